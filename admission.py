@@ -0,0 +1,215 @@
+import math
+import time
+import random
+import threading
+
+from flask import request, g, render_template, current_app
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+TOKEN_COOKIE = 'waiting_room'
+
+
+def _issued(ticket):
+    # Tickets start with their issue time in milliseconds, in hex
+    return int(ticket.split('-', 1)[0], 16)
+
+
+class AdmissionController:
+    """Per-worker admission control and load shedding.
+
+    Each worker admits at most ``max_inflight`` requests at once, and the
+    endpoints in ``limits`` at most their own count. ``reserved`` of the
+    worker's slots can only be used by the ``priority`` endpoints
+    (submit_quiz), which are never shed, so an attempt in progress always
+    gets through.
+
+    A shed take_quiz request is put in a waiting room: the response is a
+    503 with Retry-After and a signed token (a cookie, or the
+    X-Waiting-Room-Token header) holding its ticket and the time the client
+    may come back. A holder shed again keeps its place, ahead of tickets
+    issued after its own, and its wait is estimated from that place. Only
+    tickets seen in the last ``ticket_grace`` seconds past their return
+    time count towards the queue, so clients that gave up stop inflating
+    it.
+
+    When a request finishes while tickets are due back, the freed slot is
+    held for the oldest due ticket without one, for at most
+    ``hold_seconds``. Newcomers cannot take held slots, so people who have
+    been waiting get in first; a hold that is not used in time is released.
+    Otherwise any request is admitted as soon as a slot is free. The queue
+    is kept per worker, so ordering across workers is approximate.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.max_inflight = 16
+        self.reserved = 2
+        self.limits = {}
+        self.priority = {'submit_quiz'}
+        self.waiting_room = {'take_quiz'}
+        self.ticket_ttl = 120
+        self.ticket_grace = 10
+        self.hold_seconds = 2
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.endpoint_inflight = {}
+        self.outstanding = {}  # ticket id -> (due back, stops counting)
+        self.holds = {}  # ticket id -> when its held slot is released
+        self.service_rate = 1.0  # waiting-room requests completed per second (EWMA)
+        self.last_completion = time.monotonic()
+        self.counters = {'admitted': 0, 'shed': 0, 'queued': 0, 'redeemed': 0, 'held': 0, 'priority': 0}
+        self.shed_by_endpoint = {}
+        self.serializer = None
+
+    def init_app(self, app):
+        self.enabled = app.config.get('ADMISSION_ENABLED', False)
+        self.max_inflight = app.config.get('ADMISSION_MAX_INFLIGHT', 16)
+        self.reserved = app.config.get('ADMISSION_RESERVED', 2)
+        self.limits = app.config.get('ADMISSION_LIMITS', {})
+        self.ticket_ttl = app.config.get('ADMISSION_TICKET_TTL', 120)
+        self.ticket_grace = app.config.get('ADMISSION_TICKET_GRACE', 10)
+        self.hold_seconds = app.config.get('ADMISSION_HOLD_SECONDS', 2)
+        self.serializer = URLSafeTimedSerializer(app.secret_key, salt='waiting-room')
+        app.before_request(self._admit)
+        app.teardown_request(self._release)
+
+    # Admission
+
+    def _admit(self):
+        if not self.enabled or request.endpoint is None or request.endpoint == 'static':
+            return None
+        endpoint = request.endpoint
+
+        with self.lock:
+            if endpoint in self.priority:
+                self._take(endpoint)
+                self.counters['priority'] += 1
+                return None
+
+            ticket = self._ticket() if endpoint in self.waiting_room else None
+            # Slots held for others count as taken; a ticket's own hold does not
+            held = len(self._holds()) - (ticket in self.holds)
+            full = (self.inflight + held >= self.max_inflight - self.reserved
+                    or self.endpoint_inflight.get(endpoint, 0) + (held if endpoint in self.waiting_room else 0)
+                    >= self.limits.get(endpoint, math.inf))
+            if not full:
+                if ticket is not None and self.outstanding.pop(ticket, None) is not None:
+                    self.counters['redeemed'] += 1
+                    if self.holds.pop(ticket, None) is not None:
+                        self.counters['held'] += 1
+                self._take(endpoint)
+                self.counters['admitted'] += 1
+                return None
+
+            self.counters['shed'] += 1
+            self.shed_by_endpoint[endpoint] = self.shed_by_endpoint.get(endpoint, 0) + 1
+            if endpoint not in self.waiting_room or request.method != 'GET':
+                waiting = None
+            else:
+                if ticket is None:
+                    ticket = '%x-%x' % (int(time.time() * 1000), random.getrandbits(32))
+                    self.counters['queued'] += 1
+                # A holder still without room keeps its ticket and its place
+                issued = _issued(ticket)
+                position = 1 + sum(1 for other in self._outstanding()
+                                   if other != ticket and _issued(other) <= issued)
+                retry_after = min(max(math.ceil(position / max(self.service_rate, 0.1)), 1), 30)
+                not_before = time.time() + retry_after
+                self.outstanding[ticket] = (not_before, not_before + self.ticket_grace)
+                waiting = (ticket, position, retry_after, not_before)
+
+        # Rendered outside the lock
+        if waiting is None:
+            return self._busy(retry_after=1 + int(random.random() * 3))
+        return self._queue(*waiting)
+
+    def _take(self, endpoint):
+        self.inflight += 1
+        self.endpoint_inflight[endpoint] = self.endpoint_inflight.get(endpoint, 0) + 1
+        g.admitted_endpoint = endpoint
+
+    def _release(self, exc=None):
+        endpoint = g.pop('admitted_endpoint', None)
+        if endpoint is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.inflight -= 1
+            self.endpoint_inflight[endpoint] -= 1
+            if endpoint in self.waiting_room:
+                # Smoothed completions per second, for Retry-After estimates
+                interval = max(now - self.last_completion, 1e-3)
+                self.service_rate = 0.9 * self.service_rate + 0.1 * min(1 / interval, 1000)
+                self.last_completion = now
+            self._hold_for_oldest()
+
+    def _hold_for_oldest(self):
+        now = time.time()
+        holds = self._holds()
+        due = [ticket for ticket, (not_before, _) in self._outstanding().items()
+               if not_before <= now and ticket not in holds]
+        if due:
+            holds[min(due, key=_issued)] = now + self.hold_seconds
+
+    def _outstanding(self):
+        now = time.time()
+        for ticket, (_, until) in list(self.outstanding.items()):
+            if until < now:
+                del self.outstanding[ticket]
+        return self.outstanding
+
+    def _holds(self):
+        now = time.time()
+        for ticket, until in list(self.holds.items()):
+            if until < now or ticket not in self.outstanding:
+                del self.holds[ticket]
+        return self.holds
+
+    # Waiting room
+
+    def _ticket(self):
+        token = request.headers.get('X-Waiting-Room-Token') or request.cookies.get(TOKEN_COOKIE)
+        if not token:
+            return None
+        try:
+            data = self.serializer.loads(token, max_age=self.ticket_ttl)
+        except BadSignature:
+            return None
+        # Coming back early does not count
+        return data['ticket'] if data['not_before'] <= time.time() else None
+
+    def _queue(self, ticket, position, retry_after, not_before):
+        token = self.serializer.dumps({'ticket': ticket, 'not_before': not_before})
+        response = current_app.make_response((render_template('waiting_room.html', retry_after=retry_after,
+                                                              position=position, token=token), 503))
+        response.headers['Retry-After'] = str(retry_after)
+        response.headers['X-Waiting-Room-Token'] = token
+        response.set_cookie(TOKEN_COOKIE, token, max_age=self.ticket_ttl + retry_after,
+                            httponly=True, samesite='Lax')
+        return response
+
+    def _busy(self, retry_after):
+        response = current_app.make_response((render_template('waiting_room.html', retry_after=retry_after,
+                                                              position=None, token=None), 503))
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    # Metrics
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'inflight': self.inflight,
+                'max_inflight': self.max_inflight,
+                'reserved': self.reserved,
+                'endpoint_inflight': {name: count for name, count in self.endpoint_inflight.items() if count},
+                'limits': self.limits,
+                'waiting_room_depth': len(self._outstanding()),
+                'held_slots': len(self._holds()),
+                'service_rate': round(self.service_rate, 2),
+                'shed_by_endpoint': dict(self.shed_by_endpoint),
+                **self.counters,
+            }
+
+
+admission = AdmissionController()
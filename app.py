@@ -3,22 +3,24 @@ import logging
 import datetime
 import json
 import ast
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify
+import click
+from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, session, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required
-from flask_wtf.csrf import CSRFProtect
-from sqlalchemy.orm import DeclarativeBase
-from werkzeug.security import check_password_hash
+from flask_wtf.csrf import CSRFProtect, generate_csrf
+from sqlalchemy.orm import DeclarativeBase, aliased
 from sqlalchemy import func, desc
+from logconfig import structured_logging
+from replicas import RoutingSession, read_replica, stick_to_primary, sync_sqlite_replica
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (levels, format and sampling come from LOG_* variables)
+structured_logging.configure()
 
 # Initialize SQLAlchemy with the new API
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 
 # Create the Flask application
 app = Flask(__name__)
@@ -30,8 +32,128 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
+# Size the connection pool to the server's request threads (see gunicorn.conf.py)
+if os.environ.get("DB_POOL_SIZE"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]["pool_size"] = int(os.environ["DB_POOL_SIZE"])
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]["max_overflow"] = int(os.environ.get("DB_MAX_OVERFLOW", 2))
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Optional read replica for the heavy read routes; a user reads from the
+# primary for REPLICA_STICKY_SECONDS after their own submit
+if os.environ.get("REPLICA_DATABASE_URL"):
+    app.config["SQLALCHEMY_BINDS"] = {"replica": os.environ["REPLICA_DATABASE_URL"]}
+app.config["REPLICA_STICKY_SECONDS"] = int(os.environ.get("REPLICA_STICKY_SECONDS", 30))
+
+# Leaderboard index snapshotting (seconds)
+app.config["LEADERBOARD_SNAPSHOT_PATH"] = os.environ.get("LEADERBOARD_SNAPSHOT_PATH")
+app.config["LEADERBOARD_SNAPSHOT_INTERVAL"] = int(os.environ.get("LEADERBOARD_SNAPSHOT_INTERVAL", 300))
+app.config["LEADERBOARD_REBUILD_INTERVAL"] = int(os.environ.get("LEADERBOARD_REBUILD_INTERVAL", 3600))
+app.config["SKETCH_REBUILD_INTERVAL"] = int(os.environ.get("SKETCH_REBUILD_INTERVAL", 3600))
+
+# Password hashing (PASSWORD_HASH_WORKERS=0 hashes inline in the request thread)
+app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("PASSWORD_HASH_WORKERS", 0))
+app.config["PASSWORD_HASH_MAX_PENDING"] = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 0))
+app.config["PASSWORD_HASH_TIMEOUT"] = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))
+
+# Deletes run in chunks of DELETE_CHUNK_SIZE ids; subtrees with more attempts
+# than DELETE_BACKGROUND_THRESHOLD are removed on a background thread, as a
+# job that `flask resume-deletions` restarts once it has made no progress
+# for DELETE_JOB_STALE_SECONDS
+app.config["DELETE_CHUNK_SIZE"] = int(os.environ.get("DELETE_CHUNK_SIZE", 1000))
+app.config["DELETE_CHUNK_PAUSE"] = float(os.environ.get("DELETE_CHUNK_PAUSE", 0))
+app.config["DELETE_BACKGROUND_THRESHOLD"] = int(os.environ.get("DELETE_BACKGROUND_THRESHOLD", 5000))
+app.config["DELETE_JOB_STALE_SECONDS"] = int(os.environ.get("DELETE_JOB_STALE_SECONDS", 600))
+
+# Rescoring after an answer key change runs in chunks of RESCORE_CHUNK_SIZE attempts
+app.config["RESCORE_CHUNK_SIZE"] = int(os.environ.get("RESCORE_CHUNK_SIZE", 500))
+app.config["RESCORE_CHUNK_PAUSE"] = float(os.environ.get("RESCORE_CHUNK_PAUSE", 0))
+
+# Bulk user imports: rows per batch and, for `flask provision-users`, password
+# hashing processes (0 = one per CPU). Uploads from the admin page share the
+# login hashing pool and may have at most PROVISION_UPLOAD_MAX_ROWS rows
+app.config["PROVISION_BATCH_SIZE"] = int(os.environ.get("PROVISION_BATCH_SIZE", 1000))
+app.config["PROVISION_HASH_WORKERS"] = int(os.environ.get("PROVISION_HASH_WORKERS", 0))
+app.config["PROVISION_UPLOAD_MAX_ROWS"] = int(os.environ.get("PROVISION_UPLOAD_MAX_ROWS", 2000))
+
+# Request bodies (roster uploads included) larger than this are refused
+# with a 413 before they are read
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_CONTENT_LENGTH", 4 * 1024 * 1024))
+
+# Answer-similarity checks (`flask check-similarity`): a pair of attempts is
+# flagged when it shares SIMILARITY_MIN_SHARED_WRONG identical wrong answers
+# and its weighted agreement reaches SIMILARITY_THRESHOLD (processes: 0 = one per CPU)
+app.config["SIMILARITY_THRESHOLD"] = float(os.environ.get("SIMILARITY_THRESHOLD", 0.8))
+app.config["SIMILARITY_WRONG_WEIGHT"] = float(os.environ.get("SIMILARITY_WRONG_WEIGHT", 3))
+app.config["SIMILARITY_MIN_SHARED_WRONG"] = int(os.environ.get("SIMILARITY_MIN_SHARED_WRONG", 4))
+app.config["SIMILARITY_MIN_COMMON"] = int(os.environ.get("SIMILARITY_MIN_COMMON", 10))
+app.config["SIMILARITY_PROCESSES"] = int(os.environ.get("SIMILARITY_PROCESSES", 0))
+app.config["SIMILARITY_BLOCK_SIZE"] = int(os.environ.get("SIMILARITY_BLOCK_SIZE", 512))
+
+# Monthly partitions of scores and user_answers (PostgreSQL only), created
+# SCORE_PARTITION_MONTHS_AHEAD ahead by `flask partition-tables`, which
+# converts the tables on its first run and should then run daily from cron
+app.config["SCORE_PARTITION_MONTHS_AHEAD"] = int(os.environ.get("SCORE_PARTITION_MONTHS_AHEAD", 2))
+app.config["ANSWER_PARTITION_SPAN"] = int(os.environ.get("ANSWER_PARTITION_SPAN", 1000000))
+
+# Quiz history shows the last HISTORY_MONTHS calendar months unless the user
+# picks another window (?months=, 0 for all time)
+app.config["HISTORY_MONTHS"] = int(os.environ.get("HISTORY_MONTHS", 12))
+
+# Admin-only profiling (off unless PROFILING_ENABLED): sampling runs are capped
+# at PROFILE_MAX_SECONDS; tracemalloc stops after TRACEMALLOC_MAX_SECONDS or
+# once its own memory passes TRACEMALLOC_MAX_OVERHEAD_MB, checked every
+# TRACEMALLOC_CHECK_INTERVAL seconds
+app.config["PROFILING_ENABLED"] = os.environ.get("PROFILING_ENABLED", "false").lower() == "true"
+app.config["PROFILE_INTERVAL"] = float(os.environ.get("PROFILE_INTERVAL", 0.01))
+app.config["PROFILE_MAX_SECONDS"] = int(os.environ.get("PROFILE_MAX_SECONDS", 30))
+app.config["PROFILE_MAX_REQUESTS"] = int(os.environ.get("PROFILE_MAX_REQUESTS", 500))
+app.config["TRACEMALLOC_MAX_FRAMES"] = int(os.environ.get("TRACEMALLOC_MAX_FRAMES", 10))
+app.config["TRACEMALLOC_MAX_SECONDS"] = int(os.environ.get("TRACEMALLOC_MAX_SECONDS", 600))
+app.config["TRACEMALLOC_MAX_OVERHEAD_MB"] = int(os.environ.get("TRACEMALLOC_MAX_OVERHEAD_MB", 64))
+app.config["TRACEMALLOC_MIN_INTERVAL"] = int(os.environ.get("TRACEMALLOC_MIN_INTERVAL", 5))
+app.config["TRACEMALLOC_CHECK_INTERVAL"] = float(os.environ.get("TRACEMALLOC_CHECK_INTERVAL", 2))
+
+# Pre-rendered quiz papers are built this many days ahead of the quiz date
+app.config["PAPER_DIR"] = os.environ.get("PAPER_DIR")
+app.config["PAPER_PRERENDER_DAYS"] = int(os.environ.get("PAPER_PRERENDER_DAYS", 1))
+
+# Dynamic responses at least COMPRESS_MIN_SIZE bytes are gzipped
+app.config["COMPRESS_MIN_SIZE"] = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+app.config["COMPRESS_LEVEL"] = int(os.environ.get("COMPRESS_LEVEL", 6))
+
+# Compiled templates are cached in TEMPLATE_CACHE_DIR; TEMPLATES_AUTO_RELOAD
+# (re-checking template files on every render) defaults to on only in debug
+app.config["TEMPLATE_CACHE_DIR"] = os.environ.get("TEMPLATE_CACHE_DIR", os.path.join(app.instance_path, "jinja_cache"))
+app.config["TEMPLATE_WARMUP"] = os.environ.get("TEMPLATE_WARMUP", "false").lower() == "true"
+app.config["TEMPLATE_TRIM_BLOCKS"] = os.environ.get("TEMPLATE_TRIM_BLOCKS", "false").lower() == "true"
+if os.environ.get("TEMPLATES_AUTO_RELOAD"):
+    app.config["TEMPLATES_AUTO_RELOAD"] = os.environ["TEMPLATES_AUTO_RELOAD"].lower() == "true"
+
+# Cache invalidation events between workers: sqlite:///path (one machine),
+# redis://host:port/channel or redis+unix:///path; unset for a single process.
+# Cached catalog lists are re-checked against the data versions at most every
+# CATALOG_CACHE_CHECK_SECONDS, so a lost event is noticed within that time
+app.config["INVALIDATION_BUS_URL"] = os.environ.get("INVALIDATION_BUS_URL")
+app.config["CATALOG_CACHE_CHECK_SECONDS"] = float(os.environ.get("CATALOG_CACHE_CHECK_SECONDS", 10))
+
+# Admission control (off unless ADMISSION_ENABLED): per-worker concurrency
+# caps (ADMISSION_LIMITS is endpoint=count,...), with ADMISSION_RESERVED
+# slots kept for submit_quiz; waiting-room tickets stop counting towards the
+# queue ADMISSION_TICKET_GRACE seconds after their holder was due back, and
+# a freed slot is held for the oldest due ticket for ADMISSION_HOLD_SECONDS
+app.config["ADMISSION_ENABLED"] = os.environ.get("ADMISSION_ENABLED", "false").lower() == "true"
+app.config["ADMISSION_MAX_INFLIGHT"] = int(os.environ.get("ADMISSION_MAX_INFLIGHT", os.environ.get("DB_POOL_SIZE", 16)))
+app.config["ADMISSION_RESERVED"] = int(os.environ.get("ADMISSION_RESERVED", 2))
+app.config["ADMISSION_LIMITS"] = {
+    name.strip(): int(limit)
+    for name, _, limit in (item.partition("=") for item in
+                           os.environ.get("ADMISSION_LIMITS", "login=4,quiz_list=6,take_quiz=6").split(",") if item)
+}
+app.config["ADMISSION_TICKET_TTL"] = int(os.environ.get("ADMISSION_TICKET_TTL", 120))
+app.config["ADMISSION_TICKET_GRACE"] = int(os.environ.get("ADMISSION_TICKET_GRACE", 10))
+app.config["ADMISSION_HOLD_SECONDS"] = float(os.environ.get("ADMISSION_HOLD_SECONDS", 2))
+
 # Custom Jinja2 filters
 @app.template_filter('from_json')
 def from_json_filter(value):
@@ -63,8 +185,28 @@ csrf.init_app(app)
 
 # Import models and forms after initializing db to avoid circular imports
 with app.app_context():
-    from models import User, Subject, Chapter, Quiz, Question, Score, UserAnswer
+    from models import User, Subject, Chapter, Quiz, QuizPool, Question, Score, UserAnswer, SimilarityFlag
     from forms import LoginForm, RegistrationForm, SubjectForm, ChapterForm, QuizForm, QuestionForm
+    from leaderboard import leaderboards
+    from passwords import password_hasher, PasswordHasherBusy
+    from papers import papers
+    from pools import select_questions, original_answer
+    from archive import load_answers, archive_answers
+    from deletion import deleter
+    from assets import assets
+    from http_cache import http_cache, data_versions, conditional, latest_score_id
+    from templating import templates
+    from invalidation import bus, LocalCache, ALL, run_broker
+    from history import history_page, history_summary, rows_to_json, summary_cache
+    from admission import admission
+    from rescoring import rescorer
+    from provisioning import provisioner, read_roster, roster_format, RosterTooLarge, REPORT_FIELDS
+    from readmodels import (quiz_rows, admin_quiz_rows, chapter_rows, chapter_options, subject_options,
+                            completed_attempts)
+    from partitions import partitions, window_start
+    from profiling import profiler, memory_tracer, collapsed, ProfilingUnavailable
+    from sketches import sketches, Histogram
+    from integrity import similarity_checker
 
     # Create all tables
     db.create_all()
@@ -85,6 +227,179 @@ with app.app_context():
         db.session.commit()
         logging.info("Admin user created")
 
+leaderboards.init_app(app)
+sketches.init_app(app)
+password_hasher.init_app(app)
+papers.init_app(app)
+deleter.init_app(app)
+rescorer.init_app(app)
+provisioner.init_app(app)
+similarity_checker.init_app(app)
+partitions.init_app(app)
+assets.init_app(app)
+data_versions.init_app(app)
+http_cache.init_app(app)
+templates.init_app(app)
+structured_logging.init_app(app)
+bus.init_app(app)
+admission.init_app(app)
+profiler.init_app(app)
+memory_tracer.init_app(app)
+
+# In-process caches, validated against the data versions; bus events evict early
+catalog_cache = LocalCache(check_interval=app.config["CATALOG_CACHE_CHECK_SECONDS"])
+bus.subscribe(ALL, catalog_cache.evict)
+bus.subscribe(ALL, summary_cache.evict)
+# Other workers' bulk score changes need a full leaderboard rebuild, and
+# so do quizzes or chapters moving for the sketches by subject
+bus.subscribe('scores', lambda key, version: leaderboards.invalidate())
+bus.subscribe('scores', lambda key, version: sketches.invalidate())
+bus.subscribe('catalog', lambda key, version: key == 'catalog:structure' and sketches.invalidate())
+
+HISTORY_PER_PAGE = 20
+
+def history_months():
+    return max(request.args.get('months', app.config["HISTORY_MONTHS"], type=int), 0)
+
+def history_since():
+    # Calendar-month windows, so only the partitions they cover are read
+    months = history_months()
+    return window_start(months) if months else None
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Minify, fingerprint and precompress static assets."""
+    manifest = assets.build()
+    # Pre-rendered papers embed asset URLs
+    papers.discard_all()
+    click.echo(f'Built {len(manifest)} assets.')
+
+@app.cli.command('precompile-templates')
+@click.option('--clear', is_flag=True, help='Drop the existing bytecode cache first.')
+def precompile_templates_command(clear):
+    """Compile every template into the bytecode cache."""
+    if clear:
+        templates.clear()
+    count = templates.precompile()
+    click.echo(f'Precompiled {count} templates into {templates.cache_dir}.')
+
+@app.cli.command('sync-replica')
+def sync_replica_command():
+    """Copy a SQLite primary onto the SQLite replica (local testing)."""
+    if 'replica' not in db.engines:
+        raise click.ClickException('REPLICA_DATABASE_URL is not set.')
+    primary, replica = db.engines[None].url, db.engines['replica'].url
+    if primary.get_backend_name() != 'sqlite' or replica.get_backend_name() != 'sqlite':
+        raise click.ClickException('Only SQLite files can be synced; use database replication otherwise.')
+    sync_sqlite_replica(primary.database, replica.database)
+    click.echo(f'Copied {primary.database} to {replica.database}.')
+
+@app.cli.command('bus-broker')
+@click.option('--bind', default='127.0.0.1:6379', help='host:port, or a path for a Unix socket.')
+def bus_broker_command(bind):
+    """Run a local stand-in for Redis pub/sub for the invalidation bus."""
+    host, _, port = bind.rpartition(':')
+    address = (host, int(port)) if port.isdigit() else bind
+    click.echo(f'Invalidation bus broker listening on {bind}')
+    run_broker(address)
+
+@app.cli.command('rescore-quiz')
+@click.argument('quiz_id', type=int)
+def rescore_quiz_command(quiz_id):
+    """Recompute every attempt's score against the quiz's current answer key."""
+    changed = rescorer.rescore(quiz_id, progress=lambda done, total, changed: click.echo(
+        f'{done}/{total} attempts checked, {changed} rescored'))
+    click.echo(f'Rescored {changed} attempts.')
+
+@app.cli.command('resume-deletions')
+def resume_deletions_command():
+    """Finish background deletions that failed or whose worker went away."""
+    completed = deleter.resume(progress=lambda job: click.echo(
+        f'Resuming deletion job {job.id}: {job.kind} {job.row_id}, '
+        f'{job.deleted_scores}/{job.total_scores} attempts removed so far'))
+    click.echo(f'Completed {len(completed)} deletion jobs.')
+    if completed:
+        # Running workers notice through the data versions; drop the on-disk copies
+        leaderboards.discard_snapshot()
+        papers.discard_all()
+
+@app.cli.command('check-similarity')
+@click.argument('quiz_ids', type=int, nargs=-1)
+@click.option('--processes', type=int, default=None, help='Worker processes (default: SIMILARITY_PROCESSES).')
+def check_similarity_command(quiz_ids, processes):
+    """Flag suspiciously similar attempts for review (every quiz with attempts by default)."""
+    if not quiz_ids:
+        quiz_ids = [quiz_id for quiz_id, in db.session.query(Score.quiz_id).distinct().order_by(Score.quiz_id)]
+    for quiz_id in quiz_ids:
+        attempts, flagged = similarity_checker.check(quiz_id, processes=processes)
+        click.echo(f'Quiz {quiz_id}: {attempts} attempts, {flagged} pairs flagged.')
+
+@app.cli.command('provision-users')
+@click.argument('roster', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Roster format (default: from the file extension).')
+@click.option('--report', type=click.File('w'), default='-', help='Where to write the per-row CSV report.')
+def provision_users_command(roster, fmt, report):
+    """Create users in bulk from a CSV or JSONL roster."""
+    import csv
+    writer = csv.DictWriter(report, fieldnames=REPORT_FIELDS)
+    writer.writeheader()
+    with open(roster, encoding='utf-8-sig', newline='') as stream:
+        counts = provisioner.provision(read_roster(stream, fmt or roster_format(roster)), report=writer.writerow,
+                                       progress=lambda counts: click.echo(f'{sum(counts.values())} rows processed',
+                                                                          err=True))
+    click.echo(f"Created {counts['created']}, duplicates {counts['duplicate']}, errors {counts['error']}.", err=True)
+
+@app.cli.command('prerender-papers')
+@click.option('--days', type=int, default=None, help='Build papers for quizzes dated this many days ahead.')
+def prerender_papers_command(days):
+    """Pre-render the papers of upcoming quizzes."""
+    built = papers.prerender_upcoming(days)
+    click.echo(f'Pre-rendered {built} quiz papers.')
+
+@app.cli.command('archive-answers')
+@click.option('--days', type=int, default=180, help='Archive attempts older than this many days.')
+@click.option('--batch-size', type=int, default=500, help='Attempts moved per transaction.')
+@click.option('--max-batches', type=int, default=None, help='Stop after this many batches.')
+def archive_answers_command(days, batch_size, max_batches):
+    """Pack the answers of old attempts into the compact archive."""
+    archived = archive_answers(days, batch_size, max_batches,
+                               progress=lambda count, last_id: click.echo(
+                                   f'{count} attempts archived (through score {last_id})'))
+    click.echo(f'Archived {archived} attempts.')
+
+@app.cli.command('partition-tables')
+def partition_tables_command():
+    """Partition scores and user_answers by month (PostgreSQL) and create upcoming partitions."""
+    try:
+        converted, dropped = partitions.convert()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    for table in converted:
+        click.echo(f'Partitioned {table}.')
+    for referencing, constraint, definition in dropped:
+        click.echo(f'Dropped foreign key {referencing}.{constraint}: {definition}')
+    if dropped:
+        click.echo('Deletes of scores must now go through deletion.py, which removes answers first.')
+    for table, name, bounds, rows in partitions.status():
+        click.echo(f'{name:<28} {bounds:<60} ~{rows} rows')
+
+@app.cli.command('detach-partitions')
+@click.option('--before', required=True, help='First month to keep, as YYYY-MM.')
+def detach_partitions_command(before):
+    """Detach the partitions of months before --before, for archiving."""
+    try:
+        month = datetime.datetime.strptime(before, '%Y-%m').date()
+    except ValueError:
+        raise click.BadParameter('expected YYYY-MM', param_hint='--before')
+    try:
+        detached = partitions.detach_before(month)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    for name in detached:
+        click.echo(f'Detached {name}; dump it (pg_dump -t {name}) and drop it once archived.')
+    click.echo(f'Detached {len(detached)} partitions.')
+
 @login_manager.user_loader
 def load_user(id):
     from models import User
@@ -112,10 +427,22 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user is None or not check_password_hash(user.password_hash, form.password.data):
+        try:
+            # Unknown users are checked against a dummy hash to keep timing uniform
+            valid, new_hash = password_hasher.verify(user.password_hash if user else None,
+                                                     form.password.data)
+        except PasswordHasherBusy:
+            flash('The server is busy. Please try signing in again in a moment.', 'warning')
+            return render_template('login.html', form=form), 503
+        
+        if user is None or not valid:
             flash('Invalid username or password', 'danger')
             return redirect(url_for('login'))
         
+        if new_hash:
+            user.password_hash = new_hash
+            db.session.commit()
+        
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or not next_page.startswith('/'):
@@ -134,10 +461,14 @@ def register():
     
     form = RegistrationForm()
     if form.validate_on_submit():
-        from werkzeug.security import generate_password_hash
+        try:
+            password_hash = password_hasher.hash(form.password.data)
+        except PasswordHasherBusy:
+            flash('The server is busy. Please try registering again in a moment.', 'warning')
+            return render_template('register.html', form=form), 503
         user = User(
             username=form.username.data,
-            password_hash=generate_password_hash(form.password.data),
+            password_hash=password_hash,
             full_name=form.full_name.data,
             qualification=form.qualification.data,
             dob=form.dob.data
@@ -210,6 +541,7 @@ def edit_subject(id):
         subject.name = form.name.data
         subject.description = form.description.data
         db.session.commit()
+        papers.discard_all()
         flash('Subject updated successfully.', 'success')
         return redirect(url_for('manage_subjects'))
     
@@ -222,10 +554,11 @@ def delete_subject(id):
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('index'))
     
-    subject = Subject.query.get_or_404(id)
-    db.session.delete(subject)
-    db.session.commit()
-    flash('Subject deleted successfully.', 'success')
+    Subject.query.get_or_404(id)
+    if deleter.schedule('subject', id, on_done=lambda: (leaderboards.invalidate(), papers.discard_all())):
+        flash('Subject deletion started. It will disappear once all its attempts are removed.', 'info')
+    else:
+        flash('Subject deleted successfully.', 'success')
     return redirect(url_for('manage_subjects'))
 
 @app.route('/admin/chapters', methods=['GET', 'POST'])
@@ -235,8 +568,9 @@ def manage_chapters():
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('index'))
     
+    subjects = subject_options()
     form = ChapterForm()
-    form.subject_id.choices = [(s.id, s.name) for s in Subject.query.all()]
+    form.subject_id.choices = [(s.id, s.name) for s in subjects]
     
     if form.validate_on_submit():
         chapter = Chapter(
@@ -252,18 +586,10 @@ def manage_chapters():
     search_query = request.args.get('search', '')
     subject_filter = request.args.get('subject_id', type=int)
     
-    query = db.session.query(Chapter, Subject.name).join(Subject, Chapter.subject_id == Subject.id)
-    
-    if search_query:
-        query = query.filter(Chapter.name.contains(search_query))
-    if subject_filter:
-        query = query.filter(Chapter.subject_id == subject_filter)
-    
-    chapters_with_subjects = query.all()
-    subjects = Subject.query.all()
+    chapters = chapter_rows(subject_id=subject_filter, search=search_query)
     
     return render_template('admin/manage_chapters.html', 
-                          chapters=chapters_with_subjects, 
+                          chapters=chapters, 
                           form=form, 
                           subjects=subjects,
                           search_query=search_query,
@@ -285,6 +611,7 @@ def edit_chapter(id):
         chapter.name = form.name.data
         chapter.description = form.description.data
         db.session.commit()
+        papers.discard_all()
         flash('Chapter updated successfully.', 'success')
         return redirect(url_for('manage_chapters'))
     
@@ -297,12 +624,22 @@ def delete_chapter(id):
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('index'))
     
-    chapter = Chapter.query.get_or_404(id)
-    db.session.delete(chapter)
-    db.session.commit()
-    flash('Chapter deleted successfully.', 'success')
+    Chapter.query.get_or_404(id)
+    if deleter.schedule('chapter', id, on_done=lambda: (leaderboards.invalidate(), papers.discard_all())):
+        flash('Chapter deletion started. It will disappear once all its attempts are removed.', 'info')
+    else:
+        flash('Chapter deleted successfully.', 'success')
     return redirect(url_for('manage_chapters'))
 
+def apply_pool_settings(quiz, form):
+    if form.pool_size.data or form.shuffle_options.data:
+        if quiz.pool is None:
+            quiz.pool = QuizPool()
+        quiz.pool.pool_size = form.pool_size.data
+        quiz.pool.shuffle_options = form.shuffle_options.data
+    else:
+        quiz.pool = None
+
 @app.route('/admin/quizzes', methods=['GET', 'POST'])
 @login_required
 def manage_quizzes():
@@ -311,8 +648,7 @@ def manage_quizzes():
         return redirect(url_for('index'))
     
     form = QuizForm()
-    form.chapter_id.choices = [(c.id, f"{c.name} ({Subject.query.get(c.subject_id).name})") 
-                              for c in Chapter.query.all()]
+    form.chapter_id.choices = [(c.id, f"{c.name} ({c.subject_name})") for c in chapter_options()]
     
     if form.validate_on_submit():
         quiz = Quiz(
@@ -322,6 +658,7 @@ def manage_quizzes():
             date=form.date.data,
             duration=form.duration.data
         )
+        apply_pool_settings(quiz, form)
         db.session.add(quiz)
         db.session.commit()
         flash('Quiz added successfully.', 'success')
@@ -330,17 +667,8 @@ def manage_quizzes():
     search_query = request.args.get('search', '')
     chapter_filter = request.args.get('chapter_id', type=int)
     
-    query = db.session.query(Quiz, Chapter.name.label('chapter_name'), Subject.name.label('subject_name'))\
-        .join(Chapter, Quiz.chapter_id == Chapter.id)\
-        .join(Subject, Chapter.subject_id == Subject.id)
-    
-    if search_query:
-        query = query.filter(Quiz.title.contains(search_query))
-    if chapter_filter:
-        query = query.filter(Quiz.chapter_id == chapter_filter)
-    
-    quizzes = query.all()
-    chapters = Chapter.query.all()
+    quizzes = admin_quiz_rows(chapter_id=chapter_filter, search=search_query)
+    chapters = chapter_options()
     
     return render_template('admin/manage_quizzes.html', 
                           quizzes=quizzes, 
@@ -358,8 +686,10 @@ def edit_quiz(id):
     
     quiz = Quiz.query.get_or_404(id)
     form = QuizForm(obj=quiz)
-    form.chapter_id.choices = [(c.id, f"{c.name} ({Subject.query.get(c.subject_id).name})") 
-                              for c in Chapter.query.all()]
+    form.chapter_id.choices = [(c.id, f"{c.name} ({c.subject_name})") for c in chapter_options()]
+    if request.method == 'GET' and quiz.pool:
+        form.pool_size.data = quiz.pool.pool_size
+        form.shuffle_options.data = quiz.pool.shuffle_options
     
     if form.validate_on_submit():
         quiz.chapter_id = form.chapter_id.data
@@ -367,7 +697,9 @@ def edit_quiz(id):
         quiz.description = form.description.data
         quiz.date = form.date.data
         quiz.duration = form.duration.data
+        apply_pool_settings(quiz, form)
         db.session.commit()
+        papers.refresh(quiz.id)
         flash('Quiz updated successfully.', 'success')
         return redirect(url_for('manage_quizzes'))
     
@@ -380,14 +712,16 @@ def delete_quiz(id):
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('index'))
     
-    quiz = Quiz.query.get_or_404(id)
-    db.session.delete(quiz)
-    db.session.commit()
-    flash('Quiz deleted successfully.', 'success')
+    Quiz.query.get_or_404(id)
+    if deleter.schedule('quiz', id, on_done=lambda: (leaderboards.remove_quiz(id), papers.discard(id))):
+        flash('Quiz deletion started. It will disappear once all its attempts are removed.', 'info')
+    else:
+        flash('Quiz deleted successfully.', 'success')
     return redirect(url_for('manage_quizzes'))
 
 @app.route('/admin/questions/<int:quiz_id>', methods=['GET', 'POST'])
 @login_required
+@conditional(lambda quiz_id: data_versions.get(f'quiz:{quiz_id}', 'questions:bulk', 'catalog'))
 def manage_questions(quiz_id):
     if not current_user.is_admin:
         flash('Access denied. Admin privileges required.', 'danger')
@@ -412,6 +746,7 @@ def manage_questions(quiz_id):
         )
         db.session.add(question)
         db.session.commit()
+        papers.refresh(quiz_id)
         flash('Question added successfully.', 'success')
         return redirect(url_for('manage_questions', quiz_id=quiz_id))
     
@@ -451,11 +786,15 @@ def edit_question(id):
             form.option_d.data
         ]
         
+        key_changed = question.correct_answer != form.correct_answer.data
         question.question_text = form.question_text.data
         question.options = str(options)
         question.correct_answer = form.correct_answer.data
         db.session.commit()
+        papers.refresh(question.quiz_id)
         flash('Question updated successfully.', 'success')
+        if key_changed and rescorer.schedule(question.quiz_id):
+            flash('The answer key changed: existing attempts are being rescored in the background.', 'info')
         return redirect(url_for('manage_questions', quiz_id=question.quiz_id))
     
     questions = Question.query.filter_by(quiz_id=question.quiz_id).all()
@@ -478,11 +817,94 @@ def delete_question(id):
     quiz_id = question.quiz_id
     db.session.delete(question)
     db.session.commit()
+    papers.refresh(quiz_id)
     flash('Question deleted successfully.', 'success')
     return redirect(url_for('manage_questions', quiz_id=quiz_id))
 
+@app.route('/admin/quizzes/<int:quiz_id>/rescore')
+@login_required
+def rescore_status(quiz_id):
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin privileges required'}), 403
+    
+    run = rescorer.latest_run(quiz_id)
+    if run is None:
+        return jsonify({'quiz_id': quiz_id, 'status': None})
+    return jsonify({
+        'quiz_id': quiz_id,
+        'run_id': run.id,
+        'status': run.status,
+        'total_scores': run.total_scores,
+        'processed': run.processed,
+        'changed': run.changed,
+        'started_at': run.started_at.isoformat() if run.started_at else None,
+        'finished_at': run.finished_at.isoformat() if run.finished_at else None,
+        'error': run.error
+    })
+
+@app.route('/admin/integrity')
+@login_required
+def similarity_flags():
+    if not current_user.is_admin:
+        flash('Access denied. Admin privileges required.', 'danger')
+        return redirect(url_for('index'))
+    
+    quiz_id = request.args.get('quiz_id', type=int)
+    status = request.args.get('status', 'open')
+    score_a, score_b = aliased(Score), aliased(Score)
+    user_a, user_b = aliased(User), aliased(User)
+    query = db.session.query(SimilarityFlag, Quiz.title, user_a.username, user_b.username,
+                             score_a.total_score, score_b.total_score)\
+        .join(Quiz, SimilarityFlag.quiz_id == Quiz.id)\
+        .join(score_a, SimilarityFlag.score_a_id == score_a.id)\
+        .join(score_b, SimilarityFlag.score_b_id == score_b.id)\
+        .join(user_a, score_a.user_id == user_a.id)\
+        .join(user_b, score_b.user_id == user_b.id)
+    if quiz_id:
+        query = query.filter(SimilarityFlag.quiz_id == quiz_id)
+    if status != 'all':
+        query = query.filter(SimilarityFlag.status == status)
+    flags = query.order_by(SimilarityFlag.similarity.desc(), SimilarityFlag.id).limit(200).all()
+    
+    return render_template('admin/integrity.html', flags=flags, quiz_id=quiz_id, status=status)
+
+@app.route('/admin/integrity/<int:flag_id>', methods=['POST'])
+@login_required
+def review_similarity_flag(flag_id):
+    if not current_user.is_admin:
+        flash('Access denied. Admin privileges required.', 'danger')
+        return redirect(url_for('index'))
+    
+    flag = SimilarityFlag.query.get_or_404(flag_id)
+    try:
+        similarity_checker.review(flag, request.form.get('status', ''))
+    except ValueError as e:
+        flash(str(e), 'danger')
+    return redirect(url_for('similarity_flags', quiz_id=request.form.get('quiz_id', type=int),
+                            status=request.form.get('filter', 'open')))
+
+@app.route('/admin/deletions')
+@login_required
+def deletion_status():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin privileges required'}), 403
+    
+    return jsonify([{
+        'job_id': job.id,
+        'kind': job.kind,
+        'row_id': job.row_id,
+        'status': job.status,
+        'total_scores': job.total_scores,
+        'deleted_scores': job.deleted_scores,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'updated_at': job.updated_at.isoformat() if job.updated_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'error': job.error
+    } for job in deleter.jobs()])
+
 @app.route('/admin/users')
 @login_required
+@conditional(lambda: data_versions.get('users', 'catalog', 'scores:bulk') + (latest_score_id(),))
 def manage_users():
     if not current_user.is_admin:
         flash('Access denied. Admin privileges required.', 'danger')
@@ -500,6 +922,120 @@ def manage_users():
     
     return render_template('admin/manage_users.html', users=users, search_query=search_query)
 
+@app.route('/admin/metrics/admission')
+@login_required
+def admission_metrics():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin privileges required'}), 403
+    # Counters are per worker process
+    return jsonify({'pid': os.getpid(), **admission.metrics()})
+
+@app.route('/admin/profiling')
+@login_required
+def profiling_page():
+    if not profiler.enabled:
+        abort(404)
+    if not current_user.is_admin:
+        flash('Access denied. Admin privileges required.', 'danger')
+        return redirect(url_for('index'))
+    return render_template('admin/profiling.html',
+                          endpoints=sorted(name for name in app.view_functions if name != 'static'),
+                          max_seconds=profiler.max_seconds,
+                          max_requests=profiler.max_requests,
+                          max_frames=memory_tracer.max_frames,
+                          memory=memory_tracer.status())
+
+@app.route('/admin/profiling/cpu', methods=['POST'])
+@login_required
+def profile_cpu():
+    if not profiler.enabled:
+        abort(404)
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin privileges required'}), 403
+    endpoint = request.form.get('endpoint') or None
+    if endpoint is not None and endpoint not in app.view_functions:
+        return jsonify({'error': f'Unknown endpoint {endpoint}'}), 400
+    try:
+        stacks, stats = profiler.sample(seconds=request.form.get('seconds', type=float),
+                                        endpoint=endpoint,
+                                        requests=request.form.get('requests', type=int))
+    except ProfilingUnavailable as e:
+        return jsonify({'error': str(e)}), 409
+    logging.info("Profiled %s in worker %s: %s", endpoint or 'all endpoints', os.getpid(), stats)
+    # Only this worker's requests are in the profile
+    filename = f"profile-{endpoint or 'all'}-{os.getpid()}-{datetime.datetime.now():%Y%m%d-%H%M%S}.folded"
+    response = app.response_class(collapsed(stacks), mimetype='text/plain')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['X-Profile-Worker'] = str(os.getpid())
+    response.headers['X-Profile-Samples'] = str(stats['samples'])
+    response.headers['X-Profile-Requests'] = str(stats['requests'])
+    return response
+
+@app.route('/admin/profiling/memory', methods=['GET', 'POST'])
+@login_required
+def profile_memory():
+    if not memory_tracer.enabled:
+        abort(404)
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin privileges required'}), 403
+    if request.method == 'POST':
+        try:
+            if request.form.get('action') == 'stop':
+                memory_tracer.stop()
+                flash('Memory tracing stopped.', 'success')
+            else:
+                memory_tracer.start(request.form.get('frames', 1, type=int))
+                flash(f'Memory tracing started in worker {os.getpid()}.', 'success')
+        except ProfilingUnavailable as e:
+            flash(str(e), 'warning')
+        return redirect(url_for('profiling_page'))
+    try:
+        return jsonify(memory_tracer.snapshot(limit=min(request.args.get('limit', 20, type=int), 100),
+                                              key=request.args.get('key', 'lineno')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except ProfilingUnavailable as e:
+        return jsonify({'error': str(e), **memory_tracer.status()}), 409
+
+@app.errorhandler(413)
+def request_too_large(e):
+    if request.endpoint == 'import_users':
+        flash(f'The roster is larger than {app.config["MAX_CONTENT_LENGTH"] // 1024} KB. '
+              'Import it with `flask provision-users`.', 'danger')
+        return redirect(url_for('manage_users'))
+    return e
+
+@app.route('/admin/users/import', methods=['POST'])
+@login_required
+def import_users():
+    if not current_user.is_admin:
+        flash('Access denied. Admin privileges required.', 'danger')
+        return redirect(url_for('index'))
+    
+    roster = request.files.get('roster')
+    if not roster or not roster.filename:
+        flash('Choose a CSV or JSONL roster to import.', 'warning')
+        return redirect(url_for('manage_users'))
+    
+    try:
+        job_id = provisioner.start_job(roster)
+    except RosterTooLarge as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('manage_users'))
+    flash(f'Import started. The per-row report is at {url_for("import_users_report", job_id=job_id)}', 'info')
+    return redirect(url_for('manage_users'))
+
+@app.route('/admin/users/import/<job_id>')
+@login_required
+def import_users_report(job_id):
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin privileges required'}), 403
+    
+    state = provisioner.job_state(job_id)
+    if state is None:
+        return jsonify({'error': 'Unknown import job'}), 404
+    return jsonify(state)
+
 @app.route('/admin/users/delete/<int:id>', methods=['POST'])
 @login_required
 def delete_user(id):
@@ -513,10 +1049,12 @@ def delete_user(id):
         flash('Cannot delete an admin user.', 'danger')
         return redirect(url_for('manage_users'))
     
+    username = user.username
     try:
-        db.session.delete(user)
-        db.session.commit()
-        flash(f'User "{user.username}" has been deleted successfully.', 'success')
+        if deleter.schedule('user', id, on_done=lambda: leaderboards.remove_user(id)):
+            flash(f'Deletion of user "{username}" started in the background.', 'info')
+        else:
+            flash(f'User "{username}" has been deleted successfully.', 'success')
     except Exception as e:
         db.session.rollback()
         flash(f'Error deleting user: {str(e)}', 'danger')
@@ -525,6 +1063,7 @@ def delete_user(id):
 
 @app.route('/admin/analytics')
 @login_required
+@read_replica
 def admin_analytics():
     if not current_user.is_admin:
         flash('Access denied. Admin privileges required.', 'danger')
@@ -535,12 +1074,20 @@ def admin_analytics():
     total_quizzes = Quiz.query.count()
     total_subjects = Subject.query.count()
     
+    # Attempts in the last ?months= calendar months, or all time; a window
+    # only reads the partitions (or the timestamp index range) it covers
+    months = request.args.get('months', type=int)
+    since = window_start(months) if months else None
+    attempts = Score.quiz_id == Quiz.id
+    if since:
+        attempts &= Score.timestamp >= since
+    
     # Get quiz participation data
     quiz_participation = db.session.query(
         Quiz.id, 
         Quiz.title,
         func.count(Score.id).label('attempt_count')
-    ).outerjoin(Score).group_by(Quiz.id).order_by(desc('attempt_count')).limit(10).all()
+    ).outerjoin(Score, attempts).group_by(Quiz.id).order_by(desc('attempt_count')).limit(10).all()
     
     # Get subject popularity
     subject_popularity = db.session.query(
@@ -549,21 +1096,23 @@ def admin_analytics():
         func.count(Score.id).label('attempt_count')
     ).join(Chapter, Subject.id == Chapter.subject_id)\
      .join(Quiz, Chapter.id == Quiz.chapter_id)\
-     .outerjoin(Score, Quiz.id == Score.quiz_id)\
+     .outerjoin(Score, attempts)\
      .group_by(Subject.id)\
      .order_by(desc('attempt_count'))\
      .all()
     
-    # Get average scores by subject
-    avg_scores_by_subject = db.session.query(
-        Subject.name,
-        func.avg(Score.total_score).label('avg_score')
-    ).join(Chapter, Subject.id == Chapter.subject_id)\
-     .join(Quiz, Chapter.id == Quiz.chapter_id)\
-     .join(Score, Quiz.id == Score.quiz_id)\
-     .group_by(Subject.name)\
-     .order_by(desc('avg_score'))\
-     .all()
+    # Score distributions are merged from the per-month sketches instead of
+    # reading every score
+    subject_histograms = sketches.histograms('subject', [subject_id for subject_id, _, _ in subject_popularity], since)
+    subject_distributions = sorted(
+        ((name, subject_histograms[subject_id].summary()) for subject_id, name, _ in subject_popularity
+         if subject_histograms[subject_id].count),
+        key=lambda item: -item[1]['mean'])
+    overall = Histogram()
+    for histogram in subject_histograms.values():
+        overall.merge(histogram)
+    quiz_distributions = {quiz_id: histogram.summary() for quiz_id, histogram in
+                          sketches.histograms('quiz', [quiz_id for quiz_id, _, _ in quiz_participation], since).items()}
     
     return render_template('admin/analytics.html',
                           total_users=total_users,
@@ -571,7 +1120,24 @@ def admin_analytics():
                           total_subjects=total_subjects,
                           quiz_participation=quiz_participation,
                           subject_popularity=subject_popularity,
-                          avg_scores_by_subject=avg_scores_by_subject)
+                          subject_distributions=subject_distributions,
+                          quiz_distributions=quiz_distributions,
+                          overall_distribution=overall.summary(),
+                          months=months)
+
+@app.route('/admin/analytics/distribution')
+@login_required
+def score_distribution():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin privileges required'}), 403
+    months = request.args.get('months', type=int)
+    since = window_start(months) if months else None
+    quiz_id, subject_id = request.args.get('quiz_id', type=int), request.args.get('subject_id', type=int)
+    if quiz_id:
+        return jsonify({'quiz_id': quiz_id, 'months': months, **sketches.summary('quiz', quiz_id, since)})
+    if subject_id:
+        return jsonify({'subject_id': subject_id, 'months': months, **sketches.summary('subject', subject_id, since)})
+    return jsonify({'error': 'quiz_id or subject_id is required'}), 400
 
 # User routes
 @app.route('/user/dashboard')
@@ -613,6 +1179,7 @@ def user_dashboard():
 
 @app.route('/user/quizzes')
 @login_required
+@read_replica
 def quiz_list():
     if current_user.is_admin:
         return redirect(url_for('admin_dashboard'))
@@ -621,37 +1188,21 @@ def quiz_list():
     subject_id = request.args.get('subject_id', type=int)
     search_query = request.args.get('search', '')
     
-    # Base query joining quizzes with chapters and subjects
-    query = db.session.query(Quiz, Chapter.name.label('chapter_name'), Subject.name.label('subject_name'))\
-        .join(Chapter, Quiz.chapter_id == Chapter.id)\
-        .join(Subject, Chapter.subject_id == Subject.id)
-    
-    # Apply filters if provided
-    if subject_id:
-        query = query.filter(Chapter.subject_id == subject_id)
-    
-    if search_query:
-        query = query.filter(
-            (Quiz.title.contains(search_query)) |
-            (Chapter.name.contains(search_query)) |
-            (Subject.name.contains(search_query))
-        )
-    
-    # Get all quizzes with their chapter and subject info
-    quizzes = query.order_by(Quiz.date.desc()).all()
+    # Quizzes with their chapter and subject names, newest first
+    quizzes = quiz_rows(subject_id=subject_id, search=search_query)
     
     # Get all subjects for the filter dropdown
-    subjects = Subject.query.all()
+    subjects = catalog_cache.get('subject_options', subject_options, depends_on=('catalog',))
     
-    # Get the user's completed quizzes to show completion status
-    completed_quiz_ids = [score.quiz_id for score in Score.query.filter_by(user_id=current_user.id).all()]
+    # The user's attempts, to show completion status and link to results
+    completed = completed_attempts(current_user.id)
     
     return render_template('user/quiz_list.html',
                           quizzes=quizzes,
                           subjects=subjects,
                           subject_id=subject_id,
                           search_query=search_query,
-                          completed_quiz_ids=completed_quiz_ids)
+                          completed=completed)
 
 @app.route('/user/quiz/<int:quiz_id>')
 @login_required
@@ -666,16 +1217,31 @@ def take_quiz(quiz_id):
         return redirect(url_for('quiz_results', score_id=existing_score.id))
     
     quiz = Quiz.query.get_or_404(quiz_id)
+    
+    # Serve the pre-rendered paper unless there are flash messages to show;
+    # pooled quizzes differ per student and are always rendered
+    if quiz.pool is None and '_flashes' not in session:
+        paper = papers.get(quiz)
+        if paper is not None:
+            return papers.serve(paper, {
+                'csrf_token': generate_csrf(),
+                'username': current_user.username
+            })
+    
     questions = Question.query.filter_by(quiz_id=quiz_id).all()
     
     if not questions:
         flash('This quiz has no questions yet.', 'warning')
         return redirect(url_for('quiz_list'))
     
-    # Parse options from string to list for each question
-    for question in questions:
-        # Use our custom from_json filter
-        question.options_list = from_json_filter(question.options)
+    if quiz.pool is not None:
+        # Each student's selection and option order come from a per-student seed
+        questions = select_questions(quiz.pool, current_user.id, questions)
+    else:
+        # Parse options from string to list for each question
+        for question in questions:
+            # Use our custom from_json filter
+            question.options_list = from_json_filter(question.options)
     
     return render_template('user/take_quiz.html', quiz=quiz, questions=questions)
 
@@ -693,6 +1259,8 @@ def submit_quiz(quiz_id):
     
     quiz = Quiz.query.get_or_404(quiz_id)
     questions = Question.query.filter_by(quiz_id=quiz_id).all()
+    if quiz.pool is not None:
+        questions = select_questions(quiz.pool, current_user.id, questions)
     
     # Calculate score
     total_questions = len(questions)
@@ -711,6 +1279,9 @@ def submit_quiz(quiz_id):
     for question in questions:
         answer_key = f'question_{question.id}'
         user_answer = request.form.get(answer_key)
+        if quiz.pool is not None:
+            # Answers are positions in the shuffled order
+            user_answer = original_answer(question, user_answer)
         
         # Save user's answer
         user_answer_record = UserAnswer(
@@ -736,12 +1307,17 @@ def submit_quiz(quiz_id):
     new_score.total_score = score_percentage
     
     db.session.commit()
+    leaderboards.record(new_score)
+    sketches.record(new_score)
+    # The replica may not have this attempt yet
+    stick_to_primary()
     
     flash('Quiz submitted successfully!', 'success')
     return redirect(url_for('quiz_results', score_id=new_score.id))
 
 @app.route('/user/quiz/results/<int:score_id>')
 @login_required
+@read_replica
 def quiz_results(score_id):
     if current_user.is_admin:
         return redirect(url_for('admin_dashboard'))
@@ -755,35 +1331,101 @@ def quiz_results(score_id):
     
     quiz = Quiz.query.get(score.quiz_id)
     
-    # Get user answers with questions
-    user_answers = db.session.query(UserAnswer, Question)\
-        .join(Question, UserAnswer.question_id == Question.id)\
-        .filter(UserAnswer.score_id == score_id)\
-        .all()
+    # Get user answers with questions, from the hot table or the archive
+    user_answers = load_answers(score_id)
     
     # Parse options from string to list for each question
     for _, question in user_answers:
         # Use our custom from_json filter
         question.options_list = from_json_filter(question.options)
     
+    rank, ranked_count = leaderboards.quiz_rank(quiz.id, current_user.id)
+    
     return render_template('user/quiz_results.html',
                           score=score,
                           quiz=quiz,
-                          user_answers=user_answers)
+                          user_answers=user_answers,
+                          rank=rank,
+                          ranked_count=ranked_count)
 
 @app.route('/user/history')
 @login_required
+@read_replica
+@conditional(lambda: data_versions.get('catalog', f'user:{current_user.id}', 'scores:bulk') + (history_since(),))
 def user_history():
     if current_user.is_admin:
         return redirect(url_for('admin_dashboard'))
     
-    # Get all user's scores with quiz information
-    scores = db.session.query(Score, Quiz.title, Chapter.name.label('chapter_name'), Subject.name.label('subject_name'))\
-        .join(Quiz, Score.quiz_id == Quiz.id)\
-        .join(Chapter, Quiz.chapter_id == Chapter.id)\
-        .join(Subject, Chapter.subject_id == Subject.id)\
-        .filter(Score.user_id == current_user.id)\
-        .order_by(Score.timestamp.desc())\
-        .all()
+    page = max(request.args.get('page', 1, type=int), 1)
+    months, since = history_months(), history_since()
+    
+    # One page of attempts in the window; the charts are drawn from the cached summary
+    rows, total = history_page(current_user.id, page, HISTORY_PER_PAGE, since)
+    summary = history_summary(current_user.id, since)
     
-    return render_template('user/history.html', scores=scores)
+    return render_template('user/history.html',
+                          rows=rows,
+                          total=total,
+                          months=months,
+                          page=page,
+                          pages=max((total + HISTORY_PER_PAGE - 1) // HISTORY_PER_PAGE, 1),
+                          summary=summary)
+
+@app.route('/user/history/data')
+@login_required
+@read_replica
+@conditional(lambda: data_versions.get('catalog', f'user:{current_user.id}', 'scores:bulk') + (history_since(),))
+def user_history_data():
+    if current_user.is_admin:
+        return jsonify({'error': 'Not available for admins'}), 403
+    
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', HISTORY_PER_PAGE, type=int), 1), 100)
+    columnar = request.args.get('format') == 'columnar'
+    
+    rows, total = history_page(current_user.id, page, per_page, history_since())
+    return jsonify({
+        'months': history_months(),
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'has_next': page * per_page < total,
+        'columns' if columnar else 'items': rows_to_json(rows, columnar)
+    })
+
+@app.route('/user/history/summary')
+@login_required
+def user_history_summary():
+    if current_user.is_admin:
+        return jsonify({'error': 'Not available for admins'}), 403
+    return jsonify({'months': history_months(), **history_summary(current_user.id, history_since())})
+
+@app.route('/user/leaderboard')
+@app.route('/user/leaderboard/<int:quiz_id>')
+@login_required
+def leaderboard(quiz_id=None):
+    if current_user.is_admin:
+        return redirect(url_for('admin_dashboard'))
+    
+    limit = min(request.args.get('limit', 10, type=int), 100)
+    
+    if quiz_id is not None:
+        quiz = Quiz.query.get_or_404(quiz_id)
+        entries = [(rank, user_id, total_score, None)
+                   for rank, user_id, total_score in leaderboards.quiz_top(quiz_id, limit)]
+        rank, ranked_count = leaderboards.quiz_rank(quiz_id, current_user.id)
+    else:
+        quiz = None
+        entries = leaderboards.global_top(limit)
+        rank, ranked_count = leaderboards.global_rank(current_user.id)
+    
+    # Only the displayed rows need a user lookup
+    user_ids = [user_id for _, user_id, _, _ in entries]
+    names = dict(db.session.query(User.id, User.full_name).filter(User.id.in_(user_ids)).all())
+    
+    return render_template('user/leaderboard.html',
+                          quiz=quiz,
+                          entries=entries,
+                          names=names,
+                          rank=rank,
+                          ranked_count=ranked_count)
@@ -0,0 +1,131 @@
+import sys
+import logging
+import datetime
+from array import array
+from collections import namedtuple
+
+from app import db
+from models import Score, UserAnswer, Question, AnswerArchive
+
+FORMAT_VERSION = 1
+NO_ANSWER = 0xF  # Nibble value for an unanswered question
+
+# Stands in for a UserAnswer row when reading from the archive
+ArchivedAnswer = namedtuple('ArchivedAnswer', ['question_id', 'user_answer'])
+
+
+class Unpackable(ValueError):
+    """An answer that does not fit the packed format (not an option index 0-14)."""
+
+
+def pack_answers(answers):
+    """Pack ``(question_id, user_answer)`` pairs into one blob.
+
+    Layout: a version byte, the question count as uint32, the question ids as
+    little-endian uint32s, then one nibble per answer holding the option index
+    (0xF for no answer).
+    """
+    question_ids = array('I', (question_id for question_id, _ in answers))
+    nibbles = bytearray((len(answers) + 1) // 2)
+    for i, (_, user_answer) in enumerate(answers):
+        if user_answer is None or user_answer == '':
+            value = NO_ANSWER
+        elif user_answer.isdigit() and int(user_answer) < NO_ANSWER:
+            value = int(user_answer)
+        else:
+            raise Unpackable(user_answer)
+        nibbles[i // 2] |= value << (4 * (i % 2))
+    if sys.byteorder == 'big':
+        question_ids.byteswap()
+    header = bytes([FORMAT_VERSION]) + len(answers).to_bytes(4, 'little')
+    return header + question_ids.tobytes() + bytes(nibbles)
+
+
+def unpack_answers(blob):
+    """Inverse of pack_answers; returns a list of ArchivedAnswer."""
+    if blob[0] != FORMAT_VERSION:
+        raise ValueError(f'Unknown answer archive format {blob[0]}')
+    count = int.from_bytes(blob[1:5], 'little')
+    question_ids = array('I')
+    question_ids.frombytes(blob[5:5 + 4 * count])
+    if sys.byteorder == 'big':
+        question_ids.byteswap()
+    nibbles = blob[5 + 4 * count:]
+    answers = []
+    for i, question_id in enumerate(question_ids):
+        value = (nibbles[i // 2] >> (4 * (i % 2))) & 0xF
+        answers.append(ArchivedAnswer(question_id, None if value == NO_ANSWER else str(value)))
+    return answers
+
+
+def load_answers(score_id):
+    """Return ``(answer, question)`` pairs for a score from whichever tier holds them."""
+    user_answers = db.session.query(UserAnswer, Question)\
+        .join(Question, UserAnswer.question_id == Question.id)\
+        .filter(UserAnswer.score_id == score_id)\
+        .all()
+    if user_answers:
+        return user_answers
+
+    archive = db.session.get(AnswerArchive, score_id)
+    if archive is None:
+        return []
+    answers = unpack_answers(archive.answers)
+    questions = {question.id: question for question in
+                 Question.query.filter(Question.id.in_([a.question_id for a in answers])).all()}
+    # Questions deleted since archiving are skipped, as the join above would
+    return [(answer, questions[answer.question_id]) for answer in answers
+            if answer.question_id in questions]
+
+
+def archive_answers(older_than_days=180, batch_size=500, max_batches=None, progress=None):
+    """Move answers of old attempts from user_answers into packed archives.
+
+    Works through scores older than the cutoff in id order, one batch per
+    transaction, so it can run alongside live traffic and can be stopped and
+    restarted at any point: a score is either fully archived or untouched.
+    Attempts with answers that cannot be packed stay in the hot table.
+    Returns the number of scores archived.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than_days)
+    last_id = 0
+    archived = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        score_ids = [row[0] for row in db.session.query(Score.id)
+                     .filter(Score.id > last_id, Score.timestamp < cutoff)
+                     .filter(Score.id.in_(db.session.query(UserAnswer.score_id)))
+                     .order_by(Score.id)
+                     .limit(batch_size)
+                     .all()]
+        if not score_ids:
+            break
+        last_id = score_ids[-1]
+
+        rows = db.session.query(UserAnswer.score_id, UserAnswer.question_id, UserAnswer.user_answer)\
+            .filter(UserAnswer.score_id.in_(score_ids))\
+            .order_by(UserAnswer.score_id, UserAnswer.id)\
+            .all()
+        by_score = {}
+        for score_id, question_id, user_answer in rows:
+            by_score.setdefault(score_id, []).append((question_id, user_answer))
+
+        packed = []
+        for score_id, answers in by_score.items():
+            try:
+                packed.append({'score_id': score_id, 'answers': pack_answers(answers),
+                               'archived_at': datetime.datetime.now()})
+            except Unpackable as e:
+                logging.warning("Leaving score %s in user_answers: unpackable answer %r", score_id, str(e))
+
+        if packed:
+            done = [row['score_id'] for row in packed]
+            db.session.execute(AnswerArchive.__table__.insert(), packed)
+            db.session.execute(UserAnswer.__table__.delete().where(UserAnswer.score_id.in_(done)))
+        db.session.commit()
+
+        archived += len(packed)
+        batches += 1
+        if progress:
+            progress(archived, last_id)
+    return archived
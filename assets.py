@@ -0,0 +1,128 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+
+from flask import url_for, send_from_directory, request
+
+try:
+    import brotli
+except ImportError:  # Optional: only gzip variants are built without it
+    brotli = None
+
+# Source files under static/ that go through the pipeline
+SOURCES = ['css/custom.css', 'js/chart-utils.js', 'js/quiz.js']
+
+ONE_YEAR = 365 * 24 * 3600
+
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    # Space after a property name's colon (not selector pseudo-classes)
+    text = re.sub(r'([{;][-\w]+):\s+', r'\1:', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    # Deliberately conservative: without a parser, only block comments,
+    # whole-line comments, indentation and blank lines are safe to drop
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+class AssetPipeline:
+    """Fingerprinted, minified and precompressed static assets.
+
+    ``flask build-assets`` writes ``static/dist/<name>.<hash>.<ext>`` plus
+    ``.gz`` (and ``.br`` when brotli is installed) variants and a manifest.
+    Templates call ``asset_url('js/quiz.js')``; with a manifest present this
+    points at the fingerprinted file, which is served with a one-year
+    immutable Cache-Control and the best precompressed variant the client
+    accepts. Without a build, the original files are used unchanged.
+    """
+
+    def __init__(self):
+        self.static_folder = None
+        self.dist_folder = None
+        self.manifest = {}
+        self.version = ''
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.dist_folder = os.path.join(app.static_folder, 'dist')
+        self.load_manifest()
+        app.add_template_global(self.asset_url, 'asset_url')
+        app.add_url_rule(f'{app.static_url_path}/dist/<path:filename>', 'dist_asset', self.serve)
+
+    def load_manifest(self):
+        path = os.path.join(self.dist_folder, 'manifest.json')
+        try:
+            with open(path) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+        self.version = hashlib.sha1(json.dumps(self.manifest, sort_keys=True).encode()).hexdigest()[:12]
+
+    def asset_url(self, filename):
+        built = self.manifest.get(filename)
+        if built is None:
+            return url_for('static', filename=filename)
+        return url_for('dist_asset', filename=built)
+
+    def serve(self, filename):
+        accepted = request.accept_encodings
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if encoding in accepted and os.path.exists(os.path.join(self.dist_folder, filename + suffix)):
+                response = send_from_directory(self.dist_folder, filename + suffix,
+                                               mimetype=_mimetype(filename), max_age=ONE_YEAR)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.dist_folder, filename, max_age=ONE_YEAR)
+        response.vary.add('Accept-Encoding')
+        # Fingerprinted names never change content
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def build(self):
+        """Minify, fingerprint and precompress every source; returns the manifest."""
+        manifest = {}
+        for source in SOURCES:
+            with open(os.path.join(self.static_folder, source), encoding='utf-8') as f:
+                text = f.read()
+            minified = (minify_css(text) if source.endswith('.css') else minify_js(text)).encode()
+            digest = hashlib.sha256(minified).hexdigest()[:10]
+            stem, ext = os.path.splitext(source)
+            built = f'{stem}.{digest}{ext}'
+
+            target = os.path.join(self.dist_folder, built)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(minified)
+            with open(target + '.gz', 'wb') as f:
+                f.write(gzip.compress(minified, 9, mtime=0))
+            if brotli is not None:
+                with open(target + '.br', 'wb') as f:
+                    f.write(brotli.compress(minified, quality=11))
+            manifest[source] = built
+            logging.info("Built %s (%d -> %d bytes)", built, len(text), len(minified))
+
+        path = os.path.join(self.dist_folder, 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+        self.load_manifest()
+        return manifest
+
+
+def _mimetype(filename):
+    return 'text/css' if filename.endswith('.css') else 'application/javascript'
+
+
+assets = AssetPipeline()
@@ -0,0 +1,98 @@
+"""Logging overhead on the quiz submit path.
+
+Runs the same sequence of quiz submissions in a fresh process per logging
+setup and prints the per-submit latency of each:
+
+    legacy      root logger at DEBUG, text, written synchronously (the old
+                logging.basicConfig(level=logging.DEBUG))
+    sync json   the defaults, but written from the request thread
+    default     INFO, JSON, queued to a listener thread, request events sampled
+
+On SQLite the latencies of the three stay within run-to-run noise of each
+other (p50 around 8-9ms both ways); what the defaults change is the log
+volume, about 5x fewer bytes than legacy.
+
+    python benchmarks/logging_benchmark.py --students 100
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+PASSWORD = 'password123'
+
+SCENARIOS = [
+    ('legacy', {'LOG_LEVEL': 'DEBUG', 'LOG_FORMAT': 'text', 'LOG_ASYNC': 'false', 'LOG_SAMPLE': ''}),
+    ('sync json', {'LOG_ASYNC': 'false'}),
+    ('default', {}),
+]
+
+
+def child(students):
+    """Runs in the fresh process; prints submit latencies as JSON."""
+    import time
+    import init_db
+    from app import app, db
+    from models import User, Quiz
+    from werkzeug.security import generate_password_hash
+
+    init_db.init_database()
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'student{i}', 'password_hash': generate_password_hash(PASSWORD),
+             'full_name': f'Student {i}', 'is_admin': False}
+            for i in range(students)
+        ])
+        db.session.commit()
+        quiz_ids = [quiz.id for quiz in Quiz.query.all()]
+
+    latencies = []
+    for i in range(students):
+        client = app.test_client()
+        client.post('/login', data={'username': f'student{i}', 'password': PASSWORD})
+        for quiz_id in quiz_ids:
+            page = client.get(f'/user/quiz/{quiz_id}').get_data(as_text=True)
+            answers = {name: '0' for name in set(re.findall(r'name="(question_\d+)"', page))}
+            start = time.perf_counter()
+            client.post(f'/user/quiz/{quiz_id}/submit', data=answers)
+            latencies.append(time.perf_counter() - start)
+    print(json.dumps(latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=100)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.students)
+
+    print(f"{'logging':<10} {'p50':>9} {'p99':>9} {'log bytes':>11}")
+    for label, settings in SCENARIOS:
+        work_dir = tempfile.mkdtemp()
+        log_file = os.path.join(work_dir, 'app.log')
+        env = dict(os.environ,
+                   DATABASE_URL=f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+                   LEADERBOARD_SNAPSHOT_PATH=os.path.join(work_dir, 'leaderboard.json'),
+                   PAPER_DIR=os.path.join(work_dir, 'papers'),
+                   LOG_FILE=log_file,
+                   **settings)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child',
+                                 '--students', str(args.students)],
+                                cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+        latencies = sorted(json.loads(output.strip().splitlines()[-1]))
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(f"{label:<10} {statistics.median(latencies) * 1000:7.2f}ms {p99 * 1000:7.2f}ms "
+              f"{os.path.getsize(log_file):11d}")
+
+
+if __name__ == '__main__':
+    main()
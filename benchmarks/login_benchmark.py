@@ -0,0 +1,93 @@
+"""Concurrent login benchmark.
+
+Fires a burst of concurrent logins (a mix of valid, wrong-password and
+unknown-user attempts) at the app with password hashing inline and then
+offloaded to the process pool, and prints throughput and latency for each.
+
+    python benchmarks/login_benchmark.py --users 200 --concurrency 32
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_db_dir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+os.environ.setdefault("LEADERBOARD_SNAPSHOT_PATH", os.path.join(_db_dir, 'leaderboard.json'))
+
+from app import app, db
+from models import User
+from passwords import password_hasher
+
+PASSWORD = 'password123'
+
+
+def seed_users(count, method):
+    # Every user shares one hash so seeding does not dominate the run
+    from werkzeug.security import generate_password_hash
+    pwhash = generate_password_hash(PASSWORD, method=method)
+    with app.app_context():
+        db.session.execute(User.__table__.delete().where(User.is_admin.is_(False)))
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'student{i}', 'password_hash': pwhash,
+             'full_name': f'Student {i}', 'is_admin': False}
+            for i in range(count)
+        ])
+        db.session.commit()
+
+
+def login(i, users):
+    client = app.test_client()
+    if i % 10 == 8:
+        data = {'username': f'student{i % users}', 'password': 'wrong-password'}
+    elif i % 10 == 9:
+        data = {'username': f'nobody{i}', 'password': PASSWORD}
+    else:
+        data = {'username': f'student{i % users}', 'password': PASSWORD}
+    start = time.perf_counter()
+    response = client.post('/login', data=data)
+    return time.perf_counter() - start, response.status_code
+
+
+def run(label, attempts, users, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda i: login(i, users), range(attempts)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    shed = sum(1 for _, status in results if status == 503)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<24} {attempts / elapsed:8.1f} logins/s  "
+          f"p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+          f"p95 {p95 * 1000:7.1f} ms  shed {shed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--attempts', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--method', default='scrypt')
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    seed_users(args.users, args.method)
+
+    password_hasher.configure(method=args.method, workers=0)
+    run('inline', args.attempts, args.users, args.concurrency)
+
+    password_hasher.configure(method=args.method, workers=args.workers,
+                              max_pending=args.concurrency, timeout=30)
+    run(f'pool ({args.workers} workers)', args.attempts, args.users, args.concurrency)
+    password_hasher.shutdown()
+
+
+if __name__ == '__main__':
+    main()
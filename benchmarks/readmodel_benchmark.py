@@ -0,0 +1,121 @@
+"""Listing-page queries: full ORM hydration against the read models.
+
+Fills a scratch database with --rows quizzes and as many attempts for one
+user, then times each listing query both ways and records the peak memory
+(tracemalloc) of building its result:
+
+    orm         the old queries, loading Quiz/Chapter/Score instances
+    read model  column-only selects into the rows in readmodels.py / history.py
+
+    python benchmarks/readmodel_benchmark.py --rows 20000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import datetime
+import statistics
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+
+def seed(db, rows):
+    from models import User, Subject, Chapter, Quiz, Score
+    from werkzeug.security import generate_password_hash
+
+    subjects, chapters = 20, 200
+    today = datetime.date.today()
+    db.session.execute(Subject.__table__.insert(), [
+        {'id': i + 1, 'name': f'Subject {i}', 'description': 'Benchmark subject'} for i in range(subjects)])
+    db.session.execute(Chapter.__table__.insert(), [
+        {'id': i + 1, 'subject_id': i % subjects + 1, 'name': f'Chapter {i}',
+         'description': 'A chapter with a description long enough to be truncated in the table'}
+        for i in range(chapters)])
+    db.session.execute(Quiz.__table__.insert(), [
+        {'id': i + 1, 'chapter_id': i % chapters + 1, 'title': f'Quiz {i}',
+         'description': 'Questions covering the whole chapter', 'date': today - datetime.timedelta(days=i % 365),
+         'duration': 30} for i in range(rows)])
+    db.session.execute(User.__table__.insert(), [
+        {'username': 'benchuser', 'password_hash': generate_password_hash('password123'),
+         'full_name': 'Bench User', 'is_admin': False}])
+    user_id = User.query.filter_by(username='benchuser').one().id
+    now = datetime.datetime.now()
+    db.session.execute(Score.__table__.insert(), [
+        {'quiz_id': i + 1, 'user_id': user_id, 'timestamp': now - datetime.timedelta(minutes=i),
+         'total_questions': 10, 'correct_answers': i % 11, 'total_score': i % 11 * 10.0}
+        for i in range(rows)])
+    db.session.commit()
+    return user_id
+
+
+def measure(db, load, runs):
+    """Median seconds and peak traced bytes of ``load()``, each on a fresh session."""
+    timings = []
+    for _ in range(runs):
+        db.session.remove()
+        start = time.perf_counter()
+        result = load()
+        timings.append(time.perf_counter() - start)
+        del result
+    db.session.remove()
+    tracemalloc.start()
+    result = load()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    count = len(result)
+    del result
+    return statistics.median(timings), peak, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000, help='quizzes (and attempts) to seed')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs per query')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    os.environ.update(DATABASE_URL=f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+                      LEADERBOARD_SNAPSHOT_PATH=os.path.join(work_dir, 'leaderboard.json'),
+                      PAPER_DIR=os.path.join(work_dir, 'papers'),
+                      INVALIDATION_BUS_URL='')
+    from app import app, db
+    from models import Quiz, Chapter, Subject, Score
+    from history import history_page
+    from readmodels import quiz_rows, admin_quiz_rows, chapter_rows, chapter_options
+
+    def orm_quizzes():
+        return db.session.query(Quiz, Chapter.name.label('chapter_name'), Subject.name.label('subject_name'))\
+            .join(Chapter, Quiz.chapter_id == Chapter.id)\
+            .join(Subject, Chapter.subject_id == Subject.id)
+
+    with app.app_context():
+        user_id = seed(db, args.rows)
+        cases = [
+            ('quiz_list', lambda: orm_quizzes().order_by(Quiz.date.desc()).all(), quiz_rows),
+            ('manage_quizzes', lambda: orm_quizzes().all(), admin_quiz_rows),
+            ('manage_chapters', lambda: db.session.query(Chapter, Subject.name)
+                .join(Subject, Chapter.subject_id == Subject.id).all(), chapter_rows),
+            ('chapter choices', lambda: [(c.id, f"{c.name} ({Subject.query.get(c.subject_id).name})")
+                                         for c in Chapter.query.all()], chapter_options),
+            ('user_history', lambda: db.session.query(Score, Quiz.title, Subject.name, Chapter.name)
+                .join(Quiz, Score.quiz_id == Quiz.id)
+                .join(Chapter, Quiz.chapter_id == Chapter.id)
+                .join(Subject, Chapter.subject_id == Subject.id)
+                .filter(Score.user_id == user_id)
+                .order_by(Score.timestamp.desc()).all(),
+             lambda: history_page(user_id, per_page=args.rows)[0]),
+        ]
+
+        print(f"{'query':<16} {'rows':>6} {'orm':>10} {'read model':>11} {'orm peak':>10} {'rm peak':>9}")
+        for label, orm, read_model in cases:
+            orm_time, orm_peak, count = measure(db, orm, args.runs)
+            rm_time, rm_peak, _ = measure(db, read_model, args.runs)
+            print(f"{label:<16} {count:>6} {orm_time * 1000:8.1f}ms {rm_time * 1000:9.1f}ms "
+                  f"{orm_peak / 2 ** 20:8.1f}MB {rm_peak / 2 ** 20:7.1f}MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Load test comparing gunicorn's sync and threaded workers.
+
+Seeds a database, starts gunicorn with gunicorn.conf.py once per mode, logs
+in a set of students and hammers the read-heavy routes (quiz_list,
+take_quiz, quiz_results, user_history) from many concurrent clients.
+
+    python benchmarks/serving_benchmark.py --workers 2 --threads 8 --clients 64
+
+Point DATABASE_URL at Postgres to include real network round trips; the
+default is a throwaway SQLite file.
+"""
+import os
+import re
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.parse
+import urllib.request
+import http.cookiejar
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+_work_dir = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_work_dir, 'bench.db')}")
+os.environ.setdefault("LEADERBOARD_SNAPSHOT_PATH", os.path.join(_work_dir, 'leaderboard.json'))
+os.environ.setdefault("PAPER_DIR", os.path.join(_work_dir, 'papers'))
+
+PASSWORD = 'password123'
+
+
+def seed(students):
+    import init_db
+    from app import app, db
+    from models import User, Quiz, Score
+    from werkzeug.security import generate_password_hash
+
+    init_db.init_database()
+    pwhash = generate_password_hash(PASSWORD)
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'student{i}', 'password_hash': pwhash,
+             'full_name': f'Student {i}', 'is_admin': False}
+            for i in range(students)
+        ])
+        db.session.commit()
+        quiz_ids = [quiz.id for quiz in Quiz.query.all()]
+        user_ids = [user.id for user in User.query.filter(User.username.like('student%')).all()]
+        # Give everyone a completed first quiz so quiz_results and history have data
+        db.session.execute(Score.__table__.insert(), [
+            {'quiz_id': quiz_ids[0], 'user_id': user_id, 'total_score': 66.7,
+             'correct_answers': 2, 'total_questions': 3}
+            for user_id in user_ids
+        ])
+        db.session.commit()
+        return quiz_ids
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(worker_class, workers, threads):
+    port = free_port()
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=worker_class, GUNICORN_WORKERS=str(workers),
+               GUNICORN_THREADS=str(threads), GUNICORN_BIND=f'127.0.0.1:{port}')
+    env.pop('DB_POOL_SIZE', None)
+    env.pop('DB_MAX_OVERFLOW', None)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'main:app'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base + '/', timeout=1)
+            return server, base
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def login(base, username):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    page = opener.open(base + '/login').read().decode()
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+    data = urllib.parse.urlencode({'csrf_token': token, 'username': username, 'password': PASSWORD})
+    opener.open(base + '/login', data.encode())
+    return opener
+
+
+def run(label, base, students, clients, requests_per_client, quiz_ids):
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        openers = list(pool.map(lambda i: login(base, f'student{i % students}'), range(clients)))
+
+    paths = ['/user/quizzes', f'/user/quiz/{quiz_ids[-1]}', '/user/history', '/user/quiz/results/{score}']
+
+    def client(i):
+        opener = openers[i]
+        latencies, errors = [], 0
+        for n in range(requests_per_client):
+            path = paths[n % len(paths)].format(score=(i % students) + 1)
+            start = time.perf_counter()
+            try:
+                opener.open(base + path, timeout=30).read()
+            except OSError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(client, range(clients)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    errors = sum(result[1] for result in results)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{label:<32} {len(latencies) / elapsed:8.1f} req/s  "
+          f"p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+          f"p99 {p99 * 1000:7.1f} ms  errors {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=40, help='requests per client')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    quiz_ids = seed(args.students)
+    for label, worker_class, threads in (('sync', 'sync', 1),
+                                         (f'gthread ({args.threads} threads)', 'gthread', args.threads)):
+        server, base = start_server(worker_class, args.workers, threads)
+        try:
+            run(f'{label}, {args.workers} workers', base, args.students, args.clients,
+                args.requests, quiz_ids)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
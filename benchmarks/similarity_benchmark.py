@@ -0,0 +1,123 @@
+"""Answer-similarity check: naive pairwise comparison against packed bitsets.
+
+Builds a synthetic cohort of --attempts attempts at a --questions question
+quiz, with --copies planted pairs where one attempt copies another except
+for a few answers, then finds similar pairs three ways:
+
+    naive       per-pair loop over per-question answer dicts (run on the
+                first --naive-attempts attempts and scaled up by pair count)
+    packed      find_similar in this process
+    packed xN   find_similar over N worker processes
+
+and reports the time taken and how many of the planted pairs were found.
+
+    python benchmarks/similarity_benchmark.py --attempts 5000 --processes 4
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+
+def cohort(attempts, questions, options, copies, seed):
+    """``(key, answers, planted)``: the answer key, one ``{question_id: answer}`` per
+    attempt and the set of planted ``(source, copy)`` index pairs."""
+    rng = random.Random(seed)
+    key = {question_id: rng.randrange(options) for question_id in range(1, questions + 1)}
+    answers = []
+    for _ in range(attempts):
+        ability = rng.betavariate(5, 2)
+        answers.append({question_id: str(correct if rng.random() < ability else rng.randrange(options))
+                        for question_id, correct in key.items() if rng.random() < 0.97})
+    planted = set()
+    for source, copy in zip(rng.sample(range(attempts), copies), rng.sample(range(attempts), copies)):
+        if source == copy:
+            continue
+        copied = dict(answers[source])
+        for question_id in rng.sample(sorted(copied), min(3, len(copied))):
+            copied[question_id] = str(rng.randrange(options))
+        answers[copy] = copied
+        planted.add((min(source, copy), max(source, copy)))
+    return key, answers, planted
+
+
+def naive(key, answers, criteria):
+    """The same test as find_similar, one question at a time."""
+    extra = criteria.wrong_weight - 1
+    wrong_counts = [sum(answer != str(key[question_id]) for question_id, answer in attempt.items())
+                    for attempt in answers]
+    flagged = []
+    for i in range(len(answers)):
+        for j in range(i + 1, len(answers)):
+            common = matches = shared_wrong = 0
+            for question_id, answer in answers[i].items():
+                other = answers[j].get(question_id)
+                if other is None:
+                    continue
+                common += 1
+                if answer == other:
+                    matches += 1
+                    if answer != str(key[question_id]):
+                        shared_wrong += 1
+            if shared_wrong < criteria.min_shared_wrong or common < criteria.min_common:
+                continue
+            similarity = (matches + extra * shared_wrong) / (common + extra * max(wrong_counts[i], wrong_counts[j]))
+            if similarity >= criteria.threshold:
+                flagged.append((i, j))
+    return flagged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--attempts', type=int, default=3000, help='attempts in the cohort')
+    parser.add_argument('--questions', type=int, default=40, help='questions in the quiz')
+    parser.add_argument('--options', type=int, default=4, help='options per question')
+    parser.add_argument('--copies', type=int, default=20, help='planted copied pairs')
+    parser.add_argument('--naive-attempts', type=int, default=400, help='attempts compared the naive way')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--block-size', type=int, default=512, help='attempts per block')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    os.environ.update(DATABASE_URL=f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+                      LEADERBOARD_SNAPSHOT_PATH=os.path.join(work_dir, 'leaderboard.json'),
+                      PAPER_DIR=os.path.join(work_dir, 'papers'),
+                      INVALIDATION_BUS_URL='')
+    import app  # noqa: F401 (configures the checker)
+    from integrity import PackedAttempts, find_similar, similarity_checker
+
+    criteria = similarity_checker.criteria
+    key, answers, planted = cohort(args.attempts, args.questions, args.options, args.copies, args.seed)
+    print(f"{args.attempts} attempts, {args.questions} questions, {len(planted)} planted pairs; {criteria}")
+
+    sample = answers[:args.naive_attempts]
+    start = time.perf_counter()
+    naive(key, sample, criteria)
+    elapsed = time.perf_counter() - start
+    scale = (args.attempts * (args.attempts - 1)) / max(len(sample) * (len(sample) - 1), 1)
+    print(f"{'naive':<12} {elapsed * scale:9.2f}s  (estimated from {len(sample)} attempts)")
+
+    start = time.perf_counter()
+    attempts = PackedAttempts.for_questions((question_id, correct, args.options)
+                                            for question_id, correct in key.items())
+    for index, attempt in enumerate(answers):
+        attempts.add(index, attempt.items())
+    print(f"{'pack':<12} {time.perf_counter() - start:9.2f}s")
+
+    for processes in sorted({1, args.processes}):
+        start = time.perf_counter()
+        pairs = find_similar(attempts, criteria, processes, args.block_size)
+        elapsed = time.perf_counter() - start
+        found = {(pair.a, pair.b) for pair in pairs}
+        label = 'packed' if processes == 1 else f'packed x{processes}'
+        print(f"{label:<12} {elapsed:9.2f}s  {len(pairs)} flagged, {len(found & planted)}/{len(planted)} planted found")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""First-request latency with and without the template bytecode cache.
+
+Each scenario starts a fresh interpreter (standing in for a freshly forked
+worker), logs in and times the first request to each route, which is where
+template compilation lands:
+
+    no cache       templates compiled from source on first use
+    cold cache     bytecode cache enabled but empty (first worker after a deploy)
+    warm cache     cache filled by `flask precompile-templates`
+    warm-up        warm cache plus TEMPLATE_WARMUP loading everything at start
+
+    python benchmarks/template_benchmark.py --runs 5
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+USER_PATHS = ['/user/dashboard', '/user/quizzes', '/user/history', '/user/leaderboard']
+ADMIN_PATHS = ['/admin/dashboard', '/admin/subjects', '/admin/quizzes', '/admin/users', '/admin/analytics']
+
+
+def child():
+    """Runs in the fresh interpreter; prints per-route timings as JSON."""
+    import time
+    start = time.perf_counter()
+    from app import app
+    startup = time.perf_counter() - start
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    timings = {'startup': startup}
+    for username, password, paths in (('testuser', 'password123', USER_PATHS),
+                                      ('admin', 'admin123', ADMIN_PATHS)):
+        client = app.test_client()
+        client.post('/login', data={'username': username, 'password': password})
+        for path in paths:
+            start = time.perf_counter()
+            client.get(path)
+            timings[path] = time.perf_counter() - start
+    print(json.dumps(timings))
+
+
+def run_child(env):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per scenario')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child()
+
+    work_dir = tempfile.mkdtemp()
+    cache_dir = os.path.join(work_dir, 'jinja_cache')
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+               LEADERBOARD_SNAPSHOT_PATH=os.path.join(work_dir, 'leaderboard.json'),
+               PAPER_DIR=os.path.join(work_dir, 'papers'),
+               TEMPLATES_AUTO_RELOAD='false',
+               FLASK_APP='main.py')
+    subprocess.run([sys.executable, '-c', 'import init_db; init_db.init_database()'],
+                   cwd=ROOT, env=env, check=True, capture_output=True)
+
+    def no_cache():
+        return dict(env, TEMPLATE_CACHE_DIR='')
+
+    def cold_cache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return dict(env, TEMPLATE_CACHE_DIR=cache_dir)
+
+    def warm_cache():
+        subprocess.run([sys.executable, '-m', 'flask', 'precompile-templates', '--clear'], cwd=ROOT,
+                       env=dict(env, TEMPLATE_CACHE_DIR=cache_dir), check=True, capture_output=True)
+        return dict(env, TEMPLATE_CACHE_DIR=cache_dir)
+
+    def warm_up():
+        return dict(warm_cache(), TEMPLATE_WARMUP='true')
+
+    print(f"{'scenario':<12} {'startup':>9} {'first hit (mean)':>17} {'first hit (sum)':>16}")
+    for label, scenario in (('no cache', no_cache), ('cold cache', cold_cache),
+                            ('warm cache', warm_cache), ('warm-up', warm_up)):
+        runs = [run_child(scenario()) for _ in range(args.runs)]
+        startup = statistics.median(run.pop('startup') for run in runs)
+        totals = [sum(run.values()) for run in runs]
+        means = [statistics.mean(run.values()) for run in runs]
+        print(f"{label:<12} {startup * 1000:7.1f}ms {statistics.median(means) * 1000:15.1f}ms "
+              f"{statistics.median(totals) * 1000:14.1f}ms")
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+import time
+import logging
+import datetime
+import threading
+
+from flask import current_app
+from sqlalchemy import select, update, func
+
+from app import db
+from models import (User, Subject, Chapter, Quiz, QuizPool, Question, Score, UserAnswer, AnswerArchive, RescoreRun,
+                    SimilarityFlag, DeletionJob)
+
+
+class SubtreeDeleter:
+    """Delete subjects, chapters, quizzes and users with batched Core statements.
+
+    Going through the ORM cascade loads every dependent Score and UserAnswer
+    into the session and deletes them in one long transaction. Here the
+    dependent rows are removed bottom-up in chunks of ``chunk_size`` ids, one
+    short transaction each, with an optional pause between chunks so exam
+    traffic can get at the tables. Children always go before their parent,
+    so a deletion that is interrupted leaves a consistent (if partial) tree
+    and can simply be run again. Subtrees with more than
+    ``background_threshold`` attempts are deleted on a background thread
+    and tracked in a DeletionJob row, whose progress is written with each
+    chunk. A job whose worker died (recycled, redeployed) stops making
+    progress; ``resume`` picks such jobs and failed ones up again.
+    """
+
+    def __init__(self):
+        self.chunk_size = 1000
+        self.chunk_pause = 0
+        self.background_threshold = 5000
+        self.stale_after = 600
+        self.local = threading.local()
+
+    def init_app(self, app):
+        self.chunk_size = app.config.get('DELETE_CHUNK_SIZE', 1000)
+        self.chunk_pause = app.config.get('DELETE_CHUNK_PAUSE', 0)
+        self.background_threshold = app.config.get('DELETE_BACKGROUND_THRESHOLD', 5000)
+        self.stale_after = app.config.get('DELETE_JOB_STALE_SECONDS', 600)
+
+    # Chunked primitives
+
+    def _ids(self, column, condition):
+        return list(db.session.execute(select(column).where(condition)).scalars())
+
+    def _in_chunks(self, ids, delete_chunk):
+        for start in range(0, len(ids), self.chunk_size):
+            delete_chunk(ids[start:start + self.chunk_size])
+            db.session.commit()
+            if self.chunk_pause:
+                time.sleep(self.chunk_pause)
+
+    def _delete_scores(self, score_ids):
+        def delete_chunk(chunk):
+            db.session.execute(UserAnswer.__table__.delete().where(UserAnswer.score_id.in_(chunk)))
+            db.session.execute(AnswerArchive.__table__.delete().where(AnswerArchive.score_id.in_(chunk)))
+            db.session.execute(SimilarityFlag.__table__.delete().where(
+                SimilarityFlag.score_a_id.in_(chunk) | SimilarityFlag.score_b_id.in_(chunk)))
+            db.session.execute(Score.__table__.delete().where(Score.id.in_(chunk)))
+            job_id = getattr(self.local, 'job_id', None)
+            if job_id is not None:
+                # Same transaction as the chunk, so progress never runs ahead
+                db.session.execute(update(DeletionJob).where(DeletionJob.id == job_id).values(
+                    deleted_scores=DeletionJob.deleted_scores + len(chunk), updated_at=datetime.datetime.now()))
+        self._in_chunks(score_ids, delete_chunk)
+
+    def _delete_questions(self, question_ids):
+        def delete_chunk(chunk):
+            db.session.execute(UserAnswer.__table__.delete().where(UserAnswer.question_id.in_(chunk)))
+            db.session.execute(Question.__table__.delete().where(Question.id.in_(chunk)))
+        self._in_chunks(question_ids, delete_chunk)
+
+    def _finish(self, table, row_id, delete_stragglers):
+        # Rows added while the chunks were going are removed in the same
+        # transaction as the parent
+        delete_stragglers()
+        db.session.execute(table.delete().where(table.c.id == row_id))
+        db.session.commit()
+
+    # Subtrees
+
+    def delete_quiz(self, quiz_id):
+        self._delete_scores(self._ids(Score.id, Score.quiz_id == quiz_id))
+        self._delete_questions(self._ids(Question.id, Question.quiz_id == quiz_id))
+
+        def stragglers():
+            db.session.execute(UserAnswer.__table__.delete().where(UserAnswer.score_id.in_(
+                select(Score.id).where(Score.quiz_id == quiz_id))))
+            db.session.execute(AnswerArchive.__table__.delete().where(AnswerArchive.score_id.in_(
+                select(Score.id).where(Score.quiz_id == quiz_id))))
+            db.session.execute(Score.__table__.delete().where(Score.quiz_id == quiz_id))
+            db.session.execute(Question.__table__.delete().where(Question.quiz_id == quiz_id))
+            db.session.execute(QuizPool.__table__.delete().where(QuizPool.quiz_id == quiz_id))
+            db.session.execute(RescoreRun.__table__.delete().where(RescoreRun.quiz_id == quiz_id))
+            db.session.execute(SimilarityFlag.__table__.delete().where(SimilarityFlag.quiz_id == quiz_id))
+        self._finish(Quiz.__table__, quiz_id, stragglers)
+
+    def delete_chapter(self, chapter_id):
+        # Repeat in case a quiz was added while the others were being removed
+        while quiz_ids := self._ids(Quiz.id, Quiz.chapter_id == chapter_id):
+            for quiz_id in quiz_ids:
+                self.delete_quiz(quiz_id)
+        self._finish(Chapter.__table__, chapter_id, lambda: None)
+
+    def delete_subject(self, subject_id):
+        while chapter_ids := self._ids(Chapter.id, Chapter.subject_id == subject_id):
+            for chapter_id in chapter_ids:
+                self.delete_chapter(chapter_id)
+        self._finish(Subject.__table__, subject_id, lambda: None)
+
+    def delete_user(self, user_id):
+        self._delete_scores(self._ids(Score.id, Score.user_id == user_id))
+
+        def stragglers():
+            self._delete_scores(self._ids(Score.id, Score.user_id == user_id))
+        self._finish(User.__table__, user_id, stragglers)
+
+    # Scheduling
+
+    def _attempt_condition(self, kind, row_id):
+        if kind == 'quiz':
+            return Score.quiz_id == row_id
+        if kind == 'chapter':
+            return Score.quiz_id.in_(select(Quiz.id).where(Quiz.chapter_id == row_id))
+        if kind == 'subject':
+            return Score.quiz_id.in_(select(Quiz.id).join(Chapter, Quiz.chapter_id == Chapter.id)
+                                     .where(Chapter.subject_id == row_id))
+        if kind == 'user':
+            return Score.user_id == row_id
+        raise ValueError(f'Unknown subtree kind {kind!r}')
+
+    def run(self, job_id):
+        """Carry out (or finish) a DeletionJob; returns True if it completed."""
+        job = db.session.get(DeletionJob, job_id)
+        delete = getattr(self, f'delete_{job.kind}')
+        started = time.monotonic()
+        self.local.job_id = job_id
+        try:
+            delete(job.row_id)
+        except Exception as e:
+            db.session.rollback()
+            logging.exception("Deletion job %s (%s %s) failed", job_id, job.kind, job.row_id)
+            job = db.session.get(DeletionJob, job_id)
+            job.status, job.error = 'failed', str(e)
+            job.finished_at = job.updated_at = datetime.datetime.now()
+            db.session.commit()
+            return False
+        finally:
+            self.local.job_id = None
+        job = db.session.get(DeletionJob, job_id)
+        job.status = 'done'
+        job.finished_at = job.updated_at = datetime.datetime.now()
+        db.session.commit()
+        logging.info("Deletion job %s (%s %s) finished in %.1fs", job_id, job.kind, job.row_id,
+                     time.monotonic() - started)
+        return True
+
+    def schedule(self, kind, row_id, on_done=None):
+        """Delete a subject, chapter, quiz or user and everything under it.
+
+        Runs inline unless the subtree has more than ``background_threshold``
+        attempts, in which case a DeletionJob is recorded and run on a
+        background thread, and ``on_done`` is called from there. Returns True
+        if backgrounded.
+        """
+        delete = getattr(self, f'delete_{kind}')
+        attempts = db.session.execute(
+            select(func.count(Score.id)).where(self._attempt_condition(kind, row_id))).scalar()
+        if attempts <= self.background_threshold:
+            delete(row_id)
+            if on_done:
+                on_done()
+            return False
+
+        job = DeletionJob(kind=kind, row_id=row_id, total_scores=attempts)
+        db.session.add(job)
+        db.session.commit()
+        job_id = job.id
+        app = current_app._get_current_object()
+
+        def work():
+            with app.app_context():
+                if self.run(job_id) and on_done:
+                    on_done()
+
+        threading.Thread(target=work, name=f'{delete.__name__}-{row_id}', daemon=True).start()
+        return True
+
+    def resume(self, progress=None):
+        """Run the jobs that failed or stopped progressing for ``stale_after`` seconds.
+
+        Each job is claimed with a conditional UPDATE first, so two resumers
+        never run the same one. Returns the ids of the jobs completed.
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.stale_after)
+        candidates = db.session.execute(
+            select(DeletionJob.id, DeletionJob.status, DeletionJob.updated_at)
+            .where((DeletionJob.status == 'failed')
+                   | ((DeletionJob.status == 'running') & (DeletionJob.updated_at < cutoff)))
+            .order_by(DeletionJob.id)).all()
+        completed = []
+        for job_id, status, updated_at in candidates:
+            claimed = db.session.execute(
+                update(DeletionJob)
+                .where(DeletionJob.id == job_id, DeletionJob.status == status, DeletionJob.updated_at == updated_at)
+                .values(status='running', error=None, updated_at=datetime.datetime.now())).rowcount
+            db.session.commit()
+            if not claimed:
+                continue
+            if progress:
+                progress(db.session.get(DeletionJob, job_id))
+            if self.run(job_id):
+                completed.append(job_id)
+        return completed
+
+    def jobs(self, limit=20):
+        return DeletionJob.query.order_by(DeletionJob.id.desc()).limit(limit).all()
+
+
+deleter = SubtreeDeleter()
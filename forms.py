@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, TextAreaField, SelectField, IntegerField, DateField, RadioField, SubmitField
-from wtforms.validators import DataRequired, Length, EqualTo, Email, ValidationError, Optional
+from wtforms.validators import DataRequired, Length, EqualTo, Email, ValidationError, Optional, NumberRange
 from datetime import date
 from models import User
 
@@ -45,6 +45,8 @@ class QuizForm(FlaskForm):
     description = TextAreaField('Description')
     date = DateField('Quiz Date', validators=[DataRequired()], format='%Y-%m-%d')
     duration = IntegerField('Duration (minutes)', validators=[DataRequired()])
+    pool_size = IntegerField('Questions per Student', validators=[Optional(), NumberRange(min=1)])
+    shuffle_options = BooleanField('Shuffle Option Order')
     submit = SubmitField('Submit')
 
 class QuestionForm(FlaskForm):
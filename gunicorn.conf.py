@@ -0,0 +1,37 @@
+# Gunicorn configuration, picked up automatically by `gunicorn main:app`.
+#
+# Requests spend most of their time waiting on database round trips, so the
+# default is the threaded worker: each process serves GUNICORN_THREADS
+# requests concurrently and the SQLAlchemy pool is sized to match. Set
+# GUNICORN_WORKER_CLASS=sync to get one request per process.
+import os
+import multiprocessing
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 8)) if worker_class == "gthread" else 1
+
+# Allow brief bursts (e.g. an exam opening) to queue in the kernel
+backlog = int(os.environ.get("GUNICORN_BACKLOG", 2048))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+
+# Recycle workers periodically so slow leaks cannot build up
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 5000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 500))
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+
+# One database connection per request thread, plus a little headroom
+os.environ.setdefault("DB_POOL_SIZE", str(threads))
+os.environ.setdefault("DB_MAX_OVERFLOW", str(max(2, threads // 4)))
+
+
+def post_fork(server, worker):
+    # Connections opened in the master while preloading must not be shared
+    if preload_app:
+        from app import app, db
+        with app.app_context():
+            db.engine.dispose(close=False)
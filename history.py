@@ -0,0 +1,105 @@
+from collections import namedtuple
+
+from sqlalchemy import func, case, extract
+
+from app import db
+from models import Score, Quiz, Chapter, Subject
+from invalidation import LocalCache
+from replicas import use_primary
+
+HistoryRow = namedtuple('HistoryRow', ['score_id', 'timestamp', 'quiz_title', 'subject_name',
+                                       'chapter_name', 'total_score'])
+
+# Same bands the history charts have always used
+SCORE_BANDS = [('Excellent (90-100%)', 90), ('Good (70-89%)', 70), ('Average (50-69%)', 50),
+               ('Below Average (0-49%)', 0)]
+
+# Summaries per user and window, checked against the user's data versions on every read
+summary_cache = LocalCache(maxsize=1024)
+
+
+def _joined(query):
+    return query.join(Quiz, Score.quiz_id == Quiz.id)\
+        .join(Chapter, Quiz.chapter_id == Chapter.id)\
+        .join(Subject, Chapter.subject_id == Subject.id)
+
+
+def _attempts(user_id, since):
+    # A lower bound on the partition key lets a partitioned scores table
+    # skip the months before ``since``
+    condition = Score.user_id == user_id
+    if since is not None:
+        condition &= Score.timestamp >= since
+    return condition
+
+
+def history_page(user_id, page=1, per_page=20, since=None):
+    """One page of a user's attempts from ``since`` on, newest first; returns ``(rows, total)``."""
+    mine = _attempts(user_id, since)
+    total = db.session.query(func.count(Score.id)).filter(mine).scalar()
+    rows = _joined(db.session.query(Score.id, Score.timestamp, Quiz.title, Subject.name, Chapter.name,
+                                    Score.total_score))\
+        .filter(mine)\
+        .order_by(Score.timestamp.desc(), Score.id.desc())\
+        .limit(per_page)\
+        .offset((page - 1) * per_page)\
+        .all()
+    return [HistoryRow(*row) for row in rows], total
+
+
+def rows_to_json(rows, columnar=False):
+    """Rows as a list of objects, or as one array per column when ``columnar``."""
+    if columnar:
+        return {
+            'id': [row.score_id for row in rows],
+            'ts': [int(row.timestamp.timestamp()) if row.timestamp else None for row in rows],
+            'quiz': [row.quiz_title for row in rows],
+            'subject': [row.subject_name for row in rows],
+            'chapter': [row.chapter_name for row in rows],
+            'score': [round(row.total_score, 1) for row in rows],
+        }
+    return [{'id': row.score_id,
+             'ts': int(row.timestamp.timestamp()) if row.timestamp else None,
+             'quiz': row.quiz_title,
+             'subject': row.subject_name,
+             'chapter': row.chapter_name,
+             'score': round(row.total_score, 1)} for row in rows]
+
+
+def _summarize(user_id, since):
+    mine = _attempts(user_id, since)
+
+    band = case(*[(Score.total_score >= lower, label) for label, lower in SCORE_BANDS[:-1]],
+                else_=SCORE_BANDS[-1][0])
+    bands = dict(db.session.query(band, func.count(Score.id)).filter(mine).group_by(band).all())
+
+    subjects = _joined(db.session.query(Subject.name, func.avg(Score.total_score), func.count(Score.id)))\
+        .filter(mine)\
+        .group_by(Subject.id, Subject.name)\
+        .order_by(Subject.name)\
+        .all()
+
+    year, month = extract('year', Score.timestamp), extract('month', Score.timestamp)
+    trend = db.session.query(year, month, func.avg(Score.total_score), func.count(Score.id))\
+        .filter(mine)\
+        .group_by(year, month)\
+        .order_by(year, month)\
+        .all()
+
+    return {
+        'count': sum(count for _, _, count in subjects),
+        'distribution': [{'band': label, 'attempts': bands.get(label, 0)} for label, _ in SCORE_BANDS],
+        'subjects': [{'name': name, 'average': round(average, 1), 'attempts': count}
+                     for name, average, count in subjects],
+        'trend': [{'bucket': f'{int(y):04d}-{int(m):02d}', 'average': round(average, 1), 'attempts': count}
+                  for y, m, average, count in trend],
+    }
+
+
+def history_summary(user_id, since=None):
+    """Totals, score bands, per-subject averages and monthly trend for a user's attempts from ``since`` on."""
+    # Versions and summary both come from the primary: a lagging replica
+    # would pair an old summary with versions that look current
+    with use_primary():
+        return summary_cache.get((user_id, since), lambda: _summarize(user_id, since),
+                                 depends_on=('catalog', 'scores:bulk', f'user:{user_id}'))
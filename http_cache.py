@@ -0,0 +1,235 @@
+import os
+import gzip
+import time
+import hashlib
+from functools import wraps
+
+from flask import request, session, make_response, current_app, g, has_request_context
+from flask_login import current_user
+from sqlalchemy import event, select, update, insert, func, inspect
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import User, Subject, Chapter, Quiz, QuizPool, Question, Score, DataVersion
+
+# Tables touched by bulk (Core) statements map to these version keys
+_BULK_KEYS = {
+    'users': 'users',
+    'subjects': 'catalog',
+    'chapters': 'catalog',
+    'quizzes': 'catalog',
+    'quiz_pools': 'catalog',
+    'questions': 'questions:bulk',
+    'scores': 'scores:bulk',
+}
+
+# Moving a quiz to another chapter, or a chapter to another subject, also
+# bumps 'catalog:structure', which score aggregates by subject depend on
+_PARENT_COLUMNS = {Quiz: 'chapter_id', Chapter: 'subject_id'}
+
+COMPRESSIBLE = {'text/html', 'text/css', 'text/plain', 'application/json', 'application/javascript'}
+
+
+def _moved(obj):
+    column = _PARENT_COLUMNS.get(type(obj))
+    return column is not None and inspect(obj).attrs[column].history.has_changes()
+
+
+def _object_keys(obj):
+    if isinstance(obj, User):
+        return ('users',)
+    if isinstance(obj, (Subject, Chapter, Quiz, QuizPool)):
+        return ('catalog',)
+    if isinstance(obj, Question):
+        return (f'quiz:{obj.quiz_id}',)
+    if isinstance(obj, Score):
+        # Per user, so concurrent submits never contend on one row
+        return (f'user:{obj.user_id}',)
+    return ()
+
+
+class DataVersions:
+    """Version counters bumped by the transactions that change the data.
+
+    Pages derive their ETags from the counters of the data they show, so a
+    conditional GET can be answered with a cheap primary-key lookup instead
+    of running the view and hashing the rendered body. Counters are keyed by
+    scope ('catalog', 'users', 'quiz:<id>', 'user:<id>', ...) and bumped in
+    the same transaction as the change: ORM objects are classified after
+    each flush and bulk statements by their target table. Callbacks added
+    with ``on_commit`` receive the new versions once the transaction commits.
+    Within a request, versions read are remembered until the next commit, so
+    the ETag check and the caches validated against the same keys share one
+    lookup per bind.
+    """
+
+    def __init__(self):
+        self.commit_callbacks = []
+
+    def on_commit(self, callback):
+        self.commit_callbacks.append(callback)
+
+    def init_app(self, app):
+        event.listen(db.session, 'after_flush', self._after_flush)
+        event.listen(db.session, 'do_orm_execute', self._do_orm_execute)
+        event.listen(db.session, 'before_commit', self._before_commit)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_rollback', self._reset)
+
+    def _pending(self, session):
+        return session.info.setdefault('data_version_keys', set())
+
+    def _after_flush(self, session, flush_context):
+        pending = self._pending(session)
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            pending.update(_object_keys(obj))
+        if any(_moved(obj) for obj in session.dirty):
+            pending.add('catalog:structure')
+
+    def _do_orm_execute(self, state):
+        if state.is_insert or state.is_update or state.is_delete:
+            table = getattr(state.statement, 'table', None)
+            name = getattr(table, 'name', None)
+            key = _BULK_KEYS.get(name)
+            if key:
+                self._pending(state.session).add(key)
+            if state.is_update and name in ('quizzes', 'chapters'):
+                self._pending(state.session).add('catalog:structure')
+
+    def touch(self, session, *keys):
+        """Bump ``keys`` when the session commits; for changes the ORM cannot see (DDL, raw SQL)."""
+        self._pending(session).update(keys)
+
+    def _before_commit(self, session):
+        session.flush()
+        keys = session.info.pop('data_version_keys', None)
+        if keys:
+            session.info['data_versions_bumped'] = self.bump(session, keys)
+
+    def _after_commit(self, session):
+        if has_request_context():
+            g.pop('data_versions', None)
+        bumped = session.info.pop('data_versions_bumped', None)
+        if bumped:
+            for callback in self.commit_callbacks:
+                callback(bumped)
+
+    def _reset(self, session):
+        session.info.pop('data_version_keys', None)
+        session.info.pop('data_versions_bumped', None)
+
+    def bump(self, session, keys):
+        """Increment the counters for ``keys``; returns ``{key: new_version}``."""
+        keys = sorted(keys)
+        session.execute(update(DataVersion).where(DataVersion.name.in_(keys))
+                        .values(version=DataVersion.version + 1))
+        existing = set(session.execute(select(DataVersion.name).where(DataVersion.name.in_(keys))).scalars())
+        for key in keys:
+            if key in existing:
+                continue
+            try:
+                with session.begin_nested():
+                    session.execute(insert(DataVersion).values(name=key, version=1))
+            except IntegrityError:
+                # Another transaction created it first
+                session.execute(update(DataVersion).where(DataVersion.name == key)
+                                .values(version=DataVersion.version + 1))
+        return dict(session.execute(
+            select(DataVersion.name, DataVersion.version).where(DataVersion.name.in_(keys))).all())
+
+    def get(self, *keys):
+        seen = {}
+        if has_request_context():
+            # Kept apart per bind: a replica may still be behind the primary
+            seen = g.setdefault('data_versions', {}).setdefault(g.get('db_read_replica', False), {})
+        missing = [key for key in keys if key not in seen]
+        if missing:
+            rows = dict(db.session.execute(
+                select(DataVersion.name, DataVersion.version).where(DataVersion.name.in_(missing))).all())
+            seen.update((key, rows.get(key, 0)) for key in missing)
+        return tuple(seen[key] for key in keys)
+
+
+data_versions = DataVersions()
+
+
+def latest_score_id():
+    # Scores are append-only outside bulk statements, so the newest id
+    # versions them without a counter every submit would contend on
+    return db.session.execute(select(func.max(Score.id))).scalar() or 0
+
+
+def conditional(version_parts):
+    """Answer If-None-Match with 304 before running the view.
+
+    ``version_parts`` receives the view's arguments and returns the data
+    versions the page depends on. The weak ETag also covers the user, the
+    release and a CSRF-token age bucket.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            # Tokens expire after WTF_CSRF_TIME_LIMIT; a page revalidated
+            # within half of that still carries a usable one
+            lifetime = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+            bucket = int(time.time() // (lifetime / 2))
+            key = repr((http_cache.release, current_user.get_id(), bucket,
+                        request.full_path, version_parts(*args, **kwargs)))
+            etag = hashlib.sha1(key.encode()).hexdigest()
+
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            # Always revalidate; the page is per-user
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+class HttpCache:
+    """gzip for dynamic responses above a size threshold."""
+
+    def __init__(self):
+        self.min_size = 1024
+        self.level = 6
+        self.release = ''
+
+    def init_app(self, app):
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', 1024)
+        self.level = app.config.get('COMPRESS_LEVEL', 6)
+        self.release = self._release_id(app)
+        app.after_request(self.compress)
+
+    def _release_id(self, app):
+        # Changes whenever templates or assets are redeployed
+        from assets import assets
+        template_dir = os.path.join(app.root_path, app.template_folder)
+        newest = max((os.path.getmtime(os.path.join(root, name))
+                      for root, _, names in os.walk(template_dir) for name in names), default=0)
+        return f'{newest}:{assets.version}'
+
+    def compress(self, response):
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE
+                or 'gzip' not in request.accept_encodings):
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        response.set_data(gzip.compress(data, self.level))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+http_cache = HttpCache()
@@ -8,11 +8,15 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from app import app, db
 from models import User, Subject, Chapter, Quiz, Question
+from leaderboard import leaderboards
+from papers import papers
 
 def init_database():
     with app.app_context():
         # Drop all tables
         db.drop_all()
+        leaderboards.discard_snapshot()
+        papers.discard_all()
         
         # Create all tables
         db.create_all()
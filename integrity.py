@@ -0,0 +1,224 @@
+import os
+import time
+import logging
+import datetime
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import select
+
+from app import db, from_json_filter
+from models import Score, Question, SimilarityFlag
+from rescoring import answers_by_score
+
+# Thresholds a pair of attempts has to meet to be flagged
+Criteria = namedtuple('Criteria', ['threshold', 'wrong_weight', 'min_shared_wrong', 'min_common'])
+
+# One flagged pair; ``a`` and ``b`` index the packed attempts, a < b
+Pair = namedtuple('Pair', ['a', 'b', 'common', 'matches', 'shared_wrong', 'similarity'])
+
+
+class PackedAttempts:
+    """A quiz's attempts as bitsets, one Python int per attempt and kind.
+
+    Question ``q`` owns bits ``q * width`` to ``q * width + width - 1`` of
+    ``chosen``, one per option, and the chosen option's bit is set. ``wrong``
+    keeps only the bits of wrong choices and ``answered`` has bit ``q`` set
+    for every answered question. Comparing two attempts over all questions
+    is then an AND and a popcount, done a machine word at a time.
+    """
+
+    def __init__(self, key, width):
+        self.key = key  # question id -> (bit index, correct option)
+        self.width = width
+        self.score_ids = []
+        self.chosen = []
+        self.wrong = []
+        self.answered = []
+
+    @classmethod
+    def for_questions(cls, questions):
+        """``questions`` are ``(question id, correct option, option count)`` tuples."""
+        questions = list(questions)
+        width = max((options for _, _, options in questions), default=1) or 1
+        key = {question_id: (index, correct) for index, (question_id, correct, _) in enumerate(questions)}
+        return cls(key, width)
+
+    def add(self, score_id, answers):
+        """Pack one attempt's ``(question_id, user_answer)`` pairs; unknown questions
+        and answers that are not an option index are skipped."""
+        chosen = wrong = answered = 0
+        for question_id, user_answer in answers:
+            entry = self.key.get(question_id)
+            if entry is None or not user_answer or not user_answer.isdigit() or int(user_answer) >= self.width:
+                continue
+            index, correct = entry
+            option = int(user_answer)
+            bit = 1 << (index * self.width + option)
+            chosen |= bit
+            answered |= 1 << index
+            if option != correct:
+                wrong |= bit
+        self.score_ids.append(score_id)
+        self.chosen.append(chosen)
+        self.wrong.append(wrong)
+        self.answered.append(answered)
+
+    def __len__(self):
+        return len(self.score_ids)
+
+    def candidates(self, min_shared_wrong):
+        """Indexes of the attempts with enough wrong answers to ever be flagged."""
+        return [i for i, wrong in enumerate(self.wrong) if wrong.bit_count() >= min_shared_wrong]
+
+
+# Set in every pool process by _init_worker, so blocks are sent as four ints
+_attempts = None
+_criteria = None
+
+
+def _init_worker(attempts, criteria):
+    global _attempts, _criteria
+    _attempts, _criteria = attempts, criteria
+
+
+def _compare_block(block):
+    """Flagged pairs among rows ``[i0, i1)`` x columns ``[j0, j1)`` (upper triangle only)."""
+    i0, i1, j0, j1 = block
+    chosen, wrong, answered, wrong_counts = _attempts
+    threshold, wrong_weight, min_shared_wrong, min_common = _criteria
+    extra = wrong_weight - 1
+    flagged = []
+    for i in range(i0, i1):
+        chosen_i, wrong_i, answered_i, wrong_count_i = chosen[i], wrong[i], answered[i], wrong_counts[i]
+        for j in range(max(j0, i + 1), j1):
+            # Cheapest and most selective test first
+            shared_wrong = (wrong_i & wrong[j]).bit_count()
+            if shared_wrong < min_shared_wrong:
+                continue
+            common = (answered_i & answered[j]).bit_count()
+            if common < min_common:
+                continue
+            matches = (chosen_i & chosen[j]).bit_count()
+            # Agreement with shared wrong answers counted wrong_weight times,
+            # out of the most the pair could reach
+            similarity = (matches + extra * shared_wrong) / (common + extra * max(wrong_count_i, wrong_counts[j]))
+            if similarity >= threshold:
+                flagged.append(Pair(i, j, common, matches, shared_wrong, similarity))
+    return flagged
+
+
+def _blocks(n, size):
+    starts = range(0, n, size)
+    return [(i, min(i + size, n), j, min(j + size, n)) for i in starts for j in starts if j >= i]
+
+
+def find_similar(attempts, criteria, processes=1, block_size=512):
+    """Compare every pair of ``attempts`` (PackedAttempts); returns the flagged Pairs.
+
+    Attempts with fewer than ``min_shared_wrong`` wrong answers are dropped
+    first: they cannot be flagged, and they are usually most of a cohort.
+    The rest are compared in square blocks of ``block_size`` attempts,
+    spread over ``processes`` worker processes.
+    """
+    keep = attempts.candidates(criteria.min_shared_wrong)
+    packed = ([attempts.chosen[i] for i in keep], [attempts.wrong[i] for i in keep],
+              [attempts.answered[i] for i in keep], [attempts.wrong[i].bit_count() for i in keep])
+    blocks = _blocks(len(keep), block_size)
+    if processes <= 1 or len(blocks) <= 1:
+        _init_worker(packed, criteria)
+        results = map(_compare_block, blocks)
+    else:
+        context = None
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        executor = ProcessPoolExecutor(max_workers=min(processes, len(blocks)), mp_context=context,
+                                       initializer=_init_worker, initargs=(packed, criteria))
+        with executor:
+            results = list(executor.map(_compare_block, blocks))
+    return [pair._replace(a=keep[pair.a], b=keep[pair.b]) for block in results for pair in block]
+
+
+class SimilarityChecker:
+    """Offline check for suspiciously similar attempts at the same quiz.
+
+    Every attempt's answers (archived ones included) are packed into
+    bitsets (PackedAttempts) and all pairs are compared with find_similar.
+    Matching correct answers are expected from good students, so a pair is
+    only flagged when it also shares at least ``min_shared_wrong`` identical
+    wrong answers, and those count ``wrong_weight`` times in its similarity.
+    Flagged pairs go to the similarity_flags table for review. A rerun
+    updates the numbers of pairs already flagged, keeps their review
+    status, and removes open flags that no longer meet the criteria.
+    """
+
+    def __init__(self):
+        self.criteria = Criteria(0.8, 3, 4, 10)
+        self.processes = None
+        self.block_size = 512
+        self.load_chunk_size = 1000
+
+    def init_app(self, app):
+        self.criteria = Criteria(app.config.get('SIMILARITY_THRESHOLD', 0.8),
+                                 app.config.get('SIMILARITY_WRONG_WEIGHT', 3),
+                                 app.config.get('SIMILARITY_MIN_SHARED_WRONG', 4),
+                                 app.config.get('SIMILARITY_MIN_COMMON', 10))
+        self.processes = app.config.get('SIMILARITY_PROCESSES') or os.cpu_count()
+        self.block_size = app.config.get('SIMILARITY_BLOCK_SIZE', 512)
+
+    def pack(self, quiz_id):
+        questions = db.session.execute(
+            select(Question.id, Question.correct_answer, Question.options)
+            .where(Question.quiz_id == quiz_id).order_by(Question.id)).all()
+        attempts = PackedAttempts.for_questions(
+            (question_id, correct, len(from_json_filter(options))) for question_id, correct, options in questions)
+        score_ids = list(db.session.execute(
+            select(Score.id).where(Score.quiz_id == quiz_id).order_by(Score.id)).scalars())
+        for start in range(0, len(score_ids), self.load_chunk_size):
+            chunk = score_ids[start:start + self.load_chunk_size]
+            answers = answers_by_score(chunk)
+            for score_id in chunk:
+                attempts.add(score_id, answers.get(score_id, ()))
+        return attempts
+
+    def _save(self, quiz_id, attempts, pairs):
+        existing = {(flag.score_a_id, flag.score_b_id): flag
+                    for flag in SimilarityFlag.query.filter_by(quiz_id=quiz_id)}
+        for pair in pairs:
+            ids = (attempts.score_ids[pair.a], attempts.score_ids[pair.b])
+            flag = existing.pop(ids, None)
+            if flag is None:
+                flag = SimilarityFlag(quiz_id=quiz_id, score_a_id=ids[0], score_b_id=ids[1])
+                db.session.add(flag)
+            flag.common_questions = pair.common
+            flag.matching_answers = pair.matches
+            flag.shared_wrong = pair.shared_wrong
+            flag.similarity = pair.similarity
+        for flag in existing.values():
+            if flag.status == 'open':
+                db.session.delete(flag)
+        db.session.commit()
+
+    def check(self, quiz_id, criteria=None, processes=None):
+        """Check one quiz; returns ``(attempts, pairs flagged)``."""
+        started = time.monotonic()
+        attempts = self.pack(quiz_id)
+        packed = time.monotonic()
+        pairs = find_similar(attempts, criteria or self.criteria, processes or self.processes, self.block_size)
+        compared = time.monotonic()
+        self._save(quiz_id, attempts, pairs)
+        logging.info("Similarity check of quiz %s: %d attempts, %d pairs flagged "
+                     "(load %.1fs, compare %.1fs, save %.1fs)", quiz_id, len(attempts), len(pairs),
+                     packed - started, compared - packed, time.monotonic() - compared)
+        return len(attempts), len(pairs)
+
+    def review(self, flag, status):
+        if status not in ('open', 'cleared', 'confirmed'):
+            raise ValueError(f'Unknown review status {status!r}')
+        flag.status = status
+        flag.reviewed_at = None if status == 'open' else datetime.datetime.now()
+        db.session.commit()
+
+
+similarity_checker = SimilarityChecker()
@@ -0,0 +1,457 @@
+import os
+import json
+import time
+import queue
+import random
+import socket
+import sqlite3
+import logging
+import threading
+import socketserver
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+# Subscribing to ALL receives every event. RESYNC is delivered to every
+# subscriber when events may have been missed
+ALL = '*'
+RESYNC = '*'
+
+
+def topic_of(key):
+    """'quiz:12' -> 'quiz', 'catalog' -> 'catalog'."""
+    return key.partition(':')[0]
+
+
+# Transports
+
+class LocalTransport:
+    """No cross-process delivery; for a single worker or the CLI."""
+
+    def publish(self, origin, events):
+        pass
+
+    def listen(self, deliver, stopped):
+        stopped.wait()
+
+
+class SqliteTransport:
+    """Events appended to a shared SQLite file that every worker polls.
+
+    Covers the workers of one machine. Rows older than ``retention`` seconds
+    are pruned now and then by the publishers.
+    """
+
+    def __init__(self, path, interval=0.25, retention=3600):
+        self.path = path
+        self.interval = interval
+        self.retention = retention
+        self.local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'origin TEXT, key TEXT, version INTEGER, created REAL)')
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _conn(self):
+        # One connection per thread and process
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = self.local.conn = self._connect()
+            self.local.pid = os.getpid()
+        return conn
+
+    def publish(self, origin, events):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.executemany('INSERT INTO events (origin, key, version, created) VALUES (?, ?, ?, ?)',
+                             [(origin, key, version, now) for key, version in events.items()])
+            if random.random() < 0.01:
+                conn.execute('DELETE FROM events WHERE created < ?', (now - self.retention,))
+
+    def listen(self, deliver, stopped):
+        conn = self._connect()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+        while not stopped.wait(self.interval):
+            try:
+                rows = conn.execute('SELECT id, origin, key, version FROM events WHERE id > ? ORDER BY id',
+                                    (last_id,)).fetchall()
+            except sqlite3.Error as e:
+                logging.warning("Invalidation bus poll failed: %s", e)
+                continue
+            for last_id, origin, key, version in rows:
+                deliver(origin, {key: version})
+
+
+def _command(*args):
+    parts = [f'*{len(args)}\r\n'.encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+    return b''.join(parts)
+
+
+def _read_reply(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError('connection closed')
+    kind, value = line[:1], line[1:-2]
+    if kind == b'+':
+        return value.decode()
+    if kind == b'-':
+        raise ConnectionError(value.decode())
+    if kind == b':':
+        return int(value)
+    if kind == b'$':
+        length = int(value)
+        return None if length < 0 else stream.read(length + 2)[:-2]
+    if kind == b'*':
+        length = int(value)
+        return None if length < 0 else [_read_reply(stream) for _ in range(length)]
+    raise ConnectionError(f'unexpected reply {line!r}')
+
+
+def _open_resp(address):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+class RespTransport:
+    """PUBLISH/SUBSCRIBE over the Redis protocol.
+
+    Works against Redis itself or the stand-in from ``flask bus-broker``.
+    Events published while the subscriber was disconnected are lost, so a
+    reconnect delivers a resync that tells subscribers to drop everything.
+    """
+
+    def __init__(self, address, channel='quiz-invalidation'):
+        self.address = address
+        self.channel = channel
+        self.local = threading.local()
+
+    def publish(self, origin, events):
+        payload = json.dumps({'origin': origin, 'events': events})
+        for attempt in range(2):
+            try:
+                sock, stream = self._connection()
+                sock.sendall(_command('PUBLISH', self.channel, payload))
+                _read_reply(stream)
+                return
+            except OSError:
+                self.local.conn = None
+                if attempt:
+                    raise
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            sock = _open_resp(self.address)
+            conn = self.local.conn = (sock, sock.makefile('rb'))
+            self.local.pid = os.getpid()
+        return conn
+
+    def listen(self, deliver, stopped):
+        backoff = 0.5
+        while not stopped.is_set():
+            try:
+                sock = _open_resp(self.address)
+                with sock, sock.makefile('rb') as stream:
+                    sock.sendall(_command('SUBSCRIBE', self.channel))
+                    _read_reply(stream)
+                    deliver(None, {RESYNC: 0})
+                    backoff = 0.5
+                    while not stopped.is_set():
+                        reply = _read_reply(stream)
+                        if reply and reply[0] == b'message':
+                            message = json.loads(reply[2])
+                            deliver(message['origin'], message['events'])
+            except OSError as e:
+                logging.warning("Invalidation bus disconnected (%s); retrying in %.1fs", e, backoff)
+                stopped.wait(backoff)
+                backoff = min(backoff * 2, 30)
+
+
+def make_transport(url):
+    """``sqlite:///path``, ``redis://host:port/channel`` or ``redis+unix:///path``; empty for local."""
+    if not url:
+        return LocalTransport()
+    parts = urlsplit(url)
+    if parts.scheme == 'sqlite':
+        return SqliteTransport(parts.path)
+    if parts.scheme == 'redis':
+        return RespTransport((parts.hostname or 'localhost', parts.port or 6379),
+                             parts.path.strip('/') or 'quiz-invalidation')
+    if parts.scheme == 'redis+unix':
+        return RespTransport(parts.path)
+    raise ValueError(f'Unsupported invalidation bus URL {url!r}')
+
+
+# Bus
+
+class InvalidationBus:
+    """Fans committed data-version bumps out to every worker.
+
+    Each commit that bumps data versions (see ``http_cache.DataVersions``)
+    publishes the new ``{key: version}`` pairs. Every worker runs one
+    listener thread, started with its first request, and passes the events
+    to the callbacks subscribed to the key's topic ('catalog', 'quiz',
+    'user', ...). The publishing worker handles its own events at once;
+    the transport write happens on a publisher thread, so commits never wait
+    on it. Callbacks run on the listener thread. Delivery is best effort:
+    caches that must not serve stale data also check the data versions on
+    read (see LocalCache).
+    """
+
+    def __init__(self):
+        self.transport = LocalTransport()
+        self.subscribers = {}
+        self.origin = None
+        self.listener = None
+        self.publisher = None
+        self.outbox = queue.Queue(maxsize=10000)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        from http_cache import data_versions
+        self.transport = make_transport(app.config.get('INVALIDATION_BUS_URL'))
+        data_versions.on_commit(self.publish)
+        app.before_request(self._ensure_listening)
+
+    def subscribe(self, topic, callback):
+        """Call ``callback(key, version)`` for events on ``topic`` (or ALL)."""
+        self.subscribers.setdefault(topic, []).append(callback)
+
+    def _ensure_listening(self):
+        # Started lazily so each forked worker gets its own thread
+        if isinstance(self.transport, LocalTransport):
+            return
+        if self.origin is not None and self.origin.startswith(f'{os.getpid()}@'):
+            return
+        with self.lock:
+            if self.origin is None or not self.origin.startswith(f'{os.getpid()}@'):
+                self.origin = f'{os.getpid()}@{socket.gethostname()}:{random.getrandbits(32):08x}'
+                self.stopped = threading.Event()
+                self.listener = threading.Thread(target=self._listen, name='invalidation-bus', daemon=True)
+                self.listener.start()
+                self.outbox = queue.Queue(maxsize=10000)
+                self.publisher = threading.Thread(target=self._publish_loop, name='invalidation-publisher',
+                                                  daemon=True)
+                self.publisher.start()
+
+    def _listen(self):
+        try:
+            self.transport.listen(self._deliver, self.stopped)
+        except Exception:
+            logging.exception("Invalidation bus listener stopped")
+
+    def _deliver(self, origin, events):
+        if origin is not None and origin == self.origin:
+            return
+        self.dispatch(events)
+
+    def dispatch(self, events):
+        for key, version in events.items():
+            if key == RESYNC:
+                callbacks = [callback for topic in self.subscribers.values() for callback in topic]
+            else:
+                callbacks = self.subscribers.get(topic_of(key), []) + self.subscribers.get(ALL, [])
+            for callback in callbacks:
+                try:
+                    callback(key, version)
+                except Exception:
+                    logging.exception("Invalidation callback for %s failed", key)
+
+    def publish(self, events):
+        self.dispatch(events)
+        if isinstance(self.transport, LocalTransport):
+            return
+        if self.publisher is None or not self.publisher.is_alive():
+            # CLI commands and workers that have not served a request yet
+            self._send(events)
+            return
+        try:
+            self.outbox.put_nowait(events)
+        except queue.Full:
+            # Other workers still see the new versions when they validate on read
+            logging.warning("Invalidation outbox full; dropped %s", ', '.join(events))
+
+    def _publish_loop(self):
+        while not self.stopped.is_set():
+            try:
+                events = self.outbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            # Send whatever queued up meanwhile in one message
+            while True:
+                try:
+                    events = {**events, **self.outbox.get_nowait()}
+                except queue.Empty:
+                    break
+            self._send(events)
+
+    def _send(self, events):
+        try:
+            self.transport.publish(self.origin, events)
+        except Exception:
+            logging.exception("Could not publish invalidation of %s", ', '.join(events))
+
+    def stop(self):
+        self.stopped.set()
+
+
+class LocalCache:
+    """A small LRU of values built from versioned data.
+
+    Entries name the data-version keys they were built from and remember
+    the versions at the time. An entry is served as is for
+    ``check_interval`` seconds after it was last checked; after that a read
+    checks those versions (one primary-key lookup, shared with the request's
+    ETag check) and reloads the value when any has moved. Bus events (and
+    resyncs) evict entries at once, so with a bus between the workers the
+    interval only matters when an event is lost. With ``check_interval`` 0
+    every read is checked and an entry is never stale.
+    """
+
+    def __init__(self, maxsize=256, check_interval=0):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, load, depends_on):
+        from http_cache import data_versions
+        depends_on = tuple(depends_on)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == depends_on \
+                    and time.monotonic() - entry[3] < self.check_interval:
+                self.entries.move_to_end(key)
+                return entry[0]
+        # Read before loading: a change in between reloads on the next check
+        checked = time.monotonic()
+        versions = data_versions.get(*depends_on)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == depends_on and entry[2] == versions:
+                self.entries[key] = (*entry[:3], checked)
+                self.entries.move_to_end(key)
+                return entry[0]
+        value = load()
+        with self.lock:
+            self.entries[key] = (value, depends_on, versions, checked)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def evict(self, event_key, version=None):
+        with self.lock:
+            if event_key == RESYNC:
+                self.entries.clear()
+                return
+            for key in [key for key, (_, depends_on, _, _) in self.entries.items() if event_key in depends_on]:
+                del self.entries[key]
+
+
+def _array(*items):
+    parts = [b'*%d\r\n' % len(items)]
+    for item in items:
+        if isinstance(item, int):
+            parts.append(b':%d\r\n' % item)
+        else:
+            parts.append(b'$%d\r\n%s\r\n' % (len(item), item))
+    return b''.join(parts)
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+
+    def handle(self):
+        broker = self.server
+        try:
+            while True:
+                command = _read_reply(self.rfile)
+                name = command[0].upper()
+                if name == b'SUBSCRIBE':
+                    for channel in command[1:]:
+                        with broker.lock:
+                            broker.channels.setdefault(channel, set()).add(self)
+                        self.send(_array(b'subscribe', channel, 1))
+                elif name == b'PUBLISH':
+                    self.send(b':%d\r\n' % broker.publish(command[1], command[2]))
+                elif name == b'PING':
+                    self.send(b'+PONG\r\n')
+                else:
+                    self.send(b'-ERR unknown command\r\n')
+        except (ConnectionError, OSError, IndexError, TypeError):
+            pass
+        finally:
+            with broker.lock:
+                for subscribers in broker.channels.values():
+                    subscribers.discard(self)
+
+    def send(self, data):
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+
+class _Broker:
+    channels = None
+
+    def init_broker(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def publish(self, channel, payload):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        message = _array(b'message', channel, payload)
+        delivered = 0
+        for subscriber in subscribers:
+            try:
+                subscriber.send(message)
+                delivered += 1
+            except OSError:
+                pass
+        return delivered
+
+
+class UnixBroker(_Broker, socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class TcpBroker(_Broker, socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def run_broker(address):
+    """A local stand-in for Redis pub/sub (PUBLISH, SUBSCRIBE and PING only).
+
+    ``address`` is a Unix socket path or a ``(host, port)`` pair.
+    """
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixBroker(address, _BrokerHandler)
+    else:
+        server = TcpBroker(address, _BrokerHandler)
+    server.init_broker()
+    with server:
+        server.serve_forever()
+
+
+bus = InvalidationBus()
@@ -0,0 +1,418 @@
+import os
+import json
+import time
+import bisect
+import hashlib
+import logging
+import threading
+from itertools import chain, islice
+
+from sqlalchemy import or_
+
+from app import db
+from models import Score
+from replicas import use_primary
+from http_cache import data_versions
+
+
+# Ids below the high-water mark that have not been read yet are re-checked
+# for this many seconds before they are taken for rolled back or deleted
+GAP_WINDOW = 600
+MAX_GAPS = 1000
+
+# Bulk statements on scores (deletes, rescoring, detached partitions) bump
+# this; a change seen on read means rows may have changed or gone, which
+# only a rebuild notices. Catalog edits leave the boards alone: deleting a
+# quiz, chapter or subject deletes its scores in bulk too.
+VERSION_KEYS = ('scores:bulk',)
+
+
+class Board:
+    """A ranking kept as sorted keys, one entry per user.
+
+    Keys sort best-first. They are held in sorted buckets of up to
+    ``2 * LOAD`` keys, so an update only shifts the keys of one bucket
+    rather than the whole ranking. A rank is a binary search over the
+    bucket maxima and within one bucket, plus the sizes of the buckets
+    before it; the top N is read from the front buckets.
+    """
+
+    LOAD = 500
+
+    def __init__(self):
+        self.buckets = []
+        self.maxes = []
+        self.entries = {}  # user_id -> key
+
+    def _insert(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            return
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            i -= 1
+            self.buckets[i].append(key)
+            self.maxes[i] = key
+        else:
+            bisect.insort(self.buckets[i], key)
+        bucket = self.buckets[i]
+        if len(bucket) > 2 * self.LOAD:
+            self.buckets[i:i + 1] = [bucket[:self.LOAD], bucket[self.LOAD:]]
+            self.maxes[i:i + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+
+    def _remove(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        bucket = self.buckets[i]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+
+    def upsert(self, user_id, key):
+        old_key = self.entries.get(user_id)
+        if old_key is not None:
+            self._remove(old_key)
+        self._insert(key)
+        self.entries[user_id] = key
+
+    def discard(self, user_id):
+        key = self.entries.pop(user_id, None)
+        if key is not None:
+            self._remove(key)
+
+    def rank(self, user_id):
+        key = self.entries.get(user_id)
+        if key is None:
+            return None
+        i = bisect.bisect_left(self.maxes, key)
+        return sum(map(len, self.buckets[:i])) + bisect.bisect_left(self.buckets[i], key) + 1
+
+    def top(self, n):
+        return list(islice(chain.from_iterable(self.buckets), n))
+
+    def __iter__(self):
+        return chain.from_iterable(self.buckets)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ScoreWatermark:
+    """How far ``scores.id`` has been read, allowing for out-of-order commits.
+
+    On PostgreSQL an id is taken when a submit inserts and only becomes
+    visible when it commits, so a lower id can appear after a higher one
+    was read. Every id skipped below ``high`` is kept as a gap; catch-up
+    reads fetch ``id > high`` plus the open gaps, until a gap is filled or
+    older than GAP_WINDOW seconds (its transaction rolled back, or the row
+    was deleted before anyone read it). The newest MAX_GAPS gaps are kept.
+    """
+
+    def __init__(self, high=0, gaps=()):
+        self.high = high
+        now = time.monotonic()
+        self.gaps = {score_id: now for score_id in gaps}  # id -> when it was noticed
+
+    def condition(self, column):
+        now = time.monotonic()
+        self.gaps = {score_id: noticed for score_id, noticed in self.gaps.items() if now - noticed < GAP_WINDOW}
+        if self.gaps:
+            return or_(column > self.high, column.in_(sorted(self.gaps)))
+        return column > self.high
+
+    def seen(self, score_id):
+        """Note a score as read; False if it already was."""
+        if score_id > self.high:
+            now = time.monotonic()
+            for missing in range(max(self.high + 1, score_id - MAX_GAPS), score_id):
+                self.gaps[missing] = now
+            self.high = score_id
+            if len(self.gaps) > 2 * MAX_GAPS:
+                self.gaps = dict(sorted(self.gaps.items())[-MAX_GAPS:])
+            return True
+        return self.gaps.pop(score_id, None) is not None
+
+
+class LeaderboardIndex:
+    """Per-quiz and global leaderboards maintained incrementally.
+
+    Each quiz board ranks by percentage score, then by earliest submission.
+    The global board ranks users by the sum of their percentage scores.
+    New scores are applied as they are submitted, and scores written by other
+    workers are picked up by reading past a high-water mark on ``scores.id``.
+    The index is periodically snapshotted to disk so a restarted worker only
+    has to replay the scores written since the snapshot. Periodic and
+    invalidation rebuilds run on a background thread and swap the new
+    boards in when done; readers keep using the current ones meanwhile.
+    """
+
+    # Replaced as a whole by a rebuild
+    STATE = ('quiz_boards', 'global_board', 'global_points', 'user_scores', 'watermark', 'versions')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.app = None
+        self.rebuilding = False
+        self.snapshot_path = None
+        self.database_key = None
+        self.snapshot_interval = 300
+        self.rebuild_interval = 3600
+        self._reset()
+
+    def _reset(self):
+        self.quiz_boards = {}
+        self.global_board = Board()
+        self.global_points = {}  # user_id -> (points, attempts)
+        self.user_scores = {}  # (quiz_id, user_id) -> (score_id, total_score)
+        self.watermark = ScoreWatermark()
+        self.versions = None
+        self.loaded = False
+        self.stale = False
+        self.last_snapshot = time.monotonic()
+        self.last_rebuild = time.monotonic()
+
+    def init_app(self, app):
+        self.app = app
+        # Only a fingerprint is kept so credentials never land in the snapshot
+        self.database_key = hashlib.sha1(
+            app.config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()
+        self.snapshot_path = app.config.get('LEADERBOARD_SNAPSHOT_PATH') or \
+            os.path.join(app.instance_path, 'leaderboard_snapshot.json')
+        self.snapshot_interval = app.config.get('LEADERBOARD_SNAPSHOT_INTERVAL', 300)
+        self.rebuild_interval = app.config.get('LEADERBOARD_REBUILD_INTERVAL', 3600)
+
+    # Updates
+
+    def _apply(self, score_id, quiz_id, user_id, total_score, timestamp):
+        total_score = total_score or 0
+        previous = self.user_scores.get((quiz_id, user_id))
+        if previous is not None and previous[0] >= score_id:
+            return
+
+        board = self.quiz_boards.setdefault(quiz_id, Board())
+        board.upsert(user_id, (-total_score, timestamp, score_id, user_id))
+
+        points, attempts = self.global_points.get(user_id, (0, 0))
+        if previous is not None:
+            points -= previous[1]
+        else:
+            attempts += 1
+        points += total_score
+        self.global_points[user_id] = (points, attempts)
+        self.global_board.upsert(user_id, (-points, attempts, user_id))
+
+        self.user_scores[(quiz_id, user_id)] = (score_id, total_score)
+
+    def record(self, score):
+        """Apply a newly committed score to the boards."""
+        with self.lock:
+            self._ensure_loaded()
+            if self.watermark.seen(score.id):
+                self._apply(score.id, score.quiz_id, score.user_id, score.total_score,
+                            score.timestamp.timestamp())
+            self._maybe_snapshot()
+
+    def remove_quiz(self, quiz_id):
+        with self.lock:
+            # A rebuild going on may already have read the removed rows
+            self.stale = self.stale or self.rebuilding
+            board = self.quiz_boards.pop(quiz_id, None)
+            if board is None:
+                return
+            for user_id in list(board.entries):
+                self._drop_user_score(quiz_id, user_id)
+            self._snapshot_if_loaded()
+
+    def remove_user(self, user_id):
+        with self.lock:
+            self.stale = self.stale or self.rebuilding
+            for quiz_id, board in self.quiz_boards.items():
+                board.discard(user_id)
+            for key in [key for key in self.user_scores if key[1] == user_id]:
+                del self.user_scores[key]
+            self.global_points.pop(user_id, None)
+            self.global_board.discard(user_id)
+            self._snapshot_if_loaded()
+
+    def _drop_user_score(self, quiz_id, user_id):
+        _, total_score = self.user_scores.pop((quiz_id, user_id))
+        points, attempts = self.global_points[user_id]
+        points, attempts = points - total_score, attempts - 1
+        if attempts:
+            self.global_points[user_id] = (points, attempts)
+            self.global_board.upsert(user_id, (-points, attempts, user_id))
+        else:
+            del self.global_points[user_id]
+            self.global_board.discard(user_id)
+
+    # Loading and synchronisation
+
+    def invalidate(self):
+        """Force a full rebuild on the next read, e.g. after a bulk delete."""
+        with self.lock:
+            self.stale = True
+
+    def _ensure_loaded(self):
+        # The high-water mark must come from the primary: a lagging replica
+        # could hand out ids past attempts it has not received yet
+        with use_primary():
+            self._load()
+
+    def _load(self):
+        # Checked on every read so that other workers' deletes are noticed
+        # even when no bus event arrives
+        versions = data_versions.get(*VERSION_KEYS)
+        if not self.loaded:
+            # Nothing to serve yet, so the first build happens inline
+            if not self._load_snapshot(versions):
+                self._rebuild(versions)
+            self.loaded = True
+        elif (self.stale or versions != self.versions
+              or time.monotonic() - self.last_rebuild > self.rebuild_interval) \
+                and not self.rebuilding and self.app is not None:
+            # Deletes made by other workers are only visible to a full rebuild
+            self._start_rebuild(versions)
+        self._catch_up()
+
+    def _catch_up(self):
+        rows = db.session.query(Score.id, Score.quiz_id, Score.user_id, Score.total_score, Score.timestamp)\
+            .filter(self.watermark.condition(Score.id)).order_by(Score.id).yield_per(1000)
+        for score_id, quiz_id, user_id, total_score, timestamp in rows:
+            if self.watermark.seen(score_id):
+                self._apply(score_id, quiz_id, user_id, total_score, timestamp.timestamp())
+
+    def _rebuild(self, versions):
+        self._reset()
+        self.versions = versions
+        self.loaded = True
+        self._catch_up()
+        if self.snapshot_path:
+            self.snapshot()
+        logging.info("Leaderboard index rebuilt up to score %s", self.watermark.high)
+
+    def _start_rebuild(self, versions):
+        # Called with the lock held; invalidations from here on mark the
+        # new boards stale again
+        self.stale = False
+        self.rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, args=(versions,), name='leaderboard-rebuild',
+                         daemon=True).start()
+
+    def _rebuild_in_background(self, versions):
+        fresh = LeaderboardIndex()
+        fresh.versions = versions
+        try:
+            with self.app.app_context():
+                fresh._catch_up()
+                db.session.remove()
+        except Exception:
+            logging.exception("Leaderboard rebuild failed")
+            with self.lock:
+                # Retried after the next rebuild interval
+                self.rebuilding = False
+                self.last_rebuild = time.monotonic()
+            return
+        with self.lock:
+            for name in self.STATE:
+                setattr(self, name, getattr(fresh, name))
+            self.rebuilding = False
+            self.last_rebuild = time.monotonic()
+            if self.snapshot_path:
+                self.snapshot()
+        logging.info("Leaderboard index rebuilt up to score %s", fresh.watermark.high)
+
+    def _load_snapshot(self, versions):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            logging.warning("Ignoring unreadable leaderboard snapshot %s", self.snapshot_path)
+            return False
+        if snapshot.get('database_key') != self.database_key:
+            return False
+        # Written before a rescore, bulk delete or detach another worker made since
+        if tuple(snapshot.get('versions', ())) != versions:
+            return False
+        self.versions = versions
+        for score_id, quiz_id, user_id, total_score, timestamp in snapshot['scores']:
+            self._apply(score_id, quiz_id, user_id, total_score, timestamp)
+        self.watermark = ScoreWatermark(snapshot['last_score_id'], snapshot.get('gaps', ()))
+        return True
+
+    def _current(self):
+        # Boards waiting for a rebuild must not replace a newer snapshot
+        return not (self.stale or self.rebuilding)
+
+    def _snapshot_if_loaded(self):
+        # Keep the on-disk copy from resurrecting deleted rows after a restart
+        if self.loaded and self.snapshot_path and self._current():
+            self.snapshot()
+
+    def _maybe_snapshot(self):
+        if self.snapshot_path and self._current() \
+                and time.monotonic() - self.last_snapshot > self.snapshot_interval:
+            self.snapshot()
+
+    def discard_snapshot(self):
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+
+    def snapshot(self):
+        """Write the boards to disk atomically."""
+        scores = [
+            (key[2], quiz_id, key[3], abs(key[0]), key[1])
+            for quiz_id, board in self.quiz_boards.items()
+            for key in board
+        ]
+        tmp_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'database_key': self.database_key,
+                'versions': list(self.versions),
+                'last_score_id': self.watermark.high,
+                'gaps': sorted(self.watermark.gaps),
+                'scores': scores,
+            }, f)
+        os.replace(tmp_path, self.snapshot_path)
+        self.last_snapshot = time.monotonic()
+
+    # Queries
+
+    def quiz_top(self, quiz_id, n=10):
+        """Return ``(rank, user_id, total_score)`` for the top N of a quiz."""
+        with self.lock:
+            self._ensure_loaded()
+            board = self.quiz_boards.get(quiz_id)
+            if board is None:
+                return []
+            return [(i + 1, key[3], abs(key[0])) for i, key in enumerate(board.top(n))]
+
+    def quiz_rank(self, quiz_id, user_id):
+        """Return ``(rank, board_size)`` for a user on a quiz board."""
+        with self.lock:
+            self._ensure_loaded()
+            board = self.quiz_boards.get(quiz_id)
+            if board is None:
+                return None, 0
+            return board.rank(user_id), len(board)
+
+    def global_top(self, n=10):
+        """Return ``(rank, user_id, points, attempts)`` for the global top N."""
+        with self.lock:
+            self._ensure_loaded()
+            return [(i + 1, key[2], abs(key[0]), key[1])
+                    for i, key in enumerate(self.global_board.top(n))]
+
+    def global_rank(self, user_id):
+        with self.lock:
+            self._ensure_loaded()
+            return self.global_board.rank(user_id), len(self.global_board)
+
+
+leaderboards = LeaderboardIndex()
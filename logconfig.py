@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import queue
+import copy
+import atexit
+import random
+import logging
+import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import request, g
+
+# Attributes every LogRecord has; anything else came in through ``extra``
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including any ``extra`` fields."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of records from noisy loggers.
+
+    ``rates`` maps logger names (and their children) to the fraction of
+    records kept. Warnings and above are never dropped.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return rate >= 1 or random.random() < rate
+            name = name.rpartition('.')[0]
+        return True
+
+
+def _parse_pairs(value, convert):
+    pairs = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, _, setting = item.partition('=')
+        pairs[name.strip()] = convert(setting.strip())
+    return pairs
+
+
+class _QueueHandler(QueueHandler):
+    # The stock prepare() folds the traceback into the message; keep it
+    # separate so the formatter on the other side can place it
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class StructuredLogging:
+    """Logging configured from the environment.
+
+    Records are put on a queue by the calling thread and formatted and
+    written by a listener thread, so a request never waits on the stream.
+
+    LOG_LEVEL       root level (default INFO)
+    LOG_LEVELS      per-logger levels, e.g. ``sqlalchemy.engine=INFO,werkzeug=WARNING``
+    LOG_FORMAT      ``json`` (default) or ``text``
+    LOG_FILE        write here instead of stderr
+    LOG_SAMPLE      fraction of records kept per logger, e.g. ``quiz.request=0.05``
+    LOG_ASYNC       ``false`` writes synchronously from the calling thread
+    """
+
+    def __init__(self):
+        self.listener = None
+        self.handler = None
+        self.request_logger = logging.getLogger('quiz.request')
+
+    def configure(self, environ=os.environ):
+        level = environ.get('LOG_LEVEL', 'INFO').upper()
+        levels = _parse_pairs(environ.get('LOG_LEVELS'), str.upper)
+        rates = _parse_pairs(environ.get('LOG_SAMPLE', 'quiz.request=0.05'), float)
+
+        if environ.get('LOG_FILE'):
+            output = logging.FileHandler(environ['LOG_FILE'])
+        else:
+            output = logging.StreamHandler(sys.stderr)
+        if environ.get('LOG_FORMAT', 'json').lower() == 'text':
+            output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        else:
+            output.setFormatter(JsonFormatter())
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.setLevel(level)
+        for name, logger_level in levels.items():
+            logging.getLogger(name).setLevel(logger_level)
+
+        if environ.get('LOG_ASYNC', 'true').lower() == 'true':
+            self.handler = _QueueHandler(queue.SimpleQueue())
+            self.listener = QueueListener(self.handler.queue, output, respect_handler_level=True)
+            self.listener.start()
+            atexit.register(self.stop)
+            # The listener thread does not survive a fork (gunicorn --preload)
+            os.register_at_fork(after_in_child=self._restart_after_fork)
+        else:
+            self.handler = output
+        # Dropped before they are queued, so sampled-out records cost nothing more
+        self.handler.addFilter(SamplingFilter(rates))
+        root.addHandler(self.handler)
+
+    def _restart_after_fork(self):
+        if self.listener is None:
+            return
+        self.handler.queue = self.listener.queue = queue.SimpleQueue()
+        self.listener._thread = None
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def init_app(self, app):
+        app.before_request(self._start_request)
+        app.after_request(self._log_request)
+
+    def _start_request(self):
+        g.request_started = time.perf_counter()
+
+    def _log_request(self, response):
+        # Errors are always logged; the rest is sampled by LOG_SAMPLE. A 503
+        # is load shedding, which comes in bursts, so it is sampled too
+        level = logging.WARNING if response.status_code >= 500 and response.status_code != 503 else logging.INFO
+        if self.request_logger.isEnabledFor(level) and 'request_started' in g:
+            self.request_logger.log(level, '%s %s %s', request.method, request.path, response.status_code,
+                                    extra={'method': request.method, 'path': request.path,
+                                           'endpoint': request.endpoint, 'status': response.status_code,
+                                           'duration_ms': round((time.perf_counter() - g.request_started) * 1000, 2)})
+        return response
+
+
+structured_logging = StructuredLogging()
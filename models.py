@@ -59,10 +59,21 @@ class Quiz(db.Model):
     # Relationships
     questions = db.relationship('Question', backref='quiz', lazy='dynamic', cascade='all, delete-orphan')
     scores = db.relationship('Score', backref='quiz', lazy='dynamic', cascade='all, delete-orphan')
+    pool = db.relationship('QuizPool', backref='quiz', uselist=False, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Quiz {self.title}>'
 
+class QuizPool(db.Model):
+    __tablename__ = 'quiz_pools'
+    
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quizzes.id'), primary_key=True)
+    pool_size = db.Column(db.Integer)  # Questions shown to each student; None shows all
+    shuffle_options = db.Column(db.Boolean, default=False)
+    
+    def __repr__(self):
+        return f'<QuizPool {self.quiz_id}>'
+
 class Question(db.Model):
     __tablename__ = 'questions'
     
@@ -80,6 +91,10 @@ class Question(db.Model):
 
 class Score(db.Model):
     __tablename__ = 'scores'
+    # History pages list a user's attempts newest first; time-window queries
+    # (analytics) range over timestamp, which is also the partition key (partitions.py)
+    __table_args__ = (db.Index('ix_scores_user_timestamp', 'user_id', 'timestamp'),
+                      db.Index('ix_scores_timestamp', 'timestamp'))
     
     id = db.Column(db.Integer, primary_key=True)
     quiz_id = db.Column(db.Integer, db.ForeignKey('quizzes.id'), nullable=False)
@@ -91,12 +106,14 @@ class Score(db.Model):
     
     # Relationships
     user_answers = db.relationship('UserAnswer', backref='score', lazy='dynamic', cascade='all, delete-orphan')
+    answer_archive = db.relationship('AnswerArchive', backref='score', uselist=False, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<Score {self.id}>'
 
 class UserAnswer(db.Model):
     __tablename__ = 'user_answers'
+    __table_args__ = (db.Index('ix_user_answers_score_id', 'score_id'),)
     
     id = db.Column(db.Integer, primary_key=True)
     score_id = db.Column(db.Integer, db.ForeignKey('scores.id'), nullable=False)
@@ -105,3 +122,77 @@ class UserAnswer(db.Model):
     
     def __repr__(self):
         return f'<UserAnswer {self.id}>'
+
+class AnswerArchive(db.Model):
+    __tablename__ = 'answer_archives'
+    
+    score_id = db.Column(db.Integer, db.ForeignKey('scores.id'), primary_key=True)
+    answers = db.Column(db.LargeBinary, nullable=False)  # Packed by archive.pack_answers
+    archived_at = db.Column(db.DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<AnswerArchive {self.score_id}>'
+
+class DataVersion(db.Model):
+    __tablename__ = 'data_versions'
+    
+    name = db.Column(db.String(100), primary_key=True)  # e.g. 'catalog', 'user:42'
+    version = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<DataVersion {self.name}={self.version}>'
+
+class RescoreRun(db.Model):
+    __tablename__ = 'rescore_runs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quizzes.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, done or failed
+    total_scores = db.Column(db.Integer, default=0)
+    processed = db.Column(db.Integer, default=0)
+    changed = db.Column(db.Integer, default=0)
+    started_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+    
+    def __repr__(self):
+        return f'<RescoreRun {self.id} quiz={self.quiz_id} {self.status}>'
+
+class DeletionJob(db.Model):
+    __tablename__ = 'deletion_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # subject, chapter, quiz or user
+    row_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, done or failed
+    total_scores = db.Column(db.Integer, default=0)
+    deleted_scores = db.Column(db.Integer, default=0)
+    started_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now)  # Bumped with every chunk
+    finished_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+    
+    def __repr__(self):
+        return f'<DeletionJob {self.id} {self.kind}={self.row_id} {self.status}>'
+
+class SimilarityFlag(db.Model):
+    __tablename__ = 'similarity_flags'
+    # Score ids are plain columns: a partitioned scores table cannot be
+    # referenced by id alone (partitions.py)
+    __table_args__ = (db.UniqueConstraint('score_a_id', 'score_b_id'),
+                      db.Index('ix_similarity_flags_score_b_id', 'score_b_id'))
+    
+    id = db.Column(db.Integer, primary_key=True)
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quizzes.id'), nullable=False, index=True)
+    score_a_id = db.Column(db.Integer, nullable=False)  # The lower of the two score ids
+    score_b_id = db.Column(db.Integer, nullable=False)
+    common_questions = db.Column(db.Integer, default=0)  # Answered in both attempts
+    matching_answers = db.Column(db.Integer, default=0)
+    shared_wrong = db.Column(db.Integer, default=0)  # Same wrong option in both attempts
+    similarity = db.Column(db.Float, default=0)
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, cleared or confirmed
+    detected_at = db.Column(db.DateTime, default=datetime.now)
+    reviewed_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<SimilarityFlag {self.score_a_id}~{self.score_b_id} {self.status}>'
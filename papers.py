@@ -0,0 +1,253 @@
+import os
+import re
+import json
+import uuid
+import zlib
+import fcntl
+import struct
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+
+from flask import render_template, current_app, request
+from markupsafe import escape
+
+from app import from_json_filter
+from assets import assets
+from models import Quiz, Question
+
+# Empty final deflate block that terminates an assembled stream
+_FINAL_BLOCK = zlib.compressobj(wbits=-15).flush()
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def _deflate(data, level=6):
+    # Raw deflate ending on a byte boundary (sync flush, not final), so
+    # independently compressed pieces can be concatenated into one stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class _PaperUser:
+    """Stand-in for ``current_user`` while pre-rendering a paper."""
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+    is_admin = False
+
+    def __init__(self, username):
+        self.username = username
+
+
+class Paper:
+    """A pre-rendered take_quiz page split around its per-user fields."""
+
+    def __init__(self, segments, fields, built_on, assets_version):
+        self.segments = [segment.encode() for segment in segments]
+        self.fields = fields
+        self.built_on = built_on
+        self.assets_version = assets_version
+        self.compressed = [_deflate(segment, 9) for segment in self.segments]
+
+    def render(self, values, gzip=False):
+        """Assemble the page for one user.
+
+        ``values`` maps field names to already-escaped strings. With ``gzip``
+        the static segments are reused in their precompressed form and only
+        the per-user values are compressed on the fly.
+        """
+        dynamic = [values[name].encode() for name in self.fields]
+        if not gzip:
+            parts = [self.segments[0]]
+            for value, segment in zip(dynamic, self.segments[1:]):
+                parts.extend((value, segment))
+            return b''.join(parts)
+
+        parts = [_GZIP_HEADER, self.compressed[0]]
+        crc = zlib.crc32(self.segments[0])
+        size = len(self.segments[0])
+        for value, segment, compressed in zip(dynamic, self.segments[1:], self.compressed[1:]):
+            parts.extend((_deflate(value, 1), compressed))
+            crc = zlib.crc32(segment, zlib.crc32(value, crc))
+            size += len(value) + len(segment)
+        parts.append(_FINAL_BLOCK)
+        parts.append(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+        return b''.join(parts)
+
+
+class PaperCache:
+    """Pre-rendered quiz papers shared by all workers through the filesystem.
+
+    Papers are rendered once per quiz into ``<instance>/papers`` with markers
+    where the CSRF token and username go; each worker keeps the parsed paper
+    in memory and reloads it when the file's mtime changes. Papers are built
+    ahead of time for quizzes dated within ``PAPER_PRERENDER_DAYS`` (see the
+    ``prerender-papers`` command), rebuilt when questions change, and built
+    on first use otherwise. Builds of a quiz's paper are serialized by a
+    thread lock and an flock on ``<quiz_id>.lock``, so when a paper goes
+    missing or out of date (new year, new assets) one request in one worker
+    renders it and the others wait and reuse it.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.prerender_days = 1
+        self._papers = {}  # quiz_id -> (mtime, Paper)
+        self._build_locks = {}  # quiz_id -> threading.Lock
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.directory = app.config.get('PAPER_DIR') or os.path.join(app.instance_path, 'papers')
+        self.prerender_days = app.config.get('PAPER_PRERENDER_DAYS', 1)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, quiz_id):
+        return os.path.join(self.directory, f'{quiz_id}.json')
+
+    @contextmanager
+    def _building(self, quiz_id):
+        # The thread lock keeps this worker's threads off the flock, which is per process
+        with self._lock:
+            lock = self._build_locks.setdefault(quiz_id, threading.Lock())
+        with lock, open(os.path.join(self.directory, f'{quiz_id}.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def build(self, quiz):
+        """Render and store the paper for a quiz.
+
+        Returns None for quizzes without questions and for pooled quizzes.
+        """
+        with self._building(quiz.id):
+            return self._build(quiz)
+
+    def _build(self, quiz):
+        questions = Question.query.filter_by(quiz_id=quiz.id).all()
+        # Pooled quizzes give every student a different paper
+        if not questions or quiz.pool is not None:
+            self.discard(quiz.id)
+            return None
+        for question in questions:
+            question.options_list = from_json_filter(question.options)
+
+        nonce = uuid.uuid4().hex
+        fields = {name: f'\x00{nonce}:{name}\x00' for name in ('csrf_token', 'username')}
+        with current_app.test_request_context():
+            html = render_template('user/take_quiz.html', quiz=quiz, questions=questions,
+                                   current_user=_PaperUser(fields['username']),
+                                   csrf_token=lambda: fields['csrf_token'],
+                                   get_flashed_messages=lambda **kwargs: [])
+
+        # Split on the markers, remembering which field sits in each gap
+        pieces = re.split(f'\x00{nonce}:(\\w+)\x00', html)
+        segments = pieces[0::2]
+        order = pieces[1::2]
+
+        record = {'segments': segments, 'fields': order,
+                  'built_on': datetime.date.today().isoformat(),
+                  'assets_version': assets.version}
+        path = self._path(quiz.id)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+        logging.info("Pre-rendered paper for quiz %s", quiz.id)
+
+        paper = Paper(segments, order, record['built_on'], record['assets_version'])
+        with self._lock:
+            self._papers[quiz.id] = (os.stat(path).st_mtime_ns, paper)
+        return paper
+
+    def _load(self, quiz_id):
+        """The stored paper, or None if there is none or it cannot be read."""
+        path = self._path(quiz_id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        cached = self._papers.get(quiz_id)
+        if cached is None or cached[0] != mtime:
+            try:
+                with open(path) as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                return None
+            cached = (mtime, Paper(record['segments'], record['fields'], record['built_on'],
+                                   record.get('assets_version')))
+            with self._lock:
+                self._papers[quiz_id] = cached
+        return cached[1]
+
+    def _current(self, paper):
+        # The footer carries the current year and the page links fingerprinted assets
+        return (paper is not None and paper.built_on[:4] == str(datetime.date.today().year)
+                and paper.assets_version == assets.version)
+
+    def get(self, quiz):
+        """Return the current paper for a quiz, building it if needed."""
+        paper = self._load(quiz.id)
+        if self._current(paper):
+            return paper
+        with self._building(quiz.id):
+            # Built by another thread or worker while this one waited
+            paper = self._load(quiz.id)
+            if self._current(paper):
+                return paper
+            return self._build(quiz)
+
+    def discard(self, quiz_id):
+        with self._lock:
+            self._papers.pop(quiz_id, None)
+        try:
+            os.remove(self._path(quiz_id))
+        except FileNotFoundError:
+            pass
+
+    def refresh(self, quiz_id):
+        """Called when a quiz or its questions change."""
+        quiz = Quiz.query.get(quiz_id)
+        if quiz is None:
+            self.discard(quiz_id)
+        elif quiz.date and quiz.date <= datetime.date.today() + datetime.timedelta(days=self.prerender_days):
+            self.build(quiz)
+        else:
+            self.discard(quiz_id)
+
+    def discard_all(self):
+        """Drop every paper, e.g. after a subject or chapter is renamed."""
+        with self._lock:
+            self._papers.clear()
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def prerender_upcoming(self, days=None):
+        """Build papers for quizzes dated between today and ``days`` ahead."""
+        today = datetime.date.today()
+        horizon = today + datetime.timedelta(days=self.prerender_days if days is None else days)
+        built = 0
+        for quiz in Quiz.query.filter(Quiz.date >= today, Quiz.date <= horizon).all():
+            if self.build(quiz) is not None:
+                built += 1
+        return built
+
+    def serve(self, paper, values):
+        gzip = 'gzip' in request.accept_encodings
+        body = paper.render({name: str(escape(value)) for name, value in values.items()}, gzip=gzip)
+        response = current_app.response_class(body, mimetype='text/html')
+        response.vary.add('Accept-Encoding')
+        if gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+
+papers = PaperCache()
@@ -0,0 +1,267 @@
+import re
+import logging
+import datetime
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex, AddConstraint
+
+from app import db
+from models import Score, UserAnswer
+from http_cache import data_versions
+
+# Held (per transaction) while partitions are created, converted or detached
+ADVISORY_LOCK = 0x5C0E5
+
+
+def month_start(day):
+    return datetime.date(day.year, day.month, 1)
+
+
+def add_months(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def window_start(months, today=None):
+    """Start of a window of the last ``months`` calendar months, the current one included.
+
+    Windows start on a month boundary so that a partitioned scores table is
+    pruned to exactly ``months`` partitions.
+    """
+    start = add_months(month_start(today or datetime.date.today()), 1 - months)
+    return datetime.datetime.combine(start, datetime.time())
+
+
+class ScorePartitions:
+    """Native range partitioning of scores and user_answers on PostgreSQL.
+
+    scores is partitioned by month of ``timestamp`` (scores_p202610, ...),
+    so queries filtered on Score.timestamp (see ``window_start``) only scan
+    the months they cover. user_answers has no timestamp; it is partitioned
+    by ``score_id`` in ranges of ``answer_span`` ids, which follow time
+    because score ids are issued in order. Both tables keep a default
+    partition for rows outside every range.
+
+    Partitioned tables are transparent to the ORM. The primary keys become
+    (id, partition key), and foreign keys into scores are dropped, as
+    PostgreSQL requires; from then on SubtreeDeleter (deletion.py) is what
+    keeps answers from outliving their attempts. Upcoming partitions are
+    created ``months_ahead`` months in advance by ``flask partition-tables``,
+    which is meant to run from a daily scheduled job; requests never run
+    DDL. Old months are archived by detaching them, which leaves plain
+    tables to dump and drop.
+
+    SQLite has no partitioning. There, the same time-window queries range
+    over ix_scores_timestamp.
+    """
+
+    def __init__(self):
+        self.months_ahead = 2
+        self.answer_span = 1000000
+
+    def init_app(self, app):
+        self.months_ahead = app.config.get('SCORE_PARTITION_MONTHS_AHEAD', 2)
+        self.answer_span = app.config.get('ANSWER_PARTITION_SPAN', 1000000)
+
+    # Catalog queries
+
+    def _lock(self, conn):
+        conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': ADVISORY_LOCK})
+
+    def _is_partitioned(self, conn, table):
+        return conn.execute(text('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)'),
+                            {'table': table}).first() is not None
+
+    def _partitions(self, conn, table):
+        return conn.execute(text(
+            'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint FROM pg_inherits i '
+            'JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:table) ORDER BY c.relname'
+        ), {'table': table}).all()
+
+    def _scores_months(self, conn):
+        """``{month_start: partition name}`` of the attached scores partitions."""
+        months = {}
+        for name, _, _ in self._partitions(conn, 'scores'):
+            match = re.fullmatch(r'scores_p(\d{4})(\d{2})', name)
+            if match:
+                months[datetime.date(int(match[1]), int(match[2]), 1)] = name
+        return months
+
+    def _answer_ranges(self, conn):
+        """``{lower score id: partition name}`` of the attached user_answers partitions."""
+        ranges = {}
+        for name, _, _ in self._partitions(conn, 'user_answers'):
+            match = re.fullmatch(r'user_answers_s(\d+)', name)
+            if match:
+                ranges[int(match[1])] = name
+        return ranges
+
+    # Creating partitions
+
+    def _attach(self, conn, parent, name, key, lower, upper):
+        """Create a partition, taking over any of its rows from the default partition."""
+        q = conn.dialect.identifier_preparer.quote_identifier
+        conn.execute(text(f'CREATE TABLE {q(name)} (LIKE {q(parent)} INCLUDING DEFAULTS)'))
+        conn.execute(text(
+            f'WITH moved AS (DELETE FROM {q(parent + "_default")} WHERE {q(key)} >= {lower} AND {q(key)} < {upper} '
+            f'RETURNING *) INSERT INTO {q(name)} SELECT * FROM moved'))
+        conn.execute(text(f'ALTER TABLE {q(parent)} ATTACH PARTITION {q(name)} FOR VALUES FROM ({lower}) TO ({upper})'))
+
+    def _add_month(self, conn, month):
+        self._attach(conn, 'scores', f'scores_p{month:%Y%m}', 'timestamp',
+                     f"'{month.isoformat()}'", f"'{add_months(month, 1).isoformat()}'")
+
+    def _add_answer_range(self, conn, lower):
+        self._attach(conn, 'user_answers', f'user_answers_s{lower}', 'score_id', lower, lower + self.answer_span)
+
+    def _ensure(self, conn, today):
+        self._lock(conn)
+        created = 0
+        months = self._scores_months(conn)
+        for offset in range(self.months_ahead + 1):
+            month = add_months(month_start(today), offset)
+            if month not in months:
+                self._add_month(conn, month)
+                created += 1
+
+        if self._is_partitioned(conn, 'user_answers'):
+            ranges = self._answer_ranges(conn)
+            top = max(ranges) + self.answer_span if ranges else 0
+            last_id = conn.execute(text('SELECT COALESCE(MAX(id), 0) FROM scores')).scalar()
+            # Keep a full range of headroom above the newest score
+            while top <= last_id + self.answer_span:
+                self._add_answer_range(conn, top)
+                top += self.answer_span
+                created += 1
+        if created:
+            logging.info("Created %d partitions", created)
+        return created
+
+    def ensure(self, today=None):
+        """Create the partitions for the current month, the months ahead and new score ids."""
+        with db.engine.begin() as conn:
+            return self._ensure(conn, today or datetime.date.today())
+
+    # Converting existing tables
+
+    def _convert(self, conn, table, key, fill=None):
+        """Replace a plain table with a partitioned copy of it (default partition only).
+
+        Returns the foreign keys into the table that had to be dropped, as
+        ``(referencing table, constraint, definition)`` tuples.
+        """
+        q = conn.dialect.identifier_preparer.quote_identifier
+        name, old = table.name, f'{table.name}_unpartitioned'
+        conn.execute(text(f'LOCK TABLE {q(name)} IN ACCESS EXCLUSIVE MODE'))
+        # A partitioned table's id is only unique together with the
+        # partition key, so nothing can reference it by id alone
+        dropped = conn.execute(text(
+            "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE confrelid = to_regclass(:table) AND contype = 'f'"), {'table': name}).all()
+        for referencing, constraint, _ in dropped:
+            conn.execute(text(f'ALTER TABLE {referencing} DROP CONSTRAINT {q(constraint)}'))
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': name}).scalar()
+
+        conn.execute(text(f'ALTER TABLE {q(name)} RENAME TO {q(old)}'))
+        conn.execute(text(f'CREATE TABLE {q(name)} (LIKE {q(old)} INCLUDING DEFAULTS) PARTITION BY RANGE ({q(key)})'))
+        conn.execute(text(f'CREATE TABLE {q(name + "_default")} PARTITION OF {q(name)} DEFAULT'))
+        columns = [column.name for column in table.columns]
+        values = [(fill or {}).get(column, q(column)) for column in columns]
+        conn.execute(text(f'INSERT INTO {q(name)} ({", ".join(map(q, columns))}) '
+                          f'SELECT {", ".join(values)} FROM {q(old)}'))
+        if sequence:
+            conn.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY {q(name)}.id'))
+        conn.execute(text(f'DROP TABLE {q(old)}'))
+
+        conn.execute(text(f'ALTER TABLE {q(name)} ADD PRIMARY KEY (id, {q(key)})'))
+        for index in table.indexes:
+            conn.execute(CreateIndex(index))
+        for constraint in table.foreign_key_constraints:
+            if constraint.referred_table.name not in ('scores', 'user_answers'):
+                conn.execute(AddConstraint(constraint))
+        return [tuple(row) for row in dropped]
+
+    def convert(self):
+        """Partition scores and user_answers if they are plain tables, then create the
+        partitions their rows need. Holds exclusive locks on both tables while the rows
+        are copied, so run it in a maintenance window. On tables already partitioned it
+        only creates the upcoming partitions. Returns ``(tables converted, foreign keys
+        dropped)``."""
+        converted = []
+        dropped = []
+        today = datetime.date.today()
+        with db.engine.begin() as conn:
+            if conn.dialect.name != 'postgresql':
+                raise RuntimeError('Partitioning needs PostgreSQL.')
+            self._lock(conn)
+            if not self._is_partitioned(conn, 'scores'):
+                # The key cannot be NULL in a primary key
+                dropped += self._convert(conn, Score.__table__, 'timestamp',
+                                         fill={'timestamp': 'COALESCE("timestamp", now())'})
+                converted.append('scores')
+            if not self._is_partitioned(conn, 'user_answers'):
+                dropped += self._convert(conn, UserAnswer.__table__, 'score_id')
+                converted.append('user_answers')
+
+            # Rows copied so far sit in the default partitions; give each past
+            # month and id range of them its own partition
+            months = self._scores_months(conn)
+            first = conn.execute(text('SELECT MIN("timestamp") FROM scores_default')).scalar()
+            month = month_start(first.date()) if first is not None else month_start(today)
+            while month < month_start(today):
+                if month not in months:
+                    self._add_month(conn, month)
+                month = add_months(month, 1)
+            ranges = self._answer_ranges(conn)
+            low, high = conn.execute(text('SELECT MIN(score_id), MAX(score_id) FROM user_answers_default')).one()
+            if low is not None:
+                for lower in range(low - low % self.answer_span, high + 1, self.answer_span):
+                    if lower not in ranges:
+                        self._add_answer_range(conn, lower)
+            self._ensure(conn, today)
+        return converted, dropped
+
+    # Archiving
+
+    def detach_before(self, month):
+        """Detach the scores partitions of the months before ``month``, and the
+        user_answers partitions that only hold answers to those scores.
+
+        The detached partitions stay in the database as plain tables, ready
+        to be dumped and dropped; returns their names.
+        """
+        month = month_start(month)
+        detached = []
+        # On the session's connection, so the commit bumps the data versions
+        conn = db.session.connection()
+        if conn.dialect.name != 'postgresql':
+            raise RuntimeError('Partitioning needs PostgreSQL.')
+        q = conn.dialect.identifier_preparer.quote_identifier
+        self._lock(conn)
+        for start, name in sorted(self._scores_months(conn).items()):
+            if start < month:
+                conn.execute(text(f'ALTER TABLE scores DETACH PARTITION {q(name)}'))
+                detached.append(name)
+        # Answers of scores still attached must stay
+        oldest = conn.execute(text('SELECT MIN(id) FROM scores')).scalar()
+        if oldest is not None:
+            for lower, name in sorted(self._answer_ranges(conn).items()):
+                if lower + self.answer_span <= oldest:
+                    conn.execute(text(f'ALTER TABLE user_answers DETACH PARTITION {q(name)}'))
+                    detached.append(name)
+        if detached:
+            # Leaderboards and history summaries counted those attempts
+            data_versions.touch(db.session, 'scores:bulk')
+        db.session.commit()
+        return detached
+
+    def status(self):
+        """``(table, partition, bounds, estimated rows)`` for every partition."""
+        with db.engine.connect() as conn:
+            if conn.dialect.name != 'postgresql':
+                return []
+            return [(table, name, bounds, rows) for table in ('scores', 'user_answers')
+                    for name, bounds, rows in self._partitions(conn, table)]
+
+
+partitions = ScorePartitions()
@@ -0,0 +1,128 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hashing jobs are already queued."""
+
+
+def _hash_method(pwhash):
+    return pwhash.split('$', 1)[0]
+
+
+def _verify(pwhash, password, method, method_prefix):
+    # Runs inside a pool worker, so keep it free of app imports
+    if not check_password_hash(pwhash, password):
+        return False, None
+    if _hash_method(pwhash) != method_prefix:
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+def _noop():
+    return os.getpid()
+
+
+class PasswordHasher:
+    """Verify and generate password hashes off the request thread.
+
+    Hashing runs in a small process pool so that a burst of logins cannot
+    pin every request worker on CPU. At most ``max_pending`` jobs may be in
+    flight; beyond that callers get ``PasswordHasherBusy`` immediately rather
+    than queueing behind work that will time out anyway. Unknown usernames
+    are checked against a dummy hash so they take as long as real ones, and
+    hashes made with a different method or cost are upgraded on successful
+    login. With ``workers`` set to 0 hashing runs inline.
+    """
+
+    def __init__(self):
+        self.method = 'scrypt'
+        self.workers = 0
+        self.max_pending = 0
+        self.timeout = None
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._dummy_hash = None
+        self._method_prefix = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.configure(method=app.config.get('PASSWORD_HASH_METHOD', 'scrypt'),
+                       workers=app.config.get('PASSWORD_HASH_WORKERS', 0),
+                       max_pending=app.config.get('PASSWORD_HASH_MAX_PENDING', 0),
+                       timeout=app.config.get('PASSWORD_HASH_TIMEOUT'))
+
+    def configure(self, method='scrypt', workers=0, max_pending=0, timeout=None):
+        self.shutdown()
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending or 4 * max(workers, 1)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._dummy_hash = generate_password_hash(os.urandom(16).hex(), method=method)
+        # e.g. 'scrypt:32768:8:1', the method with its cost parameters spelled out
+        self._method_prefix = _hash_method(self._dummy_hash)
+        if workers:
+            self._get_executor()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            # A pool inherited across fork (e.g. gunicorn --preload) is unusable
+            if self._executor is None or self._pid != os.getpid():
+                context = None
+                if 'fork' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('fork')
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._pid = os.getpid()
+                # Start the workers now, before the request threads exist
+                for _ in range(self.workers):
+                    self._executor.submit(_noop)
+                logging.info("Started password hashing pool with %d workers", self.workers)
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise PasswordHasherBusy()
+
+    def verify(self, pwhash, password):
+        """Check a password against a stored hash.
+
+        Returns ``(valid, new_hash)`` where ``new_hash`` is set when the stored
+        hash should be replaced with one using the configured method. Pass
+        ``None`` as ``pwhash`` for unknown users to keep timing uniform.
+        """
+        if pwhash is None:
+            self._run(_verify, self._dummy_hash, password, self.method, self._method_prefix)
+            return False, None
+        return self._run(_verify, pwhash, password, self.method, self._method_prefix)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+
+password_hasher = PasswordHasher()
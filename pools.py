@@ -0,0 +1,55 @@
+import hashlib
+import itertools
+from functools import lru_cache
+
+from flask import current_app
+
+from app import from_json_filter
+
+
+@lru_cache(maxsize=None)
+def option_permutations(n):
+    """All orderings of ``n`` options, so a shuffle is just an index into this table."""
+    return tuple(itertools.permutations(range(n)))
+
+
+def _digest(quiz_id, user_id, question_id):
+    # Keyed so students cannot work out each other's papers
+    key = hashlib.sha256(current_app.secret_key.encode()).digest()
+    message = f'{quiz_id}:{user_id}:{question_id}'.encode()
+    return int.from_bytes(hashlib.blake2b(message, key=key, digest_size=8).digest(), 'big')
+
+
+def select_questions(pool, user_id, questions):
+    """Return the questions a student sees from a pooled quiz.
+
+    Each question gets a deterministic per-student digest: questions are
+    ordered by it, the first ``pool_size`` are kept, and its high bits pick
+    the option ordering. Nothing has to be stored, submit_quiz derives the
+    same paper again, and adding a question only moves that one question in
+    or out of existing papers. Every returned question has ``options_list``
+    in display order and ``option_order`` mapping display positions back to
+    the stored option indexes.
+    """
+    digests = {question.id: _digest(pool.quiz_id, user_id, question.id) for question in questions}
+    selected = sorted(questions, key=lambda question: digests[question.id])
+    if pool.pool_size:
+        selected = selected[:pool.pool_size]
+
+    for question in selected:
+        options = from_json_filter(question.options)
+        if pool.shuffle_options:
+            permutations = option_permutations(len(options))
+            order = permutations[(digests[question.id] >> 32) % len(permutations)]
+        else:
+            order = tuple(range(len(options)))
+        question.option_order = order
+        question.options_list = [options[i] for i in order]
+    return selected
+
+
+def original_answer(question, displayed):
+    """Map a submitted display position back to the stored option index."""
+    if displayed is None or not displayed.isdigit() or int(displayed) >= len(question.option_order):
+        return None
+    return str(question.option_order[int(displayed)])
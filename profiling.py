@@ -0,0 +1,261 @@
+import os
+import sys
+import logging
+import time
+import threading
+import tracemalloc
+from collections import Counter
+
+from flask import request
+
+
+class ProfilingUnavailable(RuntimeError):
+    """The profiler cannot take this run now (busy, rate limited or over budget)."""
+
+
+def _label(code):
+    # Function plus the last two path components keeps labels short and unambiguous
+    path = '/'.join(code.co_filename.split(os.sep)[-2:])
+    return f'{code.co_name} ({path}:{code.co_firstlineno})'
+
+
+class _Run:
+    def __init__(self, endpoint, requests):
+        self.endpoint = endpoint
+        self.requests = requests
+        self.completed = 0
+        self.done = threading.Event()
+
+
+class SamplingProfiler:
+    """On-demand statistical profiler for the current worker.
+
+    A run samples the stacks of this worker's request threads every
+    ``interval`` seconds, so the requests being profiled run no extra code
+    beyond a dict update on entry and exit. With an ``endpoint``, only
+    threads serving that endpoint are sampled, and the run can end once
+    ``requests`` of them have completed. Runs are capped at ``max_seconds``
+    and only one runs at a time. Stacks come back in collapsed format
+    ("endpoint;outer;inner count" lines), which flamegraph.pl and speedscope
+    read.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.interval = 0.01
+        self.max_seconds = 30
+        self.max_requests = 500
+        self.max_depth = 64
+        self.lock = threading.Lock()
+        self.run = None
+        self.active = {}  # thread id -> endpoint, only while a run is going
+        self.labels = {}
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PROFILING_ENABLED', False)
+        self.interval = app.config.get('PROFILE_INTERVAL', 0.01)
+        self.max_seconds = app.config.get('PROFILE_MAX_SECONDS', 30)
+        self.max_requests = app.config.get('PROFILE_MAX_REQUESTS', 500)
+        if self.enabled:
+            app.before_request(self._track)
+            app.teardown_request(self._untrack)
+
+    def _track(self):
+        if self.run is not None:
+            self.active[threading.get_ident()] = request.endpoint
+
+    def _untrack(self, exc=None):
+        endpoint = self.active.pop(threading.get_ident(), None)
+        run = self.run
+        if run is not None and run.endpoint is not None and endpoint == run.endpoint:
+            run.completed += 1
+            if run.requests and run.completed >= run.requests:
+                run.done.set()
+
+    def _collapse(self, frame, endpoint):
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            code = frame.f_code
+            label = self.labels.get(code)
+            if label is None:
+                label = self.labels[code] = _label(code).replace(';', ',')
+            labels.append(label)
+            frame = frame.f_back
+        if frame is not None:
+            labels.append('...')
+        labels.append(endpoint or '?')
+        return ';'.join(reversed(labels))
+
+    def sample(self, seconds=None, endpoint=None, requests=None):
+        """Profile for up to ``seconds``, or until ``requests`` to ``endpoint`` complete.
+
+        Blocks the calling thread, which does the sampling; returns
+        ``(stacks, stats)`` where ``stacks`` is a Counter of collapsed stacks.
+        """
+        seconds = min(seconds or self.max_seconds, self.max_seconds)
+        requests = min(requests, self.max_requests) if requests and endpoint else None
+        run = _Run(endpoint, requests)
+        with self.lock:
+            if self.run is not None:
+                raise ProfilingUnavailable('A profile is already running in this worker.')
+            self.run = run
+
+        caller = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        started = time.monotonic()
+        deadline = started + seconds
+        try:
+            while not run.done.wait(self.interval) and time.monotonic() < deadline:
+                frames = sys._current_frames()
+                for ident, current in list(self.active.items()):
+                    if ident == caller or (endpoint is not None and current != endpoint):
+                        continue
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[self._collapse(frame, current)] += 1
+                        samples += 1
+                del frames
+        finally:
+            with self.lock:
+                self.run = None
+                self.active.clear()
+        return stacks, {'samples': samples, 'seconds': round(time.monotonic() - started, 3),
+                        'requests': run.completed, 'interval': self.interval}
+
+
+def collapsed(stacks):
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+class MemoryTracer:
+    """tracemalloc snapshots of the current worker, within strict limits.
+
+    Tracing is started on demand with at most ``max_frames`` frames per
+    trace. A watchdog thread checks tracemalloc's own memory every
+    ``check_interval`` seconds and stops tracing once it passes
+    ``max_overhead`` bytes, or after ``max_seconds``, whether or not anyone
+    takes a snapshot. Snapshots are taken at most every ``min_interval``
+    seconds. Each one reports the top allocation sites and the growth since
+    tracing started.
+    """
+
+    IGNORED = (tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+               tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+               tracemalloc.Filter(False, '<unknown>'))
+
+    def __init__(self):
+        self.enabled = False
+        self.max_frames = 10
+        self.max_seconds = 600
+        self.max_overhead = 64 * 2 ** 20
+        self.min_interval = 5
+        self.check_interval = 2
+        self.lock = threading.Lock()
+        self.baseline = None
+        self.started_at = None
+        self.last_snapshot = 0
+        self.stopping = None  # Event of the current run, set to end its watchdog
+        self.stopped_because = None
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PROFILING_ENABLED', False)
+        self.max_frames = app.config.get('TRACEMALLOC_MAX_FRAMES', 10)
+        self.max_seconds = app.config.get('TRACEMALLOC_MAX_SECONDS', 600)
+        self.max_overhead = app.config.get('TRACEMALLOC_MAX_OVERHEAD_MB', 64) * 2 ** 20
+        self.min_interval = app.config.get('TRACEMALLOC_MIN_INTERVAL', 5)
+        self.check_interval = app.config.get('TRACEMALLOC_CHECK_INTERVAL', 2)
+
+    @property
+    def tracing(self):
+        return self.baseline is not None
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(self.IGNORED)
+
+    def start(self, frames=1):
+        with self.lock:
+            if tracemalloc.is_tracing():
+                raise ProfilingUnavailable('tracemalloc is already tracing in this worker.')
+            tracemalloc.start(max(1, min(frames, self.max_frames)))
+            self.baseline = self._snapshot()
+            self.started_at = time.monotonic()
+            self.stopped_because = None
+            self.stopping = threading.Event()
+            threading.Thread(target=self._watch, args=(self.stopping, self.started_at + self.max_seconds),
+                             name='tracemalloc-watchdog', daemon=True).start()
+
+    def _watch(self, stopping, deadline):
+        while not stopping.wait(self.check_interval):
+            if time.monotonic() >= deadline:
+                self._stop(stopping, f'time limit of {self.max_seconds}s reached')
+                return
+            overhead = tracemalloc.get_tracemalloc_memory()
+            if overhead > self.max_overhead:
+                logging.warning("tracemalloc used %.0fMB, over TRACEMALLOC_MAX_OVERHEAD_MB; tracing stopped",
+                                overhead / 2 ** 20)
+                self._stop(stopping, f'tracemalloc used {overhead / 2 ** 20:.0f}MB')
+                return
+
+    def _stop(self, run, reason):
+        # Only stops the run the watchdog belongs to, not one started since
+        with self.lock:
+            if self.stopping is run:
+                self._stop_tracing(reason)
+
+    def _stop_tracing(self, reason):
+        if self.stopping is not None:
+            self.stopping.set()
+            self.stopping = None
+        if self.baseline is not None:
+            tracemalloc.stop()
+            self.baseline = None
+            self.stopped_because = reason
+
+    def stop(self):
+        with self.lock:
+            self._stop_tracing('stopped')
+
+    def status(self):
+        with self.lock:
+            if not self.tracing:
+                return {'pid': os.getpid(), 'tracing': False, 'stopped_because': self.stopped_because}
+            current, peak = tracemalloc.get_traced_memory()
+            return {'pid': os.getpid(), 'tracing': True, 'frames': tracemalloc.get_traceback_limit(),
+                    'seconds': round(time.monotonic() - self.started_at, 1),
+                    'seconds_left': round(self.started_at + self.max_seconds - time.monotonic(), 1),
+                    'traced_bytes': current, 'peak_bytes': peak,
+                    'overhead_bytes': tracemalloc.get_tracemalloc_memory()}
+
+    def snapshot(self, limit=20, key='lineno'):
+        """Top ``limit`` allocation sites now, and the largest changes since tracing started."""
+        if key not in ('lineno', 'filename', 'traceback'):
+            raise ValueError(f'Unknown grouping {key!r}')
+        with self.lock:
+            if not self.tracing:
+                raise ProfilingUnavailable('tracemalloc is not tracing; start it first.')
+            wait = self.last_snapshot + self.min_interval - time.monotonic()
+            if wait > 0:
+                raise ProfilingUnavailable(f'Snapshots are limited to one every {self.min_interval}s; '
+                                           f'retry in {wait:.0f}s.')
+            overhead = tracemalloc.get_tracemalloc_memory()
+            if overhead > self.max_overhead:
+                self._stop_tracing(f'tracemalloc used {overhead / 2 ** 20:.0f}MB')
+                raise ProfilingUnavailable(f'tracemalloc used {overhead / 2 ** 20:.0f}MB; tracing stopped.')
+            snapshot, baseline = self._snapshot(), self.baseline
+            self.last_snapshot = time.monotonic()
+
+        def site(stat):
+            return [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback]
+
+        result = self.status()
+        result['top'] = [{'site': site(stat), 'size': stat.size, 'count': stat.count}
+                         for stat in snapshot.statistics(key)[:limit]]
+        result['growth'] = [{'site': site(stat), 'size_diff': stat.size_diff, 'count_diff': stat.count_diff,
+                             'size': stat.size} for stat in snapshot.compare_to(baseline, key)[:limit]]
+        return result
+
+
+profiler = SamplingProfiler()
+memory_tracer = MemoryTracer()
@@ -0,0 +1,302 @@
+import os
+import csv
+import json
+import time
+import uuid
+import logging
+import datetime
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+
+from app import db
+from models import User
+from passwords import password_hasher, PasswordHasherBusy
+
+REPORT_FIELDS = ['line', 'username', 'status', 'message']
+
+
+class RowError(ValueError):
+    pass
+
+
+class RosterTooLarge(ValueError):
+    """The uploaded roster has more rows than an upload may; use the CLI."""
+
+
+def read_roster(stream, fmt):
+    """Yield ``(line, record)`` from a CSV (with a header) or JSONL text stream.
+
+    A line that cannot be parsed yields ``(line, RowError)`` instead.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'jsonl':
+        for line, text in enumerate(stream, 1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+                if not isinstance(record, dict):
+                    raise ValueError('not an object')
+                yield line, record
+            except ValueError as e:
+                yield line, RowError(f'Invalid JSON: {e}')
+    else:
+        raise ValueError(f'Unknown roster format {fmt!r}')
+
+
+def roster_format(filename):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def clean_row(record):
+    """Validate a roster record the way RegistrationForm does; returns the user columns."""
+    def text(name):
+        value = record.get(name)
+        return str(value).strip() if value is not None else ''
+
+    username, full_name = text('username'), text('full_name')
+    # Passwords are taken as given, like RegistrationForm does
+    password = record.get('password')
+    password = str(password) if password is not None else ''
+    qualification, dob = text('qualification'), text('dob')
+    if not 3 <= len(username) <= 64:
+        raise RowError('Username must be between 3 and 64 characters.')
+    if not full_name or len(full_name) > 100:
+        raise RowError('Full name is required (at most 100 characters).')
+    if len(qualification) > 100:
+        raise RowError('Qualification must be at most 100 characters.')
+    if len(password) < 6:
+        raise RowError('Password must be at least 6 characters.')
+    if dob:
+        try:
+            dob = datetime.date.fromisoformat(dob)
+        except ValueError:
+            raise RowError('Date of birth must be YYYY-MM-DD.')
+        if dob > datetime.date.today():
+            raise RowError('Date of birth cannot be in the future.')
+    return {'username': username, 'full_name': full_name, 'qualification': qualification or None,
+            'dob': dob or None, 'password': password}
+
+
+def _hash(args):
+    # Runs in a pool worker
+    password, method = args
+    return generate_password_hash(password, method=method)
+
+
+class Provisioner:
+    """Create users in bulk from a CSV or JSONL roster.
+
+    The roster is read in one streaming pass and handled in batches of
+    ``batch_size`` rows. Per batch: rows are validated, usernames already
+    taken are found with a single ``IN`` query (duplicates within the file
+    are caught with a set), passwords are hashed and the new users are
+    inserted with one executemany. Every row ends up in the report as
+    created, duplicate or error.
+
+    ``flask provision-users`` hashes across a process pool of its own.
+    Uploads from the admin page run on a thread of a web worker, so they
+    are capped at ``upload_max_rows`` rows and hash one password at a time
+    through password_hasher's pool, backing off while logins fill it.
+    """
+
+    def __init__(self):
+        self.batch_size = 1000
+        self.workers = None
+        self.upload_max_rows = 2000
+        self.busy_pause = 0.5
+        self.report_dir = None
+
+    def init_app(self, app):
+        self.batch_size = app.config.get('PROVISION_BATCH_SIZE', 1000)
+        self.workers = app.config.get('PROVISION_HASH_WORKERS') or os.cpu_count()
+        self.upload_max_rows = app.config.get('PROVISION_UPLOAD_MAX_ROWS', 2000)
+        self.report_dir = os.path.join(app.instance_path, 'provisioning')
+
+    def _executor(self):
+        context = None
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    def _hash_shared(self, passwords):
+        # One job at a time, so an upload holds at most one of the pool's slots
+        hashes = []
+        for password in passwords:
+            while True:
+                try:
+                    hashes.append(password_hasher.hash(password))
+                    break
+                except PasswordHasherBusy:
+                    time.sleep(self.busy_pause)
+        return hashes
+
+    def provision(self, rows, report, progress=None, shared_pool=False):
+        """Provision users from ``(line, record)`` pairs; ``report(result)`` gets one dict per row.
+
+        Passwords are hashed in a process pool started for the run, or with
+        ``shared_pool`` through password_hasher. Returns counts per status.
+        """
+        if shared_pool:
+            return self._provision_rows(rows, report, progress, self._hash_shared)
+        with self._executor() as executor:
+            def hash_all(passwords):
+                return executor.map(_hash, [(password, password_hasher.method) for password in passwords],
+                                    chunksize=max(len(passwords) // (self.workers * 4), 1))
+            return self._provision_rows(rows, report, progress, hash_all)
+
+    def _provision_rows(self, rows, report, progress, hash_all):
+        counts = {'created': 0, 'duplicate': 0, 'error': 0}
+        seen = set()
+
+        def emit(line, username, status, message=''):
+            counts[status] += 1
+            report({'line': line, 'username': username, 'status': status, 'message': message})
+
+        batch = []
+        for line, record in rows:
+            batch.append((line, record))
+            if len(batch) >= self.batch_size:
+                self._report_in_order(batch, seen, hash_all, emit)
+                batch = []
+                if progress:
+                    progress(counts)
+        if batch:
+            self._report_in_order(batch, seen, hash_all, emit)
+            if progress:
+                progress(counts)
+        return counts
+
+    def _report_in_order(self, batch, seen, hash_all, emit):
+        results = []
+        try:
+            self._provision_batch(batch, seen, hash_all, lambda *result: results.append(result))
+        finally:
+            for result in sorted(results, key=lambda result: result[0]):
+                emit(*result)
+
+    def _provision_batch(self, batch, seen, hash_all, emit):
+        valid = []
+        for line, record in batch:
+            if isinstance(record, RowError):
+                emit(line, '', 'error', str(record))
+                continue
+            try:
+                row = clean_row(record)
+            except RowError as e:
+                emit(line, str(record.get('username') or ''), 'error', str(e))
+                continue
+            if row['username'] in seen:
+                emit(line, row['username'], 'duplicate', 'Username appears earlier in the roster.')
+                continue
+            seen.add(row['username'])
+            valid.append((line, row))
+
+        taken = set(db.session.execute(select(User.username).where(
+            User.username.in_([row['username'] for _, row in valid]))).scalars())
+        new = []
+        for line, row in valid:
+            if row['username'] in taken:
+                emit(line, row['username'], 'duplicate', 'Username already taken.')
+            else:
+                new.append((line, row))
+        if not new:
+            return
+
+        hashes = hash_all([row['password'] for _, row in new])
+        records = []
+        for (line, row), password_hash in zip(new, hashes):
+            records.append({'username': row['username'], 'password_hash': password_hash,
+                            'full_name': row['full_name'], 'qualification': row['qualification'],
+                            'dob': row['dob'], 'is_admin': False})
+        try:
+            db.session.execute(User.__table__.insert(), records)
+            db.session.commit()
+            for line, row in new:
+                emit(line, row['username'], 'created')
+        except IntegrityError:
+            # Someone registered one of these names meanwhile: go row by row
+            db.session.rollback()
+            for (line, row), record in zip(new, records):
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(User.__table__.insert(), record)
+                    emit(line, row['username'], 'created')
+                except IntegrityError:
+                    emit(line, row['username'], 'duplicate', 'Username already taken.')
+            db.session.commit()
+
+    # Background jobs for the admin upload; state lives in a JSON file so
+    # any worker can report on it
+
+    def _report_path(self, job_id):
+        return os.path.join(self.report_dir, f'{job_id}.json')
+
+    def _write_state(self, job_id, state):
+        path = self._report_path(job_id)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    def job_state(self, job_id):
+        try:
+            with open(self._report_path(uuid.UUID(job_id).hex)) as f:
+                return json.load(f)
+        except (ValueError, OSError):
+            return None
+
+    def start_job(self, upload):
+        """Save an uploaded roster and provision from it on a background thread; returns the job id.
+
+        Raises RosterTooLarge if it has more than ``upload_max_rows`` rows.
+        """
+        os.makedirs(self.report_dir, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        filename = upload.filename or 'roster.csv'
+        roster_path = os.path.join(self.report_dir, f'{job_id}.roster')
+        upload.save(roster_path)
+        with open(roster_path, encoding='utf-8-sig', newline='') as stream:
+            rows = sum(1 for _ in read_roster(stream, roster_format(filename)))
+        if rows > self.upload_max_rows:
+            os.remove(roster_path)
+            raise RosterTooLarge(f'The roster has {rows} rows; uploads are limited to {self.upload_max_rows}. '
+                                 f'Import it with `flask provision-users`.')
+        state = {'job_id': job_id, 'filename': filename, 'status': 'running',
+                 'counts': {'created': 0, 'duplicate': 0, 'error': 0}, 'rows': []}
+        self._write_state(job_id, state)
+        app = current_app._get_current_object()
+
+        def job():
+            with app.app_context():
+                def progress(counts):
+                    state['counts'] = dict(counts)
+                    self._write_state(job_id, state)
+                try:
+                    with open(roster_path, encoding='utf-8-sig', newline='') as stream:
+                        state['counts'] = self.provision(read_roster(stream, roster_format(filename)),
+                                                         report=state['rows'].append, progress=progress,
+                                                         shared_pool=True)
+                    state['status'] = 'done'
+                except Exception as e:
+                    db.session.rollback()
+                    logging.exception("Provisioning job %s failed", job_id)
+                    state['status'], state['error'] = 'failed', str(e)
+                finally:
+                    os.remove(roster_path)
+                self._write_state(job_id, state)
+                logging.info("Provisioning job %s finished: %s", job_id, state['counts'])
+
+        threading.Thread(target=job, name=f'provision-{job_id[:8]}', daemon=True).start()
+        return job_id
+
+
+provisioner = Provisioner()
@@ -0,0 +1,73 @@
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from app import db
+from models import Score, Quiz, Chapter, Subject
+
+# Rows for the listing pages, filled from column-only selects: no identity
+# map, no change tracking and no lazy relationships behind them. Templates
+# read them like the models (``quiz.title``, ``chapter.subject_name``).
+QuizRow = namedtuple('QuizRow', ['id', 'title', 'description', 'date', 'duration',
+                                 'chapter_name', 'subject_name'])
+ChapterRow = namedtuple('ChapterRow', ['id', 'name', 'description', 'subject_name'])
+ChapterOption = namedtuple('ChapterOption', ['id', 'name', 'subject_name'])
+SubjectOption = namedtuple('SubjectOption', ['id', 'name'])
+
+
+def _rows(row_type, statement):
+    return [row_type._make(row) for row in db.session.execute(statement)]
+
+
+def _quizzes():
+    return select(Quiz.id, Quiz.title, Quiz.description, Quiz.date, Quiz.duration,
+                  Chapter.name, Subject.name)\
+        .join(Chapter, Quiz.chapter_id == Chapter.id)\
+        .join(Subject, Chapter.subject_id == Subject.id)
+
+
+def quiz_rows(subject_id=None, search=''):
+    """Quizzes for the user quiz list, newest first; ``search`` matches quiz, chapter or subject."""
+    statement = _quizzes()
+    if subject_id:
+        statement = statement.where(Chapter.subject_id == subject_id)
+    if search:
+        statement = statement.where(Quiz.title.contains(search) | Chapter.name.contains(search)
+                                    | Subject.name.contains(search))
+    return _rows(QuizRow, statement.order_by(Quiz.date.desc(), Quiz.id))
+
+
+def admin_quiz_rows(chapter_id=None, search=''):
+    """Quizzes for the admin table; ``search`` matches the title."""
+    statement = _quizzes()
+    if chapter_id:
+        statement = statement.where(Quiz.chapter_id == chapter_id)
+    if search:
+        statement = statement.where(Quiz.title.contains(search))
+    return _rows(QuizRow, statement.order_by(Quiz.id))
+
+
+def chapter_rows(subject_id=None, search=''):
+    statement = select(Chapter.id, Chapter.name, Chapter.description, Subject.name)\
+        .join(Subject, Chapter.subject_id == Subject.id)
+    if subject_id:
+        statement = statement.where(Chapter.subject_id == subject_id)
+    if search:
+        statement = statement.where(Chapter.name.contains(search))
+    return _rows(ChapterRow, statement.order_by(Chapter.id))
+
+
+def chapter_options():
+    """Every chapter with its subject's name, in one query."""
+    return _rows(ChapterOption, select(Chapter.id, Chapter.name, Subject.name)
+                 .join(Subject, Chapter.subject_id == Subject.id)
+                 .order_by(Chapter.id))
+
+
+def subject_options():
+    return _rows(SubjectOption, select(Subject.id, Subject.name).order_by(Subject.id))
+
+
+def completed_attempts(user_id):
+    """``{quiz_id: score_id}`` of the quizzes a user has attempted."""
+    return dict(db.session.execute(select(Score.quiz_id, Score.id).where(Score.user_id == user_id)).all())
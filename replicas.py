@@ -0,0 +1,65 @@
+import time
+import sqlite3
+from functools import wraps
+from contextlib import contextmanager
+
+from flask import g, session, has_app_context, current_app
+from flask_sqlalchemy.session import Session
+
+REPLICA = 'replica'
+
+
+class RoutingSession(Session):
+    """Sends the reads of replica-routed requests to the ``replica`` bind.
+
+    Writes, flushes and anything outside a routed request keep using the
+    primary. Only takes effect when ``SQLALCHEMY_BINDS`` has a replica.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_app_context() and g.get('db_read_replica')
+                and not getattr(clause, 'is_dml', False) and REPLICA in self._db.engines):
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_replica(view):
+    """Route a read-only view's queries to the replica.
+
+    A user who wrote recently (see ``stick_to_primary``) keeps reading from
+    the primary until the window passes, so they always see their own
+    writes.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_replica = session.get('primary_until', 0) < time.time()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def stick_to_primary():
+    """Read this user's requests from the primary for REPLICA_STICKY_SECONDS."""
+    if REPLICA in current_app.config.get('SQLALCHEMY_BINDS', {}):
+        session['primary_until'] = time.time() + current_app.config.get('REPLICA_STICKY_SECONDS', 30)
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary inside a replica-routed request."""
+    routed = g.get('db_read_replica', False)
+    g.db_read_replica = False
+    try:
+        yield
+    finally:
+        g.db_read_replica = routed
+
+
+def sync_sqlite_replica(primary_path, replica_path):
+    """Copy a SQLite primary onto the replica file, standing in for replication locally."""
+    source = sqlite3.connect(primary_path)
+    target = sqlite3.connect(replica_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
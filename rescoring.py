@@ -0,0 +1,170 @@
+import time
+import logging
+import datetime
+import operator
+import threading
+from itertools import groupby
+
+from flask import current_app
+from sqlalchemy import select, update, func
+
+from app import db
+from models import Score, Question, UserAnswer, AnswerArchive, RescoreRun
+from archive import unpack_answers
+
+
+def answers_by_score(score_ids):
+    """``{score_id: [(question_id, user_answer), ...]}`` from both answer tiers."""
+    rows = db.session.execute(
+        select(UserAnswer.score_id, UserAnswer.question_id, UserAnswer.user_answer)
+        .where(UserAnswer.score_id.in_(score_ids))
+        .order_by(UserAnswer.score_id)
+    ).all()
+    answers = {score_id: [(question_id, answer) for _, question_id, answer in group]
+               for score_id, group in groupby(rows, key=operator.itemgetter(0))}
+    archived = db.session.execute(
+        select(AnswerArchive.score_id, AnswerArchive.answers)
+        .where(AnswerArchive.score_id.in_([score_id for score_id in score_ids if score_id not in answers]))
+    ).all()
+    for score_id, blob in archived:
+        answers[score_id] = [tuple(answer) for answer in unpack_answers(blob)]
+    return answers
+
+
+def count_correct(answers, key):
+    """Number of ``(question_id, user_answer)`` pairs matching ``key`` (question id -> answer string).
+
+    The comparison is one map over the two columns rather than a Python loop
+    per answer; questions no longer in the key never match.
+    """
+    if not answers:
+        return 0
+    question_ids, given = zip(*answers)
+    return sum(map(operator.eq, given, map(key.get, question_ids)))
+
+
+class Rescorer:
+    """Recompute stored scores after a quiz's answer key changes.
+
+    Attempts are processed in chunks of ``chunk_size`` score ids, one short
+    transaction each: the chunk's answers are read (archived attempts
+    included), compared against the current key and only the changed scores
+    are written back with one bulk UPDATE. The key is re-read for every
+    chunk, so a run always converges on the latest key; a change made while
+    a run is going schedules one more run after it. Progress is kept in a
+    RescoreRun row so any worker can report it.
+    """
+
+    def __init__(self):
+        self.chunk_size = 500
+        self.chunk_pause = 0
+        self.lock = threading.Lock()
+        self.running = set()
+        self.rerun = set()
+
+    def init_app(self, app):
+        self.chunk_size = app.config.get('RESCORE_CHUNK_SIZE', 500)
+        self.chunk_pause = app.config.get('RESCORE_CHUNK_PAUSE', 0)
+
+    def _key(self, quiz_id):
+        return {question_id: str(correct) for question_id, correct in db.session.execute(
+            select(Question.id, Question.correct_answer).where(Question.quiz_id == quiz_id))}
+
+    def _rescore_chunk(self, quiz_id, score_ids):
+        key = self._key(quiz_id)
+        scores = db.session.execute(
+            select(Score.id, Score.correct_answers, Score.total_questions, Score.total_score)
+            .where(Score.id.in_(score_ids))
+        ).all()
+        answers = answers_by_score(score_ids)
+        updates = []
+        for score_id, correct_before, total_questions, score_before in scores:
+            correct = count_correct(answers.get(score_id, ()), key)
+            total_score = correct / total_questions * 100 if total_questions else 0
+            if correct != correct_before or abs(total_score - (score_before or 0)) > 1e-9:
+                updates.append({'id': score_id, 'correct_answers': correct, 'total_score': total_score})
+        if updates:
+            db.session.execute(update(Score), updates)
+        return len(updates)
+
+    def rescore(self, quiz_id, run=None, progress=None):
+        """Rescore every attempt of a quiz; returns the number of scores changed."""
+        score_ids = list(db.session.execute(
+            select(Score.id).where(Score.quiz_id == quiz_id).order_by(Score.id)).scalars())
+        if run is None:
+            run = RescoreRun(quiz_id=quiz_id)
+            db.session.add(run)
+        run.total_scores = len(score_ids)
+        db.session.commit()
+
+        changed = 0
+        for start in range(0, len(score_ids), self.chunk_size):
+            chunk = score_ids[start:start + self.chunk_size]
+            changed += self._rescore_chunk(quiz_id, chunk)
+            run.processed = start + len(chunk)
+            run.changed = changed
+            db.session.commit()
+            if progress:
+                progress(run.processed, run.total_scores, changed)
+            if self.chunk_pause:
+                time.sleep(self.chunk_pause)
+
+        run.status = 'done'
+        run.finished_at = datetime.datetime.now()
+        db.session.commit()
+        return changed
+
+    def schedule(self, quiz_id):
+        """Rescore a quiz on a background thread; returns the RescoreRun id, or None if
+        there is nothing to rescore or a run already going will pick up the change."""
+        with self.lock:
+            if quiz_id in self.running:
+                self.rerun.add(quiz_id)
+                return None
+        attempts = db.session.execute(select(func.count(Score.id)).where(Score.quiz_id == quiz_id)).scalar()
+        if not attempts:
+            return None
+        with self.lock:
+            self.running.add(quiz_id)
+        run = RescoreRun(quiz_id=quiz_id, total_scores=attempts)
+        db.session.add(run)
+        db.session.commit()
+        run_id = run.id
+
+        app = current_app._get_current_object()
+
+        def job(run_id):
+            with app.app_context():
+                while True:
+                    run = db.session.get(RescoreRun, run_id)
+                    started = time.monotonic()
+                    try:
+                        changed = self.rescore(quiz_id, run)
+                    except Exception as e:
+                        db.session.rollback()
+                        logging.exception("Rescoring quiz %s failed", quiz_id)
+                        run = db.session.get(RescoreRun, run_id)
+                        run.status, run.error = 'failed', str(e)
+                        run.finished_at = datetime.datetime.now()
+                        db.session.commit()
+                    else:
+                        logging.info("Rescored quiz %s: %d of %d scores changed in %.1fs",
+                                     quiz_id, changed, run.total_scores, time.monotonic() - started)
+                    with self.lock:
+                        if quiz_id not in self.rerun:
+                            self.running.discard(quiz_id)
+                            return
+                        self.rerun.discard(quiz_id)
+                    run = RescoreRun(quiz_id=quiz_id)
+                    db.session.add(run)
+                    db.session.commit()
+                    run_id = run.id
+
+        threading.Thread(target=job, args=(run_id,), name=f'rescore-{quiz_id}', daemon=True).start()
+        return run_id
+
+    def latest_run(self, quiz_id):
+        return RescoreRun.query.filter_by(quiz_id=quiz_id).order_by(RescoreRun.id.desc()).first()
+
+
+rescorer = Rescorer()
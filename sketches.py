@@ -0,0 +1,235 @@
+import math
+import time
+import logging
+import threading
+
+from sqlalchemy import func, extract
+
+from app import db
+from models import Score, Quiz, Chapter
+from replicas import use_primary
+from http_cache import data_versions
+from leaderboard import ScoreWatermark, MAX_GAPS
+
+# Bulk score changes (rescoring, deletes) and quizzes or chapters moving to
+# another subject bump these; a change seen on read triggers a rebuild
+VERSION_KEYS = ('catalog:structure', 'scores:bulk')
+
+# Same 10-point bands as the charts elsewhere; the last one includes 100
+BAND_LABELS = ['0-9', '10-19', '20-29', '30-39', '40-49', '50-59', '60-69', '70-79', '80-89', '90-100']
+
+def _bin(total_score):
+    return min(max(math.floor((total_score or 0) + 0.5), 0), 100)
+
+
+class Histogram:
+    """Counts of percentage scores rounded to whole points.
+
+    Merging two histograms adds their counts, so a subject's or a window's
+    distribution is the sum of its parts. Quantiles are nearest-rank over
+    the rounded scores, within half a point of the exact value; the mean is
+    exact.
+    """
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, total_score, n=1):
+        key = _bin(total_score)
+        self.counts[key] = self.counts.get(key, 0) + n
+        self.count += n
+        self.total += (total_score or 0) * n
+
+    def merge(self, other):
+        for key, n in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + n
+        self.count += other.count
+        self.total += other.total
+        return self
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = max(math.ceil(q * self.count), 1)
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= rank:
+                return key
+
+    def bands(self):
+        bands = [0] * len(BAND_LABELS)
+        for key, n in self.counts.items():
+            bands[min(key // 10, len(BAND_LABELS) - 1)] += n
+        return bands
+
+    def summary(self):
+        return {
+            'attempts': self.count,
+            'mean': round(self.total / self.count, 1) if self.count else None,
+            'median': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'bands': [{'band': label, 'attempts': n} for label, n in zip(BAND_LABELS, self.bands())],
+        }
+
+
+class ScoreSketches:
+    """Score distributions per quiz and per subject, one histogram per month.
+
+    Like the leaderboards, the sketches live in each worker's memory:
+    submit_quiz adds its score directly and scores from other workers are
+    read past a ScoreWatermark on ``scores.id``. Bulk changes (rescoring,
+    deletes, quizzes or chapters moved to another subject) are caught on
+    read by comparing the 'catalog:structure' and 'scores:bulk' data
+    versions with those the sketches were built from, whether or not a bus
+    event arrived. Other catalog edits need no rebuild: the subject of a
+    quiz created since is looked up when its first scores are read, and
+    its quiz histograms are added to the subject's. A rebuild is one GROUP BY
+    over scores; it runs outside the lock and is swapped in, and other
+    readers keep using the current sketches meanwhile. Reads merge the
+    monthly histograms of the requested window, so their cost depends on
+    the number of months, not the number of attempts.
+    """
+
+    # Replaced as a whole by a rebuild
+    STATE = ('sketches', 'quiz_subject', 'unmapped', 'watermark', 'versions')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rebuild_interval = 3600
+        self.rebuilding = False
+        self._reset()
+
+    def _reset(self):
+        self.sketches = {}  # (scope, id) -> {(year, month): Histogram}
+        self.quiz_subject = {}
+        self.unmapped = set()  # quizzes counted before their subject was known
+        self.watermark = ScoreWatermark()
+        self.versions = None
+        self.loaded = False
+        self.stale = False
+        self.last_rebuild = 0
+
+    def init_app(self, app):
+        self.rebuild_interval = app.config.get('SKETCH_REBUILD_INTERVAL', 3600)
+
+    # Updates
+
+    def _apply(self, quiz_id, month, total_score, n=1):
+        if quiz_id not in self.quiz_subject:
+            self.unmapped.add(quiz_id)
+        for scope, scope_id in (('quiz', quiz_id), ('subject', self.quiz_subject.get(quiz_id))):
+            if scope_id is not None:
+                months = self.sketches.setdefault((scope, scope_id), {})
+                months.setdefault(month, Histogram()).add(total_score, n)
+
+    def record(self, score):
+        """Count a newly committed score (no query; skipped until the sketches are loaded)."""
+        with self.lock:
+            if self.loaded and self.watermark.seen(score.id):
+                self._apply(score.quiz_id, (score.timestamp.year, score.timestamp.month), score.total_score)
+
+    def invalidate(self):
+        with self.lock:
+            self.stale = True
+
+    # Loading
+
+    def _build(self, versions):
+        """Fill this (fresh) instance from the database."""
+        self.versions = versions
+        self.quiz_subject = dict(db.session.query(Quiz.id, Chapter.subject_id)
+                                 .join(Chapter, Quiz.chapter_id == Chapter.id).all())
+        top = db.session.query(func.max(Score.id)).scalar() or 0
+        year, month = extract('year', Score.timestamp), extract('month', Score.timestamp)
+        for quiz_id, y, m, total_score, n in db.session.query(
+                Score.quiz_id, year, month, Score.total_score, func.count(Score.id))\
+                .filter(Score.id <= top)\
+                .group_by(Score.quiz_id, year, month, Score.total_score):
+            self._apply(quiz_id, (int(y or 0), int(m or 0)), total_score, n)
+        # Recent ids not committed yet are caught up once they are
+        recent = {score_id for score_id, in db.session.query(Score.id).filter(Score.id > top - MAX_GAPS,
+                                                                              Score.id <= top)}
+        self.watermark = ScoreWatermark(top, (score_id for score_id in range(max(top - MAX_GAPS + 1, 1), top + 1)
+                                              if score_id not in recent))
+        self.loaded = True
+        self.last_rebuild = time.monotonic()
+        logging.info("Score sketches rebuilt up to score %s", top)
+
+    def _swap(self, fresh):
+        for name in self.STATE:
+            setattr(self, name, getattr(fresh, name))
+        self.loaded = True
+        self.last_rebuild = fresh.last_rebuild
+
+    def _ensure_current(self):
+        versions = data_versions.get(*VERSION_KEYS)
+        with self.lock:
+            if not self.loaded:
+                # Nothing to serve yet, so build while holding the lock
+                fresh = ScoreSketches()
+                fresh._build(versions)
+                self._swap(fresh)
+                return
+            expired = time.monotonic() - self.last_rebuild > self.rebuild_interval
+            if self.rebuilding or not (self.stale or expired or versions != self.versions):
+                return
+            self.rebuilding = True
+            self.stale = False
+        try:
+            fresh = ScoreSketches()
+            fresh._build(versions)
+            with self.lock:
+                self._swap(fresh)
+        finally:
+            with self.lock:
+                self.rebuilding = False
+
+    def _map_new_quizzes(self):
+        # Every score of such a quiz so far went to its quiz histograms only
+        unmapped, self.unmapped = self.unmapped, set()
+        for quiz_id, subject_id in db.session.query(Quiz.id, Chapter.subject_id)\
+                .join(Chapter, Quiz.chapter_id == Chapter.id).filter(Quiz.id.in_(unmapped)):
+            self.quiz_subject[quiz_id] = subject_id
+            subject_months = self.sketches.setdefault(('subject', subject_id), {})
+            for month, part in self.sketches.get(('quiz', quiz_id), {}).items():
+                subject_months.setdefault(month, Histogram()).merge(part)
+
+    def _catch_up(self):
+        for score_id, quiz_id, timestamp, total_score in db.session.query(
+                Score.id, Score.quiz_id, Score.timestamp, Score.total_score)\
+                .filter(self.watermark.condition(Score.id)).order_by(Score.id).yield_per(1000):
+            if self.watermark.seen(score_id):
+                self._apply(quiz_id, (timestamp.year, timestamp.month) if timestamp else (0, 0), total_score)
+
+    # Queries
+
+    def histograms(self, scope, scope_ids=None, since=None):
+        """``{id: Histogram}`` for quizzes or subjects (all of them when ``scope_ids`` is None),
+        merged over the months from ``since`` (a datetime) on."""
+        start = (since.year, since.month) if since else (0, 0)
+        with use_primary():
+            self._ensure_current()
+            with self.lock:
+                self._catch_up()
+                if self.unmapped:
+                    self._map_new_quizzes()
+                if scope_ids is None:
+                    scope_ids = [scope_id for kind, scope_id in self.sketches if kind == scope]
+                merged = {}
+                for scope_id in scope_ids:
+                    histogram = merged[scope_id] = Histogram()
+                    for month, part in self.sketches.get((scope, scope_id), {}).items():
+                        if month >= start:
+                            histogram.merge(part)
+                return merged
+
+    def summary(self, scope, scope_id, since=None):
+        return self.histograms(scope, [scope_id], since)[scope_id].summary()
+
+
+sketches = ScoreSketches()
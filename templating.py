@@ -0,0 +1,60 @@
+import os
+import time
+import logging
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class TemplateCompiler:
+    """Bytecode cache and warm-up for the Jinja templates.
+
+    Compiled templates are cached on disk in ``TEMPLATE_CACHE_DIR`` (one file
+    per template, shared by every worker and kept across restarts; Jinja
+    recompiles a template whose source checksum no longer matches).
+    ``flask precompile-templates`` fills the cache at deploy time, and
+    ``TEMPLATE_WARMUP`` loads every template when the app starts, so with
+    ``GUNICORN_PRELOAD`` the workers inherit them compiled.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.cache_dir = None
+
+    def init_app(self, app):
+        self.app = app
+        self.cache_dir = app.config.get('TEMPLATE_CACHE_DIR')
+        env = app.jinja_env
+        trim_blocks = app.config.get('TEMPLATE_TRIM_BLOCKS', False)
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Jinja only checks the source checksum, so code compiled with the
+            # other whitespace setting is kept apart by its file name
+            pattern = '__jinja2_%s.trim.cache' if trim_blocks else '__jinja2_%s.cache'
+            env.bytecode_cache = FileSystemBytecodeCache(self.cache_dir, pattern)
+        if trim_blocks:
+            # Drops the indentation and newlines around block tags from the output
+            env.trim_blocks = True
+            env.lstrip_blocks = True
+        if app.config.get('TEMPLATE_WARMUP'):
+            self.precompile()
+
+    def template_names(self):
+        return [name for name in self.app.jinja_env.list_templates()
+                if name.endswith(('.html', '.txt'))]
+
+    def precompile(self):
+        """Load every template, writing the bytecode cache; returns the count."""
+        started = time.perf_counter()
+        names = self.template_names()
+        for name in names:
+            self.app.jinja_env.get_template(name)
+        logging.info("Precompiled %d templates in %.0f ms", len(names),
+                     (time.perf_counter() - started) * 1000)
+        return len(names)
+
+    def clear(self):
+        if self.app.jinja_env.bytecode_cache is not None:
+            self.app.jinja_env.bytecode_cache.clear()
+
+
+templates = TemplateCompiler()